@@ -21,21 +21,33 @@ datetime.datetime class.
 
 
 
+import array
+import bisect
 import calendar
+import collections
 import copy
 import datetime
+import functools
+import itertools
+import operator
+import os
 import re
+import struct
 import sys
+import threading
 import time
 import types
 import warnings
 
 import dateutil.parser
+import dateutil.tz
 import pytz
 
 
+
 _MICROSECONDS_PER_SECOND = 1000000
 _MICROSECONDS_PER_SECOND_F = float(_MICROSECONDS_PER_SECOND)
+_EPOCH = datetime.datetime(1970, 1, 1)
 
 
 def SecondsToMicroseconds(seconds):
@@ -61,12 +73,19 @@ def MicrosecondsToSeconds(microseconds):
   return microseconds / _MICROSECONDS_PER_SECOND_F
 
 
+# The CoarseClock that the current time is read from; see SetCoarseClock.
+_coarse_clock = None
+
+
 def _GetCurrentTimeMicros():
   """Get the current time in microseconds, in UTC.
 
   Returns:
     The number of microseconds since the epoch.
   """
+  clock = _coarse_clock
+  if clock is not None:
+    return clock.reading[1]
   return int(SecondsToMicroseconds(time.time()))
 
 
@@ -159,6 +178,120 @@ def UTCMillisToDatetime(millis, tz=None):
   return UTCMicrosToDatetime(millis * 1000, tz)
 
 
+@functools.lru_cache(maxsize=1)
+def _Numpy():
+  """Import NumPy on first use, as it takes long to import; None if missing.
+
+  NumPy is optional; the bulk conversions also work on plain sequences.
+  """
+  try:
+    import numpy  # pylint: disable=g-import-not-at-top
+  except ImportError:
+    return None
+  return numpy
+
+
+def _IsNumpyArray(values):
+  """Returns whether values is a NumPy array."""
+  # A NumPy array can only exist once NumPy has been imported.
+  numpy = sys.modules.get('numpy')
+  return numpy is not None and isinstance(values, numpy.ndarray)
+
+
+def _TimedeltaToMicros(delta):
+  """Convert a timedelta to a whole number of microseconds."""
+  return ((delta.days * 86400 + delta.seconds) * _MICROSECONDS_PER_SECOND +
+          delta.microseconds)
+
+
+def _DatetimeToUTCMicrosFast(date):
+  """Same as DatetimeToUTCMicros, but using datetime arithmetic."""
+  offset = date.utcoffset()
+  try:
+    delta = (date if offset is None
+             else date.replace(tzinfo=None) - offset) - _EPOCH
+  except OverflowError:
+    # Converting to UTC spills over MINYEAR or MAXYEAR; utctimetuple() knows
+    # how to deal with that.
+    return DatetimeToUTCMicros(date)
+  return _TimedeltaToMicros(delta)
+
+
+def DatetimesToUTCMicros(dates):
+  """Converts many datetime objects to microseconds since the epoch in UTC.
+
+  The results are exactly those of DatetimeToUTCMicros, but each date is
+  turned into microseconds by datetime arithmetic instead of going through a
+  time tuple, and NumPy arrays are converted as a whole.
+
+  Args:
+    dates: A sequence of datetimes to convert, or a NumPy datetime64 array
+      (whose values are taken to be in UTC).
+  Returns:
+    A list with the number of microseconds since the epoch, in UTC, of every
+    date, or an int64 NumPy array of them if dates is a NumPy array.
+  """
+  if not _IsNumpyArray(dates):
+    return [_DatetimeToUTCMicrosFast(date) for date in dates]
+  numpy = _Numpy()
+  if dates.dtype.kind == 'M':
+    return dates.astype('datetime64[us]').astype(numpy.int64)
+  return numpy.array([_DatetimeToUTCMicrosFast(date) for date in dates],
+                     dtype=numpy.int64)
+
+
+_MIN_MICROS = DatetimeToUTCMicros(datetime.datetime.min)
+_MAX_MICROS = DatetimeToUTCMicros(datetime.datetime.max)
+
+
+def UTCMicrosToDatetimes(micros, tz=None):
+  """Converts many microsecond epoch times to datetime objects.
+
+  The results are exactly those of UTCMicrosToDatetime, including its rounding
+  of times too far from the epoch for a float to hold to the microsecond.  With
+  NumPy the values are converted as a whole; without it, one at a time.
+
+  Args:
+    micros: A sequence of UTC times, expressed in microseconds since the epoch,
+      or a NumPy array of them.
+    tz: The desired tzinfo for the datetime objects. If None, the
+        datetimes will be naive.
+  Returns:
+    A list of the datetimes represented by the input values.  If micros is a
+    NumPy array and tz is None, a datetime64[us] NumPy array of the same (UTC)
+    values instead.
+  Raises:
+    ValueError: if a value is outside of the range of datetime.
+  """
+  numpy = _Numpy()
+  if numpy is None:
+    return [UTCMicrosToDatetime(value, tz) for value in micros]
+  # This mirrors how datetime.utcfromtimestamp() splits a float timestamp
+  # into seconds and microseconds, rounding half to even.
+  seconds = (numpy.asarray(micros, dtype=numpy.float64) /
+             _MICROSECONDS_PER_SECOND_F)
+  fraction, whole = numpy.modf(seconds)
+  fraction = numpy.rint(fraction * _MICROSECONDS_PER_SECOND_F)
+  carry = fraction >= _MICROSECONDS_PER_SECOND_F
+  whole += carry
+  fraction -= carry * _MICROSECONDS_PER_SECOND_F
+  borrow = fraction < 0
+  whole -= borrow
+  fraction += borrow * _MICROSECONDS_PER_SECOND_F
+  if whole.size and not (
+      _MIN_MICROS // _MICROSECONDS_PER_SECOND <= whole.min() and
+      whole.max() <= _MAX_MICROS // _MICROSECONDS_PER_SECOND):
+    raise ValueError('timestamp out of range for datetime')
+  stamps = (whole.astype(numpy.int64) * _MICROSECONDS_PER_SECOND +
+            fraction.astype(numpy.int64)).astype('datetime64[us]')
+  if tz is None and _IsNumpyArray(micros):
+    return stamps
+  result = stamps.tolist()
+  if tz is not None:
+    result = [tz.fromutc(dt) for dt in result]
+  return result
+
+
 UTC = pytz.UTC
 US_PACIFIC = pytz.timezone('US/Pacific')
 
@@ -178,7 +311,212 @@ class TimeParseError(TimestampError):
   pass
 
 
-# TODO(user): this class needs to handle daylight better
+_ZONEINFO_DIR = '/usr/share/zoneinfo'
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+
+def _LocalTzfilePath():
+  """Get the path of the TZif file describing the local timezone.
+
+  Returns:
+    The path, following the TZ environment variable like the C library does,
+    or None if the local timezone is not described by a file.
+  """
+  name = os.environ.get('TZ')
+  if name is None:
+    return '/etc/localtime'
+  name = name.lstrip(':')
+  if not name:
+    return None
+  path = name if os.path.isabs(name) else os.path.join(_ZONEINFO_DIR, name)
+  return path if os.path.isfile(path) else None
+
+
+# The last year up to which the DST rule at the end of a TZif file is expanded
+# into transitions.  Later times are left to mktime().
+_TZIF_RULE_END_YEAR = 2100
+
+_POSIX_TZ_RE = re.compile(
+    r'%(name)s(?P<std>%(time)s)(?:%(name)s(?P<dst>%(time)s)?'
+    r',(?P<start>[^,/]+)(?:/(?P<start_time>%(time)s))?'
+    r',(?P<end>[^,/]+)(?:/(?P<end_time>%(time)s))?)?$' % {
+        'name': r'(?:<[^>]*>|[A-Za-z]+)',
+        'time': r'[-+]?\d+(?::\d+){0,2}'})
+
+
+def _PosixTimeToSeconds(text):
+  """Convert a [+-]hh[:mm[:ss]] time of a POSIX TZ string to seconds."""
+  sign = -1 if text.startswith('-') else 1
+  parts = [int(part) for part in text.lstrip('+-').split(':')]
+  parts += [0] * (3 - len(parts))
+  return sign * (parts[0] * 3600 + parts[1] * 60 + parts[2])
+
+
+def _PosixRuleDay(rule, year):
+  """Get the day a date rule of a POSIX TZ string picks in a year.
+
+  Args:
+    rule: str; Jn, n or Mm.w.d.
+    year: int.
+
+  Returns:
+    The proleptic Gregorian ordinal of the day.
+
+  Raises:
+    ValueError: if rule is invalid.
+  """
+  if rule.startswith('M'):
+    month, week, weekday = [int(part) for part in rule[1:].split('.')]
+    first = datetime.date(year, month, 1)
+    # POSIX counts weekdays from Sunday, date.weekday() from Monday.
+    day = 1 + (weekday - first.weekday() - 1) % 7 + (week - 1) * 7
+    days_in_month = calendar.monthrange(year, month)[1]
+    while day > days_in_month:
+      # Week 5 is the last one.
+      day -= 7
+    return first.toordinal() + day - 1
+  new_year = datetime.date(year, 1, 1).toordinal()
+  if rule.startswith('J'):
+    # Julian days never count February 29th.
+    day = int(rule[1:])
+    return new_year + day - 1 + (calendar.isleap(year) and day >= 60)
+  return new_year + int(rule)
+
+
+def _ExpandPosixTz(tz, first_year, last_year):
+  """Expand the DST rule of a POSIX TZ string into transitions.
+
+  Args:
+    tz: str; a TZ string like 'PST8PDT,M3.2.0,M11.1.0'.
+    first_year: int; the first year to list the transitions of.
+    last_year: int; the last year to list the transitions of.
+
+  Returns:
+    A list of (UTC seconds since the epoch, UTC offset in seconds after the
+    transition, whether DST is in effect after it) tuples in order, or None
+    if tz has no DST rule or cannot be parsed.
+  """
+  match = _POSIX_TZ_RE.match(tz)
+  if not match or match.group('start') is None:
+    return None
+  std = -_PosixTimeToSeconds(match.group('std'))
+  if match.group('dst'):
+    dst = -_PosixTimeToSeconds(match.group('dst'))
+  else:
+    dst = std + 3600
+  start_time = _PosixTimeToSeconds(match.group('start_time') or '2')
+  end_time = _PosixTimeToSeconds(match.group('end_time') or '2')
+  transitions = []
+  try:
+    for year in range(first_year, last_year + 1):
+      # The times are on the wall clock before each transition.
+      start = (_PosixRuleDay(match.group('start'), year) -
+               _EPOCH_ORDINAL) * 86400 + start_time - std
+      end = (_PosixRuleDay(match.group('end'), year) -
+             _EPOCH_ORDINAL) * 86400 + end_time - dst
+      transitions.append((start, dst, True))
+      transitions.append((end, std, False))
+  except ValueError:
+    return None
+  transitions.sort()
+  return transitions
+
+
+def _ParseTzif(data):
+  """Parse the DST transitions out of a TZif file (see RFC 8536).
+
+  The DST rule at the end of version 2 files, which "slim" files rely on for
+  all times after their last transition, is expanded into transitions up to
+  _TZIF_RULE_END_YEAR.
+
+  Args:
+    data: bytes; the contents of the file.
+
+  Returns:
+    A tuple of (list of the transition times, in seconds since the epoch on
+    the local wall clock, for wall times with fold=0; the same for fold=1;
+    list of whether DST is in effect before the first transition and after
+    each one; whether the last of those holds for all later times, as opposed
+    to following rules that are not in the table).  Like mktime(), the wall
+    times that happen twice belong before their transition when fold=0, and
+    the ones that are skipped after it.
+
+  Raises:
+    ValueError: if data is not a TZif file.
+    struct.error: if the file is truncated.
+  """
+  if data[:4] != b'TZif':
+    raise ValueError('Not a TZif file')
+  version = data[4:5]
+  header = struct.Struct('>6l')
+  (isutcnt, isstdcnt, leapcnt, timecnt, typecnt,
+   charcnt) = header.unpack_from(data, 20)
+  offset = 44
+  time_format = 'l'
+  if version >= b'2':
+    # Skip the version 1 data for the 64-bit data that follows it.
+    offset += (timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 + isstdcnt +
+               isutcnt)
+    (isutcnt, isstdcnt, leapcnt, timecnt, typecnt,
+     charcnt) = header.unpack_from(data, offset + 20)
+    offset += 44
+    time_format = 'q'
+  time_size = struct.calcsize('>' + time_format)
+  times = struct.unpack_from('>%d%s' % (timecnt, time_format), data, offset)
+  offset += timecnt * time_size
+  indices = struct.unpack_from('>%dB' % timecnt, data, offset)
+  offset += timecnt
+  local_types = [struct.unpack_from('>lB', data, offset + 6 * i)
+                 for i in range(typecnt)]
+  offset += (typecnt * 6 + charcnt + leapcnt * (time_size + 4) + isstdcnt +
+             isutcnt)
+  # Version 2 files end with a POSIX TZ string for the times after the last
+  # transition; without a DST rule in it, the last local time type holds.
+  footer = data[offset:].strip() if version >= b'2' else b''
+  fixed = bool(footer) and b',' not in footer
+  rule = None
+  if footer and not fixed:
+    first_year = 1970
+    if times:
+      first_year = (_EPOCH + datetime.timedelta(seconds=times[-1])).year
+    rule = _ExpandPosixTz(footer.decode('ascii', 'replace'), first_year,
+                          _TZIF_RULE_END_YEAR)
+
+  utoff, dst = local_types[0]
+  changes = [(when, local_types[index][0], bool(local_types[index][1]))
+             for when, index in zip(times, indices)]
+  changes.extend(change for change in rule or ()
+                 if not times or change[0] > times[-1])
+  walls = []
+  fold_walls = []
+  isdst = [bool(dst)]
+  for when, new_utoff, dst in changes:
+    previous, utoff = utoff, new_utoff
+    # A skipped wall time is after the transition, at which the clock jumps
+    # forward from when + previous.  One that happens twice is before the
+    # transition the first time, up to when + previous, and after it the
+    # second time, from when + utoff.
+    fold_walls.append(when + min(previous, utoff))
+    walls.append(when + previous if utoff < previous else fold_walls[-1])
+    isdst.append(dst)
+  return walls, fold_walls, isdst, fixed
+
+
+def _ReadLocalTransitions():
+  """Read the DST transitions of the local timezone; see _ParseTzif.
+
+  Returns:
+    The output of _ParseTzif, or an empty table if there is no TZif file for
+    the local timezone or it cannot be read.
+  """
+  path = _LocalTzfilePath()
+  if path is not None:
+    try:
+      with open(path, 'rb') as tzfile:
+        return _ParseTzif(tzfile.read())
+    except (IOError, ValueError, struct.error):
+      pass
+  return [], [], [False], False
 
 
 class LocalTimezoneClass(datetime.tzinfo):
@@ -195,6 +533,10 @@ class LocalTimezoneClass(datetime.tzinfo):
 
   DSTDIFF = DSTOFFSET - STDOFFSET
 
+  # The output of _ReadLocalTransitions, read the first time it is needed.
+  # Set it back to None after changing the local timezone with time.tzset().
+  _transitions = None
+
   def utcoffset(self, dt):
     """datetime -> minutes east of UTC (negative for west of UTC)."""
     if self._isdst(dt):
@@ -214,7 +556,31 @@ class LocalTimezoneClass(datetime.tzinfo):
     return time.tzname[self._isdst(dt)]
 
   def _isdst(self, dt):
-    """Return true if given datetime is within local DST."""
+    """Return true if given datetime is within local DST.
+
+    This looks the datetime up in the transitions of the local timezone's
+    TZif file, and only asks the C library about times outside of the table.
+
+    Args:
+      dt: datetime; a time on the local wall clock.  Its fold picks which of
+        the two times a wall time happening twice is.
+
+    Returns:
+      bool.
+    """
+    transitions = LocalTimezoneClass._transitions
+    if transitions is None:
+      transitions = LocalTimezoneClass._transitions = _ReadLocalTransitions()
+    walls, fold_walls, isdst, fixed = transitions
+    wall = ((dt.toordinal() - _EPOCH_ORDINAL) * 86400 + dt.hour * 3600 +
+            dt.minute * 60 + dt.second)
+    index = bisect.bisect_right(fold_walls if dt.fold else walls, wall)
+    if index == len(walls) and not fixed:
+      return self._mktime_isdst(dt)
+    return isdst[index]
+
+  def _mktime_isdst(self, dt):
+    """Return true if given datetime is within local DST, using mktime."""
     tt = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
           dt.weekday(), 0, -1)
     stamp = time.mktime(tt)
@@ -241,6 +607,140 @@ class LocalTimezoneClass(datetime.tzinfo):
 LocalTimezone = LocalTimezoneClass()
 
 
+class CoarseClock(object):
+  """A clock that reads the system time only once per tick.
+
+  Reading the time from a CoarseClock is a single attribute access, at the
+  price of precision: the time only advances when the clock is updated, which
+  is every resolution seconds once Start() runs a background thread to do so,
+  or on every tick of an event loop, with ScheduleOn() or by calling Update()
+  from the loop.  That is good enough for stamping log records, where
+  sub-millisecond precision is wasted.
+
+  Use SetCoarseClock() to make Timestamp.now(), utcnow() and today() read the
+  time from a clock.
+
+  Attributes:
+    resolution: float; seconds between updates by Start() or ScheduleOn().
+    reading: tuple of (time, micros) at the last update.  Both are replaced
+      in a single assignment, so unpacking reading gives values from the same
+      update even while another thread updates the clock.
+    time: float; seconds since the epoch at the last update.
+    micros: int; microseconds since the epoch at the last update.
+  """
+
+  def __init__(self, resolution=0.001, timer=time.time):
+    """Initialize a CoarseClock and read the time once.
+
+    Args:
+      resolution: float; seconds between updates.
+      timer: function returning the current time in seconds since the epoch.
+    """
+    self.resolution = resolution
+    self._timer = timer
+    self._stopped = threading.Event()
+    self._stopped.set()
+    self._thread = None
+    # (cls, utc) -> (micros, timestamp) for the last timestamp built.
+    self._timestamps = {}
+    self.Update()
+
+  def Update(self):
+    """Read the system time; call this on every tick of an event loop."""
+    now = self._timer()
+    self.reading = (now, int(now * _MICROSECONDS_PER_SECOND))
+
+  @property
+  def time(self):
+    return self.reading[0]
+
+  @property
+  def micros(self):
+    return self.reading[1]
+
+  def Start(self):
+    """Update the clock from a daemon thread until Stop() is called."""
+    if not self._stopped.is_set():
+      return
+    self._stopped.clear()
+    self._thread = threading.Thread(target=self._Run, name='CoarseClock')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Run(self):
+    while not self._stopped.wait(self.resolution):
+      self.Update()
+
+  def ScheduleOn(self, loop):
+    """Update the clock from an event loop until Stop() is called.
+
+    Args:
+      loop: an asyncio event loop, or anything else with the same call_later.
+    """
+    self._stopped.clear()
+
+    def Tick():
+      if not self._stopped.is_set():
+        self.Update()
+        loop.call_later(self.resolution, Tick)
+
+    Tick()
+
+  def Stop(self):
+    """Stop updating the clock."""
+    self._stopped.set()
+    thread, self._thread = self._thread, None
+    if thread is not None and thread is not threading.current_thread():
+      thread.join()
+
+  def __enter__(self):
+    self.Start()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Stop()
+
+  def Now(self, cls, utc=False):
+    """Get the time of the last update as a timestamp.
+
+    The timestamp is built once per update and class, and shared by all
+    callers until the next update.
+
+    Args:
+      cls: BaseTimestamp subclass to return.
+      utc: whether to return the time in UTC rather than in local time.
+    Returns:
+      A cls like cls.utcnow() if utc is true, like cls.now() otherwise.
+    """
+    micros = self.reading[1]
+    key = (cls, utc)
+    cached = self._timestamps.get(key)
+    if cached is not None and cached[0] == micros:
+      return cached[1]
+    if utc:
+      result = cls.FromMicroTimestamp(micros)
+    else:
+      result = cls.fromtimestamp(micros / _MICROSECONDS_PER_SECOND_F)
+    self._timestamps[key] = (micros, result)
+    return result
+
+
+def SetCoarseClock(clock):
+  """Read the current time from a CoarseClock instead of the system.
+
+  Args:
+    clock: CoarseClock to read the time from, or None to read the system time
+      again.  The clock is not started; that is up to the caller.
+  """
+  global _coarse_clock
+  _coarse_clock = clock
+
+
+def GetCoarseClock():
+  """Get the CoarseClock set with SetCoarseClock(), or None."""
+  return _coarse_clock
+
+
 class BaseTimestamp(datetime.datetime):
   """Our kind of wrapper over datetime.datetime.
 
@@ -266,18 +766,35 @@ class BaseTimestamp(datetime.datetime):
       return cls.LocalTimezone.localize(obj)
     return obj
 
+  @classmethod
+  def _Wrap(cls, r):
+    """Make a new cls with the fields and tzinfo of datetime r.
+
+    Building a datetime subclass instance costs several times as much as
+    building a plain datetime, so the methods below work on plain datetimes
+    and call this once at the end.
+
+    Args:
+      r: datetime.
+    Returns:
+      New cls().
+    """
+    return cls(r.year, r.month, r.day, r.hour, r.minute, r.second,
+               r.microsecond, r.tzinfo, fold=r.fold)
+
   def __add__(self, *args, **kwargs):
     """x.__add__(y) <==> x+y."""
     r = super(BaseTimestamp, self).__add__(*args, **kwargs)
-    return type(self)(r.year, r.month, r.day, r.hour, r.minute, r.second,
-                      r.microsecond, r.tzinfo)
+    # Since Python 3.8 datetime arithmetic already returns the subclass.
+    if r is NotImplemented or type(r) is type(self):
+      return r
+    return self._Wrap(r)
 
   def __sub__(self, *args, **kwargs):
     """x.__add__(y) <==> x-y."""
     r = super(BaseTimestamp, self).__sub__(*args, **kwargs)
-    if isinstance(r, datetime.datetime):
-      return type(self)(r.year, r.month, r.day, r.hour, r.minute, r.second,
-                        r.microsecond, r.tzinfo)
+    if isinstance(r, datetime.datetime) and type(r) is not type(self):
+      return self._Wrap(r)
     return r
 
   @classmethod
@@ -292,8 +809,12 @@ class BaseTimestamp(datetime.datetime):
     Returns:
       A new BaseTimestamp with tz's local day and time.
     """
-    return cls.AddLocalTimezone(
-        super(BaseTimestamp, cls).now(*args, **kwargs))
+    if _coarse_clock is not None and not args and not kwargs:
+      return _coarse_clock.Now(cls)
+    r = datetime.datetime.now(*args, **kwargs)
+    # Same as AddLocalTimezone, without the replace() call.
+    return cls(r.year, r.month, r.day, r.hour, r.minute, r.second,
+               r.microsecond, r.tzinfo or cls.LocalTimezone, fold=r.fold)
 
   @classmethod
   def today(cls):
@@ -303,7 +824,7 @@ class BaseTimestamp(datetime.datetime):
     Returns:
       New self.__class__.
     """
-    return cls.AddLocalTimezone(super(BaseTimestamp, cls).today())
+    return cls.now()
 
   @classmethod
   def fromtimestamp(cls, *args, **kwargs):
@@ -317,19 +838,24 @@ class BaseTimestamp(datetime.datetime):
     Returns:
       A new BaseTimestamp with tz's local day and time.
     """
-    return cls.Localize(
-        super(BaseTimestamp, cls).fromtimestamp(*args, **kwargs))
+    return cls._Wrap(cls.Localize(
+        datetime.datetime.fromtimestamp(*args, **kwargs)))
 
   @classmethod
   def utcnow(cls):
     """Return a new BaseTimestamp representing UTC day and time."""
-    return super(BaseTimestamp, cls).utcnow().replace(tzinfo=pytz.utc)
+    if _coarse_clock is not None:
+      return _coarse_clock.Now(cls, utc=True)
+    r = datetime.datetime.now(datetime.timezone.utc)
+    return cls(r.year, r.month, r.day, r.hour, r.minute, r.second,
+               r.microsecond, pytz.utc)
 
   @classmethod
-  def utcfromtimestamp(cls, *args, **kwargs):
+  def utcfromtimestamp(cls, timestamp):
     """timestamp -> UTC datetime from a POSIX timestamp (like time.time())."""
-    return super(BaseTimestamp, cls).utcfromtimestamp(
-        *args, **kwargs).replace(tzinfo=pytz.utc)
+    r = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return cls(r.year, r.month, r.day, r.hour, r.minute, r.second,
+               r.microsecond, pytz.utc)
 
   @classmethod
   def strptime(cls, date_string, format, tz=None):
@@ -348,8 +874,9 @@ class BaseTimestamp(datetime.datetime):
   def astimezone(self, *args, **kwargs):
     """tz -> convert to time in new timezone tz."""
     r = super(BaseTimestamp, self).astimezone(*args, **kwargs)
-    return type(self)(r.year, r.month, r.day, r.hour, r.minute, r.second,
-                      r.microsecond, r.tzinfo)
+    if type(r) is type(self):
+      return r
+    return self._Wrap(r)
 
   @classmethod
   def FromMicroTimestamp(cls, ts):
@@ -364,12 +891,19 @@ class BaseTimestamp(datetime.datetime):
 
   def AsSecondsSinceEpoch(self):
     """Return number of seconds since epoch (timestamp in seconds)."""
-    return GetSecondsSinceEpoch(self.utctimetuple())
+    return self.AsMicroTimestamp() // _MICROSECONDS_PER_SECOND
 
   def AsMicroTimestamp(self):
     """Return microsecond timestamp constructed from this object."""
-    return (SecondsToMicroseconds(self.AsSecondsSinceEpoch()) +
-            self.microsecond)
+    # Plain integer arithmetic on the fields; going through utctimetuple()
+    # would build an intermediate timestamp and a time tuple.
+    micros = (((self.toordinal() - _EPOCH_ORDINAL) * 86400 +
+               self.hour * 3600 + self.minute * 60 + self.second) *
+              _MICROSECONDS_PER_SECOND + self.microsecond)
+    offset = self.utcoffset()
+    if offset:
+      micros -= _TimedeltaToMicros(offset)
+    return micros
 
   @classmethod
   def combine(cls, datepart, timepart, tz=None):
@@ -400,6 +934,13 @@ _INTERVAL_CONV_DICT['W'] = _INTERVAL_CONV_DICT['w']
 _INTERVAL_CONV_DICT['M'] = 30 * _INTERVAL_CONV_DICT['d']
 _INTERVAL_CONV_DICT['Y'] = 365 * _INTERVAL_CONV_DICT['d']
 _INTERVAL_REGEXP = re.compile('^([0-9]+)([%s])?' % ''.join(_INTERVAL_CONV_DICT))
+# One basic interval, with an optional fraction, and the whitespace around it.
+# A sign must start the string or follow whitespace, so that dates such as
+# "2013-02-30" are not taken for intervals, and a number without a suffix must
+# not be followed by another one.
+_INTERVAL_COMPONENT_REGEXP = re.compile(
+    r'\s*((?<!\S)[+-])?([0-9]+(?:\.[0-9]+)?|\.[0-9]+)([%s]|(?![.0-9]))\s*'
+    % ''.join(_INTERVAL_CONV_DICT))
 
 
 def ConvertIntervalToSeconds(interval):
@@ -407,34 +948,259 @@ def ConvertIntervalToSeconds(interval):
 
   Args:
     interval: String to interpret as an interval.  A basic interval looks like
-      "<number><suffix>".  Complex intervals consisting of a chain of basic
-      intervals are also allowed.
+      "<number><suffix>", where the number may have a sign and a fraction, as
+      in "-1.5h".  Complex intervals consisting of a chain of basic intervals,
+      optionally separated by whitespace, are also allowed, e.g. "1h 30m".
 
   Returns:
-    An integer representing the number of seconds represented by the interval
-    string, or None if the interval string could not be decoded.
+    The number of seconds represented by the interval string: an integer,
+    unless some number in it had a fraction, in which case a float.  None if
+    the interval string could not be decoded.
   """
+  if not interval:
+    return 0
+  return _ParseInterval(interval)
+
+
+@functools.lru_cache(maxsize=1024)
+def _ParseInterval(interval):
+  """Parse a non-empty interval string; see ConvertIntervalToSeconds."""
   total = 0
-  while interval:
-    match = _INTERVAL_REGEXP.match(interval)
+  position = 0
+  end = len(interval)
+  match_component = _INTERVAL_COMPONENT_REGEXP.match
+  while position < end:
+    match = match_component(interval, position)
     if not match:
       return None
+    sign, number, suffix = match.groups()
+    num = float(number) if '.' in number else int(number)
+    if suffix:
+      num *= _INTERVAL_CONV_DICT[suffix]
+    total += -num if sign == '-' else num
+    position = match.end()
+  return total
+
+
+# Regular expressions for the strptime directives understood by
+# _CompileFormat, with a group for each field.
+_FORMAT_DIRECTIVES = {
+    'Y': r'(?P<year>\d{4})',
+    'm': r'(?P<month>\d\d)',
+    'b': r'(?P<month_name>[A-Za-z]{3})',
+    'd': r'(?P<day>\d\d)',
+    'H': r'(?P<hour>\d\d)',
+    'M': r'(?P<minute>\d\d)',
+    'S': r'(?P<second>\d\d)',
+    'f': r'(?P<fraction>\d{1,6})',
+    'z': (r'(?:(?P<utc>Z)|(?P<sign>[+-])(?P<offset_hours>\d\d)'
+          r':?(?P<offset_minutes>\d\d))'),
+    '%': '%',
+}
+
+_MONTH_NAMES = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep',
+                'oct', 'nov', 'dec')
+
+# Strict ISO 8601 (and so RFC 3339) dates and times, in the extended and basic
+# formats, which Timestamp parses without going through dateutil.
+_ISO8601_REGEXPS = (
+    re.compile(r'%(Y)s-%(m)s-%(d)s'
+               r'(?:[T ]%(H)s:%(M)s(?::%(S)s(?:\.%(f)s)?)?%(z)s?)?\Z'
+               % _FORMAT_DIRECTIVES, re.ASCII),
+    re.compile(r'%(Y)s%(m)s%(d)sT%(H)s%(M)s%(S)s(?:\.%(f)s)?%(z)s?\Z'
+               % _FORMAT_DIRECTIVES, re.ASCII))
+
+
+def _ParseIso8601(timestring):
+  """Parse a strict ISO 8601 date and time the way dateutil.parser would.
 
+  Args:
+    timestring: string with datetime.
+
+  Returns:
+    A datetime, with a dateutil tzinfo if the string had a UTC offset, or None
+    if timestring is not in one of the formats handled here or is not a valid
+    date.
+  """
+  if not isinstance(timestring, str):
+    return None
+  for regexp in _ISO8601_REGEXPS:
+    match = regexp.match(timestring)
+    if match:
+      return _DatetimeFromMatch(match)
+  return None
+
+
+def _CompileFormat(fmt):
+  """Compile a strptime-style format into a parser like _ParseIso8601.
+
+  Args:
+    fmt: string; a format made of the directives %Y, %m, %b, %d, %H, %M, %S,
+      %f (one to six digits), %z (Z or an offset with or without a colon) and
+      literal text.
+
+  Returns:
+    A function from a string to a datetime, or None if the string does not
+    match the format or is not a valid date.  Unlike _ParseIso8601, it need
+    not agree with dateutil.parser, so a zero UTC offset always gives UTC.
+
+  Raises:
+    ValueError: if the format has unsupported directives.
+  """
+  parts = re.split('%(.)', fmt)
+  pattern = []
+  for i, part in enumerate(parts):
+    if i % 2 == 0:
+      pattern.append(re.escape(part))
+    elif part in _FORMAT_DIRECTIVES:
+      pattern.append(_FORMAT_DIRECTIVES[part])
+    else:
+      raise ValueError('Unsupported directive %%%s in %r' % (part, fmt))
+  regexp = re.compile(''.join(pattern) + r'\Z', re.ASCII)
+
+  def Parse(timestring):
+    match = regexp.match(timestring)
+    return _DatetimeFromMatch(match, like_dateutil=False) if match else None
+  return Parse
+
+
+def _DatetimeFromMatch(match, like_dateutil=True):
+  """Build a datetime from a match of _ISO8601_REGEXPS or _CompileFormat.
+
+  Args:
+    match: re.Match; with groups named like in _FORMAT_DIRECTIVES.
+    like_dateutil: bool; if True, give up where dateutil.parser would not give
+      the same result.
+
+  Returns:
+    A datetime, with a dateutil tzinfo if the string had a UTC offset, or None
+    if the fields do not make a valid date, or like_dateutil is set and
+    dateutil.parser would not give the same result.
+  """
+  fields = match.groupdict()
+  year, month, day, hour, minute, second, fraction = (
+      fields.get(name) for name in (
+          'year', 'month', 'day', 'hour', 'minute', 'second', 'fraction'))
+  month_name = fields.get('month_name')
+  if month_name:
     try:
-      num = int(match.group(1))
+      month = _MONTH_NAMES.index(month_name.lower()) + 1
     except ValueError:
       return None
+  utc, sign, offset_hours, offset_minutes = (
+      fields.get(name) for name in (
+          'utc', 'sign', 'offset_hours', 'offset_minutes'))
+  offset = None
+  if utc:
+    offset = 0
+  elif sign:
+    offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+    if sign == '-':
+      offset = -offset
+  if offset is None:
+    tzinfo = None
+  elif offset:
+    tzinfo = dateutil.tz.tzoffset(None, offset)
+  elif like_dateutil and 'UTC' in time.tzname:
+    # dateutil then makes it local time, named after the local zone.
+    return None
+  else:
+    tzinfo = dateutil.tz.tzutc()
+  try:
+    return datetime.datetime(
+        int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+        int(second or 0), int(fraction.ljust(6, '0')) if fraction else 0,
+        tzinfo)
+  except ValueError:
+    return None
 
-    suffix = match.group(2)
-    if suffix:
-      multiplier = _INTERVAL_CONV_DICT.get(suffix)
-      if not multiplier:
-        return None
-      num *= multiplier
 
-    total += num
-    interval = interval[match.end(0):]
-  return total
+def _ParseDatetime(timestring):
+  """Parse a string with _ParseIso8601, or else dateutil.parser.
+
+  Args:
+    timestring: string with datetime.
+
+  Returns:
+    A datetime, or None if unable to parse the timestring.
+  """
+  r = _ParseIso8601(timestring)
+  if r is None:
+    try:
+      r = dateutil.parser.parse(timestring)
+      # dateutil will raise ValueError if it's an unknown format -- or
+      # TypeError in some cases, due to bugs.
+    except (TypeError, ValueError):
+      return None
+  return r
+
+
+class ParseCacheInfo(
+    collections.namedtuple('ParseCacheInfo', 'hits misses maxsize currsize')):
+  """Statistics of the cache of parsed timestamp strings."""
+  __slots__ = ()
+
+  @property
+  def hit_rate(self):
+    """The fraction of lookups answered from the cache."""
+    lookups = self.hits + self.misses
+    return self.hits / float(lookups) if lookups else 0.0
+
+
+# The cache of Timestamp._StringToTime results; see SetParseCacheSize.
+_parse_cache = None
+
+
+_MONTH_PATTERN = r'(?:%s)[a-z]*\.?' % '|'.join(_MONTH_NAMES)
+
+# Strings with a year, month and day, numeric or with a month name.
+# dateutil.parser takes the fields a string leaves out, as in "13:00" or
+# "Friday", from the current date, so only these strings are cached.
+_FULL_DATE_REGEXP = re.compile(
+    r'\b\d{4}([-/.])\d{1,2}\1\d{1,2}(?!\d)'
+    r'|\b\d{1,2}([-/.])\d{1,2}\2\d{4}(?!\d)'
+    r'|\b\d{8}T'
+    r'|\b\d{1,2}[-/ ]*%(month)s[-/ ,]*\d{4}(?!\d)'
+    r'|\b%(month)s[-/ ]*\d{1,2}(?:st|nd|rd|th)?,?[-/ ]*\d{4}(?!\d)'
+    % {'month': _MONTH_PATTERN}, re.ASCII | re.IGNORECASE)
+
+
+def _ParseCacheMiss(cls, timestring, tz):
+  """Parse a string that is not in the parse cache."""
+  return cls._ParseStringToTime(timestring, tz)
+
+
+def SetParseCacheSize(maxsize):
+  """Enable or disable the cache of parsed timestamp strings.
+
+  With the cache enabled, Timestamp.FromString() remembers the results for the
+  maxsize most recently used (string, tz) pairs, which saves parsing the same
+  strings over and over, as logs tend to repeat them.  Only strings with a
+  full date are cached: intervals like "1d", and strings that leave out part
+  of the date, like "13:00", are relative to the current time, so they are
+  parsed on every call and not counted as hits or misses.  Changing the size
+  empties the cache.
+
+  Args:
+    maxsize: int; the number of results to keep, or 0 to disable the cache.
+  """
+  global _parse_cache
+  if maxsize:
+    _parse_cache = functools.lru_cache(maxsize)(_ParseCacheMiss)
+  else:
+    _parse_cache = None
+
+
+def GetParseCacheInfo():
+  """Get statistics of the cache of parsed timestamp strings.
+
+  Returns:
+    A ParseCacheInfo, or None if the cache is disabled.
+  """
+  cache = _parse_cache
+  if cache is None:
+    return None
+  return ParseCacheInfo(*cache.cache_info())
 
 
 class Timestamp(BaseTimestamp):
@@ -448,9 +1214,32 @@ class Timestamp(BaseTimestamp):
 
   @classmethod
   def _StringToTime(cls, timestring, tz=None):
+    """Convert string into timestamp, using the parse cache if it is enabled.
+
+    Args:
+      timestring: string with datetime
+      tz: optional timezone, if timezone is omitted from timestring.
+
+    Returns:
+      New Timestamp or None if unable to parse the timestring.
+    """
+    cache = _parse_cache
+    if (cache is not None and isinstance(timestring, str) and
+        _FULL_DATE_REGEXP.search(timestring)):
+      try:
+        return cache(cls, timestring, tz)
+      except TypeError:
+        # Unhashable arguments cannot be cached.
+        pass
+    return cls._ParseStringToTime(timestring, tz)
+
+  @classmethod
+  def _ParseStringToTime(cls, timestring, tz=None):
     """Use dateutil.parser to convert string into timestamp.
 
-    dateutil.parser understands ISO8601 which is really handy.
+    dateutil.parser understands ISO8601 which is really handy.  It is also
+    slow, so strict ISO 8601 strings, which are most of the input, are parsed
+    directly, to the same result; dateutil is only used for everything else.
 
     Args:
       timestring: string with datetime
@@ -459,18 +1248,25 @@ class Timestamp(BaseTimestamp):
     Returns:
       New Timestamp or None if unable to parse the timestring.
     """
-    try:
-      r = dateutil.parser.parse(timestring)
-      # dateutil will raise ValueError if it's an unknown format -- or
-      # TypeError in some cases, due to bugs.
-    except (TypeError, ValueError):
+    r = _ParseDatetime(timestring)
+    if r is None:
       return None
+    return cls._FromDatetime(r, tz)
+
+  @classmethod
+  def _FromDatetime(cls, r, tz=None):
+    """Make a Timestamp of a parsed datetime.
+
+    Args:
+      r: datetime.
+      tz: optional timezone, if r is naive.
+
+    Returns:
+      New Timestamp.
+    """
     if not r.tzinfo:
       r = (tz or cls.LocalTimezone).localize(r)
-    result = cls(r.year, r.month, r.day, r.hour, r.minute, r.second,
-                 r.microsecond, r.tzinfo)
-
-    return result
+    return cls._Wrap(r)
 
   @classmethod
   def _IntStringToInterval(cls, timestring):
@@ -501,17 +1297,569 @@ class Timestamp(BaseTimestamp):
     Raises:
       TimeParseError if unable to parse value.
     """
+    # dateutil reads intervals such as "30m" or "1h 30m" as times of day, so
+    # strings ending in an interval suffix are tried as intervals first.  Bare
+    # numbers, such as "2013", are still dates.
+    interval = (isinstance(value, str) and
+                value.rstrip()[-1:] in _INTERVAL_CONV_DICT)
+    if interval:
+      result = cls._IntStringToInterval(value)
+      if result:
+        return cls.utcnow() - result
+
     result = cls._StringToTime(value, tz=tz)
     if result:
       return result
 
-    result = cls._IntStringToInterval(value)
-    if result:
-      return cls.utcnow() - result
+    if not interval:
+      result = cls._IntStringToInterval(value)
+      if result:
+        return cls.utcnow() - result
 
     raise TimeParseError(value)
 
 
+# Formats besides ISO 8601 that ParseTimestamps looks for by default.
+_STREAM_FORMATS = (
+    '%Y/%m/%d %H:%M:%S',
+    '%Y/%m/%d %H:%M:%S.%f',
+    '%m/%d/%Y %H:%M:%S',
+    '%d/%b/%Y:%H:%M:%S %z',  # Apache and NCSA logs.
+    '%b %d %Y %H:%M:%S',
+)
+
+
+def _MakeExtractor(extract):
+  """Turn the extract argument of ParseTimestamps into a function."""
+  if extract is None:
+    return lambda line: line.strip()
+  if isinstance(extract, int):
+    def ExtractField(line):
+      fields = line.split()
+      return fields[extract] if -len(fields) <= extract < len(fields) else None
+    return ExtractField
+  if isinstance(extract, str):
+    extract = re.compile(extract)
+  if hasattr(extract, 'search'):
+    def ExtractMatch(line):
+      match = extract.search(line)
+      if not match:
+        return None
+      return match.group(1) if extract.groups else match.group(0)
+    return ExtractMatch
+  return extract
+
+
+def ParseTimestamps(lines, tz=None, extract=None, micros=False, formats=None,
+                    sample_size=100, errors='raise'):
+  """Lazily parse a column of timestamp strings, e.g. from a log file.
+
+  The first sample_size strings are used to work out which format most of them
+  are in, among strict ISO 8601 and formats.  The strings are then parsed with
+  a regular expression compiled for that format, or, if one does not match it,
+  like Timestamp.FromString does, but never as an interval, so that a field
+  like "1d" is not taken for a time before now.  Only the sample is kept in
+  memory, so any number of lines can be parsed.
+
+  Args:
+    lines: iterable of strings, e.g. an open file.
+    tz: optional timezone, for the strings that do not have one.
+    extract: how to find the timestamp in a line.  None to use the whole line,
+      stripped; an int to use that whitespace-separated field; a regular
+      expression, as a string or compiled, to use its first group, or the whole
+      match if it has none; or a function from a line to a string, or to None
+      if the line has no timestamp.
+    micros: bool; if True, produce microseconds since the epoch, in UTC,
+      instead of Timestamps.
+    formats: sequence of strptime-style formats to consider; see
+      _CompileFormat for the directives supported.  Defaults to some common
+      ones.
+    sample_size: int; the number of lines used to pick the format.
+    errors: str; what to do with a timestamp that cannot be parsed: 'raise'
+      a TimeParseError, which ends the iteration, or 'none' to yield None for
+      its line and go on.
+
+  Yields:
+    A Timestamp, or an int if micros is set, for every line, or None for the
+    lines with no timestamp.
+
+  Raises:
+    TimeParseError: if a timestamp cannot be parsed and errors is 'raise'.
+    ValueError: if formats has unsupported directives, or errors is not known.
+  """
+  if errors not in ('raise', 'none'):
+    raise ValueError('Unknown errors value %r' % (errors,))
+  extract = _MakeExtractor(extract)
+  parsers = [_ParseIso8601] + [
+      _CompileFormat(fmt) for fmt in (_STREAM_FORMATS if formats is None
+                                      else formats)]
+  lines = iter(lines)
+  sample = list(itertools.islice(lines, sample_size))
+  strings = [string for string in map(extract, sample) if string]
+  parse = max(parsers, key=lambda parser: sum(
+      1 for string in strings if parser(string) is not None))
+
+  for line in itertools.chain(sample, lines):
+    string = extract(line)
+    if not string:
+      yield None
+      continue
+    r = parse(string)
+    if r is None:
+      # pylint: disable=protected-access
+      r = Timestamp._StringToTime(string, tz)
+      if r is None:
+        if errors == 'raise':
+          raise TimeParseError(string)
+        yield None
+        continue
+    elif not micros:
+      # pylint: disable=protected-access
+      r = Timestamp._FromDatetime(r, tz)
+    elif not r.tzinfo:
+      # Plain datetimes are cheaper to convert than Timestamps.
+      r = (tz or LocalTimezone).localize(r)
+    yield _DatetimeToUTCMicrosFast(r) if micros else r
+
+
+_MICROSECONDS_PER_DAY = 86400 * _MICROSECONDS_PER_SECOND
+
+# Sizes of the calendar units of fixed length, in microseconds.
+_UNIT_MICROS = {
+    'second': _MICROSECONDS_PER_SECOND,
+    'minute': 60 * _MICROSECONDS_PER_SECOND,
+    'hour': 3600 * _MICROSECONDS_PER_SECOND,
+    'day': _MICROSECONDS_PER_DAY,
+}
+
+TRUNCATION_UNITS = ('second', 'minute', 'hour', 'day', 'week', 'month', 'year')
+
+
+@functools.lru_cache(maxsize=64)
+def _UTCOffsetTable(tz):
+  """Get the UTC offsets of a timezone as a table.
+
+  Args:
+    tz: tzinfo.
+
+  Returns:
+    A tuple of (list of the times at which the offset changes, list of the
+    offsets before the first change and after each one), all in microseconds,
+    or None if there is no table for tz.
+  """
+  transition_times = getattr(tz, '_utc_transition_times', None)
+  if transition_times is not None:
+    # A pytz timezone with DST.  The first transition is at datetime.min.
+    # pylint: disable=protected-access
+    return ([DatetimeToUTCMicros(when) for when in transition_times[1:]],
+            [_TimedeltaToMicros(info[0]) for info in tz._transition_info])
+  try:
+    offset = tz.utcoffset(None)
+  except (AttributeError, TypeError):
+    offset = None
+  if offset is None:
+    return None
+  return [], [_TimedeltaToMicros(offset)]
+
+
+def _GetUTCOffsetTable(tz):
+  """Same as _UTCOffsetTable, but also works on unhashable timezones."""
+  try:
+    return _UTCOffsetTable(tz)
+  except TypeError:
+    return _UTCOffsetTable.__wrapped__(tz)
+
+
+def _MakeOffsetFunction(tz, table):
+  """Get a function from UTC micros to the UTC offset of tz then, in micros.
+
+  Args:
+    tz: tzinfo.
+    table: the output of _GetUTCOffsetTable(tz).
+
+  Returns:
+    A function from an int to an int.
+  """
+  if table is None:
+    def Offset(micros):
+      dt = (_EPOCH + datetime.timedelta(microseconds=micros)).replace(tzinfo=tz)
+      return _TimedeltaToMicros(tz.fromutc(dt).utcoffset())
+    return Offset
+  transitions, offsets = table
+  if not transitions:
+    return lambda micros: offsets[0]
+  return lambda micros: offsets[bisect.bisect_right(transitions, micros)]
+
+
+def _DaysToCivil(days):
+  """Convert days since the epoch to a (year, month) pair.
+
+  This is integer arithmetic only, so it works on NumPy arrays too.
+
+  Args:
+    days: int.
+
+  Returns:
+    A (year, month) tuple.
+  """
+  # See http://howardhinnant.github.io/date_algorithms.html#civil_from_days
+  days += 719468
+  era = days // 146097
+  day_of_era = days - era * 146097
+  year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 -
+                 day_of_era // 146096) // 365
+  day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 -
+                              year_of_era // 100)
+  shifted_month = (5 * day_of_year + 2) // 153  # 0 is March.
+  wraps = shifted_month // 10
+  return (year_of_era + era * 400 + wraps,
+          shifted_month + 3 - 12 * wraps)
+
+
+def _CivilToDays(year, month):
+  """Convert a year and month to the days since the epoch of its first day.
+
+  Like _DaysToCivil, this works on NumPy arrays too.
+
+  Args:
+    year: int.
+    month: int; 1 to 12.
+
+  Returns:
+    int.
+  """
+  # See http://howardhinnant.github.io/date_algorithms.html#days_from_civil
+  year -= (14 - month) // 12  # Years start in March.
+  era = year // 400
+  year_of_era = year - era * 400
+  day_of_year = (153 * ((month + 9) % 12) + 2) // 5
+  day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100 +
+                day_of_year)
+  return era * 146097 + day_of_era - 719468
+
+
+def _TruncateWall(wall, unit, step):
+  """Truncate wall clock times, in micros since the epoch, to calendar units.
+
+  Like _DaysToCivil, this works on NumPy arrays too.
+  """
+  size = _UNIT_MICROS.get(unit)
+  if size is not None:
+    size *= step
+    return wall - wall % size
+  if unit == 'week':
+    # Weeks start on Monday, and the epoch was on a Thursday.
+    size = 7 * step * _MICROSECONDS_PER_DAY
+    return wall - (wall + 3 * _MICROSECONDS_PER_DAY) % size
+  year, month = _DaysToCivil(wall // _MICROSECONDS_PER_DAY)
+  if unit == 'month':
+    months = year * 12 + month - 1
+    months -= months % step
+    year, month = months // 12, months % 12 + 1
+  else:
+    year -= year % step
+    month = 1
+  return _CivilToDays(year, month) * _MICROSECONDS_PER_DAY
+
+
+def _WallToUTCMicros(wall, offset, offset_at):
+  """Find when a wall clock time happens.
+
+  Args:
+    wall: int; a wall clock time, in micros since the epoch.
+    offset: int; the preferred UTC offset, in micros, if wall happens twice.
+    offset_at: function from UTC micros to the UTC offset then.
+
+  Returns:
+    The time in UTC micros.  If the clock skips over wall, the time at which
+    it does.
+  """
+  first = wall - offset
+  first_offset = offset_at(first)
+  if first_offset == offset:
+    return first
+  second = wall - first_offset
+  if offset_at(second) == first_offset:
+    return second
+  low, high = min(first, second), max(first, second)
+  high_offset = offset_at(high)
+  while high - low > 1:
+    middle = (low + high) // 2
+    if offset_at(middle) == high_offset:
+      high = middle
+    else:
+      low = middle
+  return high
+
+
+def TruncateUTCMicros(micros, unit, tz=None, step=1):
+  """Truncate times to the start of the calendar unit they fall in.
+
+  This is how timestamps are put in buckets by minute, day, week, etc. to
+  aggregate them, e.g. with collections.Counter.  The calendar is that of tz,
+  whose UTC offsets are looked up in a table built once, for pytz timezones
+  and fixed offsets; the truncation itself is integer arithmetic.  Other
+  timezones are asked for the offset of every time.
+
+  When DST ends, the repeated hour forms two buckets, one for each offset.
+  When a bucket would start at a wall clock time that DST skips, it starts
+  when the clock jumps instead.
+
+  Args:
+    micros: sequence of UTC times, expressed in microseconds since the epoch,
+      or a NumPy array of them.
+    unit: str; one of TRUNCATION_UNITS.  Weeks start on Monday.
+    tz: timezone whose calendar to use; defaults to UTC.
+    step: int; the number of units in a bucket, e.g. 15 with 'minute' for
+      quarter hours.  Buckets of up to a day start at multiples of step units
+      from 1970-01-01 on the wall clock, weeks from Monday 1969-12-29, and
+      months and years at multiples of step from year 0 (so 3 months are
+      quarters).
+
+  Returns:
+    A list of the start of the bucket of every time, in UTC micros, or an
+    int64 NumPy array of them if micros is a NumPy array.
+
+  Raises:
+    ValueError: if unit or step is invalid.
+  """
+  if unit not in TRUNCATION_UNITS:
+    raise ValueError('Unknown calendar unit %r' % (unit,))
+  if step < 1:
+    raise ValueError('Invalid step %r' % (step,))
+  tz = tz or UTC
+  table = _GetUTCOffsetTable(tz)
+  if _IsNumpyArray(micros) and table is not None:
+    return _TruncateUTCMicrosArray(micros, unit, step, *table)
+  offset_at = _MakeOffsetFunction(tz, table)
+  result = []
+  # Timezones without a table are asked about every time, and take ints only.
+  for value in micros.tolist() if _IsNumpyArray(micros) else micros:
+    offset = offset_at(value)
+    result.append(_WallToUTCMicros(_TruncateWall(value + offset, unit, step),
+                                   offset, offset_at))
+  if _IsNumpyArray(micros):
+    numpy = _Numpy()
+    return numpy.array(result, dtype=numpy.int64)
+  return result
+
+
+def _TruncateUTCMicrosArray(micros, unit, step, transitions, offsets):
+  """TruncateUTCMicros on a NumPy array, for a timezone with a table."""
+  numpy = _Numpy()
+  values = numpy.asarray(micros, dtype=numpy.int64)
+  transitions = numpy.array(transitions, dtype=numpy.int64)
+  offsets = numpy.array(offsets, dtype=numpy.int64)
+
+  def OffsetAt(times):
+    return offsets[numpy.searchsorted(transitions, times, side='right')]
+  offset = OffsetAt(values)
+  wall = _TruncateWall(values + offset, unit, step)
+  if not len(transitions):
+    return wall - offset
+  # Vectorized _WallToUTCMicros; the transitions are hours apart, so the one
+  # skipped over is the first after the earlier guess.
+  first = wall - offset
+  first_offset = OffsetAt(first)
+  second = wall - first_offset
+  skipped = transitions[numpy.minimum(
+      numpy.searchsorted(transitions, numpy.minimum(first, second),
+                         side='right'), len(transitions) - 1)]
+  return numpy.where(
+      first_offset == offset, first,
+      numpy.where(OffsetAt(second) == first_offset, second, skipped))
+
+
+class TimestampArray(object):
+  """A compact sequence of timestamps.
+
+  The timestamps are stored as microseconds since the epoch, in UTC, in an
+  array of 64-bit integers, which takes 8 bytes per timestamp instead of a
+  Python object each.  Timestamps are only created when elements are accessed;
+  sorting, range queries and arithmetic work on the integers directly, and the
+  integers themselves are in the micros attribute.
+  """
+
+  __slots__ = ('micros', 'tz')
+
+  def __init__(self, micros=(), tz=None):
+    """Initialize a TimestampArray.
+
+    Args:
+      micros: iterable of UTC times, expressed in microseconds since the epoch,
+        or a NumPy array of them.
+      tz: timezone of the Timestamps made of the elements; defaults to UTC.
+    """
+    self.micros = array.array('q')
+    if _IsNumpyArray(micros):
+      numpy = _Numpy()
+      self.micros.frombytes(
+          numpy.ascontiguousarray(micros, dtype=numpy.int64).tobytes())
+    else:
+      self.micros.extend(micros)
+    self.tz = tz or UTC
+
+  @classmethod
+  def FromDatetimes(cls, dates, tz=None):
+    """Create a TimestampArray from datetimes; naive ones are taken as UTC.
+
+    Args:
+      dates: iterable of datetimes.
+      tz: timezone of the Timestamps made of the elements; defaults to UTC.
+
+    Returns:
+      New TimestampArray.
+    """
+    return cls(map(_DatetimeToUTCMicrosFast, dates), tz)
+
+  def AsNumpy(self):
+    """Return the microseconds as an int64 NumPy array sharing this memory.
+
+    NumPy must be installed.  While the NumPy array is alive, appending to
+    this TimestampArray raises BufferError.
+    """
+    numpy = _Numpy()
+    return numpy.frombuffer(self.micros, dtype=numpy.int64)
+
+  def _ToMicros(self, value):
+    """Get the microseconds of a datetime, or of an int as is."""
+    if isinstance(value, datetime.datetime):
+      return _DatetimeToUTCMicrosFast(value)
+    return value
+
+  def _MakeTimestamp(self, micros):
+    """Create a Timestamp in self.tz from microseconds since the epoch."""
+    r = _EPOCH + datetime.timedelta(microseconds=micros)
+    result = Timestamp(r.year, r.month, r.day, r.hour, r.minute, r.second,
+                       r.microsecond, UTC)
+    if self.tz is not UTC:
+      result = result.astimezone(self.tz)
+    return result
+
+  def _Copy(self, micros):
+    """Create a TimestampArray in the same timezone."""
+    result = TimestampArray(tz=self.tz)
+    result.micros = micros
+    return result
+
+  def __len__(self):
+    return len(self.micros)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return self._Copy(self.micros[index])
+    return self._MakeTimestamp(self.micros[index])
+
+  def __iter__(self):
+    for micros in self.micros:
+      yield self._MakeTimestamp(micros)
+
+  def __eq__(self, other):
+    if not isinstance(other, TimestampArray):
+      return NotImplemented
+    return self.micros == other.micros
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return 'TimestampArray(%r, tz=%r)' % (self.micros.tolist(), self.tz)
+
+  def append(self, value):
+    """Append a datetime, or a time in microseconds since the epoch."""
+    self.micros.append(self._ToMicros(value))
+
+  def extend(self, values):
+    """Append datetimes, or times in microseconds since the epoch."""
+    self.micros.extend(map(self._ToMicros, values))
+
+  def sort(self, reverse=False):
+    """Sort the timestamps in place."""
+    numpy = _Numpy()
+    if numpy is not None:
+      micros = numpy.sort(self.AsNumpy())
+      self.micros = array.array('q', (micros[::-1] if reverse
+                                      else micros).tobytes())
+    else:
+      self.micros = array.array('q', sorted(self.micros, reverse=reverse))
+
+  def Between(self, start=None, end=None):
+    """Get the timestamps in a range, which must be sorted.
+
+    Args:
+      start: datetime or microseconds since the epoch; the first timestamp
+        included in the range, or None to start at the beginning.
+      end: datetime or microseconds since the epoch; the first timestamp after
+        the range, or None to go to the end.
+
+    Returns:
+      New TimestampArray.
+    """
+    low = 0 if start is None else bisect.bisect_left(
+        self.micros, self._ToMicros(start))
+    high = len(self.micros) if end is None else bisect.bisect_left(
+        self.micros, self._ToMicros(end), low)
+    return self[low:high]
+
+  def Truncate(self, unit, step=1):
+    """Truncate the timestamps to calendar units in this array's timezone.
+
+    Args:
+      unit: str; one of TRUNCATION_UNITS.
+      step: int; the number of units in a bucket; see TruncateUTCMicros.
+
+    Returns:
+      New TimestampArray.
+    """
+    micros = self.AsNumpy() if _Numpy() is not None else self.micros
+    result = TruncateUTCMicros(micros, unit, self.tz, step)
+    del micros
+    return TimestampArray(result, self.tz)
+
+  def Shift(self, delta):
+    """Move all timestamps by the same amount.
+
+    Args:
+      delta: timedelta, or integer number of microseconds.
+
+    Returns:
+      New TimestampArray.
+
+    Raises:
+      TypeError: if delta is neither a timedelta nor an integer.
+      OverflowError: if a timestamp would not fit in 64 bits.
+    """
+    if isinstance(delta, datetime.timedelta):
+      delta = _TimedeltaToMicros(delta)
+    # NumPy would add a float to the int64 values as a float64, whose bytes
+    # are then read back as garbage.
+    delta = operator.index(delta)
+    if _Numpy() is not None:
+      micros = self.AsNumpy()
+      # Unlike array.array, NumPy silently wraps around on overflow.
+      if len(micros) and not (-2 ** 63 <= int(micros.min()) + delta and
+                              int(micros.max()) + delta < 2 ** 63):
+        raise OverflowError('timestamp out of range for TimestampArray')
+      return self._Copy(array.array('q', (micros + delta).tobytes()))
+    return self._Copy(array.array('q', [micros + delta
+                                        for micros in self.micros]))
+
+  def __add__(self, delta):
+    if not isinstance(delta, datetime.timedelta):
+      return NotImplemented
+    return self.Shift(delta)
+
+  __radd__ = __add__
+
+  def __sub__(self, delta):
+    if not isinstance(delta, datetime.timedelta):
+      return NotImplemented
+    return self.Shift(-delta)
+
+
 # What's written below is a clear python bug. I mean, okay, I can apply
 # negative timezone to it and end result will be inconversible.
 
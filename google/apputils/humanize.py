@@ -38,11 +38,16 @@ HumanReadableInt in strings/human_readable.h.
 
 
 import datetime
+import functools
 import math
 import re
+import sys
 
 SIBILANT_ENDINGS = frozenset(['sh', 'ss', 'tch', 'ax', 'ix', 'ex'])
 DIGIT_SPLITTER = re.compile(r'\d+|\D+').findall
+# Splits a string into runs of non-digits at even indexes, and runs of digits
+# at odd indexes, the first and last run of non-digits possibly being empty.
+_DIGIT_RUN_SPLITTER = re.compile(r'(\d+)').split
 
 # These are included because they are common technical terms.
 SPECIAL_PLURALS = {
@@ -228,6 +233,50 @@ def BinaryPrefix(quantity, unit, precision=1):
   return _Prefix(quantity, unit, precision, BinaryScale)
 
 
+def DecimalPrefixes(quantities, unit, precision=1, min_scale=0,
+                    max_scale=None):
+  """Formats many numbers and a unit into strings, using decimal prefixes.
+
+  The same as calling DecimalPrefix() on every quantity, but the prefixes are
+  looked up once, and for a NumPy array the scale of all the quantities is
+  chosen at once.
+
+    DecimalPrefixes([576012, 1574215], 'bps') -> ['576 kbps', '2 Mbps']
+
+  Args:
+    quantities: A sequence or NumPy array of numbers.
+    unit: A string, the dimension for the quantities, with no multipliers.
+    precision: An integer, the minimum number of digits to display.
+    min_scale: minimum power of 1000 to scale to, (None = unbounded).
+    max_scale: maximum power of 1000 to scale to, (None = unbounded).
+
+  Returns:
+    A list of strings, one per quantity, as returned by DecimalPrefix().
+  """
+  prefixes, min_scale = _DecimalPrefixes(min_scale, max_scale)
+  return _Prefixes(quantities, unit, precision, 1000, prefixes, min_scale)
+
+
+def BinaryPrefixes(quantities, unit, precision=1):
+  """Formats many numbers and a unit into strings, using binary prefixes.
+
+  The same as calling BinaryPrefix() on every quantity, but for a NumPy array
+  the scale of all the quantities is chosen at once.
+
+    BinaryPrefixes([576012, 1024], 'B') -> ['563 KiB', '1 KiB']
+
+  Args:
+    quantities: A sequence or NumPy array of numbers.
+    unit: A string, the dimension for the quantities, with no multipliers.
+    precision: An integer, the minimum number of digits to display.
+
+  Returns:
+    A list of strings, one per quantity, as returned by BinaryPrefix().
+  """
+  return _Prefixes(quantities, unit, precision, 1024,
+                   ('',) + BINARY_PREFIXES, 0)
+
+
 def _Prefix(quantity, unit, precision, scale_callable, **args):
   """Formats an integer and a unit into a string.
 
@@ -247,18 +296,60 @@ def _Prefix(quantity, unit, precision, scale_callable, **args):
   if not quantity:
     return '0%s%s' % (separator, unit)
 
-  if quantity in [float('inf'), float('-inf')] or math.isnan(quantity):
+  if math.isinf(quantity) or math.isnan(quantity):
     return '%f%s%s' % (quantity, separator, unit)
 
   scaled_quantity, scaled_unit = scale_callable(quantity, unit, **args)
+  return _FormatScaled(scaled_quantity, scaled_unit, precision)
+
+
+def _FormatScaled(scaled_quantity, scaled_unit, precision):
+  """Formats a non-zero, finite scaled quantity and its prefixed unit.
+
+  Args:
+    scaled_quantity: A number, as returned by _Scale().
+    scaled_unit: A string, the prefixed unit returned by _Scale().
+    precision: An integer, the minimum number of digits to display.
+
+  Returns:
+    A string.
+  """
+  separator = ' ' if scaled_unit else ''
+  digits = max(0, precision - int(math.log(abs(scaled_quantity), 10)) - 1)
+  return '%.*f%s%s' % (digits, scaled_quantity, separator, scaled_unit)
 
-  if scaled_unit:
-    separator = ' '
 
-  print_pattern = '%%.%df%%s%%s' % max(0, (precision - int(
-      math.log(abs(scaled_quantity), 10)) - 1))
+def _Prefixes(quantities, unit, precision, multiplier, prefixes, min_scale):
+  """Formats many numbers and a unit into strings.
 
-  return print_pattern % (scaled_quantity, separator, scaled_unit)
+  Args:
+    quantities: A sequence or NumPy array of numbers.
+    unit: A string, the dimension for the quantities, with no multipliers.
+    precision: An integer, the minimum number of digits to display.
+    multiplier: An integer, the ratio between prefixes.
+    prefixes: A sequence of strings, the prefix of every power of multiplier
+        from min_scale on.
+    min_scale: The power of multiplier corresponding to the first prefix.
+
+  Returns:
+    A list of strings.
+  """
+  separator = ' ' if unit else ''
+  zero = '0%s%s' % (separator, unit)
+  units = [prefix + unit for prefix in prefixes]
+  results = []
+  append = results.append
+  for quantity, value, index in _Scales(quantities, multiplier, prefixes,
+                                        min_scale):
+    if index is not None:
+      append(_FormatScaled(value, units[index], precision))
+    elif not quantity:
+      append(zero)
+    elif math.isnan(quantity) or math.isinf(quantity):
+      append('%f%s%s' % (quantity, separator, unit))
+    else:
+      append(_FormatScaled(value, unit, precision))
+  return results
 
 
 # Prefixes and corresponding min_scale and max_scale for decimal formating.
@@ -267,6 +358,9 @@ DECIMAL_PREFIXES = ('y', 'z', 'a', 'f', 'p', 'n', 'µ', 'm',
 DECIMAL_MIN_SCALE = -8
 DECIMAL_MAX_SCALE = 8
 
+# Prefixes for binary formating, from 1024**1 on.
+BINARY_PREFIXES = ('Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi')
+
 
 def DecimalScale(quantity, unit, min_scale=0, max_scale=None):
   """Get the scaled value and decimal prefixed unit in a tupple.
@@ -284,13 +378,27 @@ def DecimalScale(quantity, unit, min_scale=0, max_scale=None):
     A tuple of a scaled quantity (float) and BinaryPrefix for the
     units (string).
   """
+  powers, min_scale = _DecimalPrefixes(min_scale, max_scale)
+  return _Scale(quantity, unit, 1000, powers, min_scale)
+
+
+def _DecimalPrefixes(min_scale, max_scale):
+  """Get the decimal prefixes between min_scale and max_scale.
+
+  Args:
+    min_scale: minimum power of 1000 to normalize to (None = unbounded)
+    max_scale: maximum power of 1000 to normalize to (None = unbounded)
+
+  Returns:
+    A tuple of the prefixes, and the power of 1000 of the first one.
+  """
   if min_scale is None or min_scale < DECIMAL_MIN_SCALE:
     min_scale = DECIMAL_MIN_SCALE
   if max_scale is None or max_scale > DECIMAL_MAX_SCALE:
     max_scale = DECIMAL_MAX_SCALE
   powers = DECIMAL_PREFIXES[
       min_scale - DECIMAL_MIN_SCALE:max_scale - DECIMAL_MIN_SCALE + 1]
-  return _Scale(quantity, unit, 1000, powers, min_scale)
+  return powers, min_scale
 
 
 def BinaryScale(quantity, unit):
@@ -306,8 +414,7 @@ def BinaryScale(quantity, unit):
     A tuple of a scaled quantity (float) and BinaryPrefix for the
     units (string).
   """
-  return _Scale(quantity, unit, 1024,
-                ('Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi'))
+  return _Scale(quantity, unit, 1024, BINARY_PREFIXES)
 
 
 def _Scale(quantity, unit, multiplier, prefixes=None, min_scale=None):
@@ -326,19 +433,158 @@ def _Scale(quantity, unit, multiplier, prefixes=None, min_scale=None):
     A tuple containing the raw scaled quantity (float) and the prefixed unit.
   """
   if (not prefixes or not quantity or math.isnan(quantity) or
-      quantity in [float('inf'), float('-inf')]):
+      math.isinf(quantity)):
     return float(quantity), unit
 
   if min_scale is None:
     min_scale = 0
     prefixes = ('',) + tuple(prefixes)
-  value, prefix = quantity, ''
-  for power, prefix in enumerate(prefixes, min_scale):
-    # This is more numerically accurate than '/ multiplier ** power'.
-    value = float(quantity) * multiplier ** -power
-    if abs(value) < multiplier:
+  table = _ScaleTable(multiplier, min_scale, len(prefixes))
+  value, index = _ScaleIndex(quantity, multiplier, min_scale, table)
+  return value, prefixes[index] + unit
+
+
+@functools.lru_cache(maxsize=None)
+def _ScaleTable(multiplier, min_scale, count):
+  """Get what _ScaleIndex needs to know about a range of prefixes.
+
+  Args:
+    multiplier: An integer, the ratio between prefixes.
+    min_scale: The power of multiplier corresponding to the first prefix.
+    count: The number of prefixes.
+
+  Returns:
+    A tuple of:
+      a tuple of floats, multiplier ** -power for every power from min_scale
+      on; multiplying by these is more numerically accurate than dividing by
+      multiplier ** power;
+      the base 2 logarithm of multiplier.
+  """
+  factors = tuple(float(multiplier ** -power)
+                  for power in range(min_scale, min_scale + count))
+  return factors, math.log(multiplier, 2)
+
+
+def _ScaleIndex(quantity, multiplier, min_scale, table):
+  """Find the prefix for a quantity.
+
+  That is the first one which scales the quantity below multiplier, or the
+  last one if none does.  It is estimated from the binary exponent of the
+  quantity, then corrected by comparing the scaled quantity itself with
+  multiplier, so that quantities at a boundary, like 1024 or 999.95, get the
+  same prefix as when trying every prefix in turn.
+
+  Args:
+    quantity: A non-zero, finite number.
+    multiplier: An integer, the ratio between prefixes.
+    min_scale: The power of multiplier corresponding to the first prefix.
+    table: As returned by _ScaleTable().
+
+  Returns:
+    A tuple of the scaled quantity (float) and the index of the prefix.
+  """
+  factors, bits = table
+  quantity = float(quantity)
+  last = len(factors) - 1
+  # 2 ** (exponent - 1) <= abs(quantity) < 2 ** exponent.
+  index = math.floor((math.frexp(quantity)[1] - 1) / bits) - min_scale
+  if index < 0:
+    index = 0
+  elif index > last:
+    index = last
+  value = quantity * factors[index]
+  if abs(value) >= multiplier:
+    while index < last:
+      index += 1
+      value = quantity * factors[index]
+      if abs(value) < multiplier:
+        break
+  else:
+    while index:
+      lower = quantity * factors[index - 1]
+      if abs(lower) >= multiplier:
+        break
+      index -= 1
+      value = lower
+  return value, index
+
+
+def _Scales(quantities, multiplier, prefixes, min_scale):
+  """Scales many quantities like _Scale, without attaching units.
+
+  Args:
+    quantities: A sequence or NumPy array of numbers.
+    multiplier: An integer, the ratio between prefixes.
+    prefixes: A sequence of strings, the prefix of every power of multiplier
+        from min_scale on.
+    min_scale: The power of multiplier corresponding to the first prefix.
+
+  Returns:
+    An iterable of (quantity, scaled quantity, index of the prefix) tuples,
+    with a None index for quantities that are not scaled: zero, infinite and
+    NaN ones, and all of them if there are no prefixes.
+  """
+  if not prefixes:
+    return ((q, float(q), None) for q in quantities)
+  # NumPy is optional, and slow to import; a NumPy array can only exist once
+  # it has been imported.
+  numpy = sys.modules.get('numpy')
+  if (numpy is not None and isinstance(quantities, numpy.ndarray) and
+      quantities.dtype.kind in 'iuf'):
+    return _ScaleArray(quantities, multiplier, prefixes, min_scale)
+  table = _ScaleTable(multiplier, min_scale, len(prefixes))
+  results = []
+  append = results.append
+  for quantity in quantities:
+    if not quantity or math.isnan(quantity) or math.isinf(quantity):
+      append((quantity, float(quantity), None))
+    else:
+      append((quantity,) +
+             _ScaleIndex(quantity, multiplier, min_scale, table))
+  return results
+
+
+def _ScaleArray(quantities, multiplier, prefixes, min_scale):
+  """Scales a NumPy array of quantities; see _Scales.
+
+  The power of every quantity is estimated from its logarithm, then corrected
+  by comparing the scaled value with multiplier exactly as _Scale does, so
+  that quantities right at a boundary get the same prefix.
+
+  Args:
+    quantities: A NumPy array of integers or floats.
+    multiplier: An integer, the ratio between prefixes.
+    prefixes: A non-empty sequence of strings, the prefix of every power of
+        multiplier from min_scale on.
+    min_scale: The power of multiplier corresponding to the first prefix.
+
+  Returns:
+    A list of (quantity, scaled quantity, index of the prefix) tuples.
+  """
+  import numpy  # pylint: disable=g-import-not-at-top
+  quantities = quantities.astype(numpy.float64).ravel()
+  last = len(prefixes) - 1
+  factors = numpy.array(_ScaleTable(multiplier, min_scale, last + 1)[0])
+  magnitudes = numpy.abs(quantities)
+  scaled = numpy.isfinite(quantities) & (magnitudes != 0)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    estimate = numpy.floor(numpy.log(magnitudes) / math.log(multiplier))
+  estimate[~scaled] = min_scale
+  indexes = numpy.clip(estimate - min_scale, 0, last).astype(numpy.intp)
+  while True:
+    values = quantities * factors[indexes]
+    up = scaled & (indexes < last) & (numpy.abs(values) >= multiplier)
+    lower = numpy.maximum(indexes - 1, 0)
+    down = scaled & (indexes > 0) & (
+        numpy.abs(quantities * factors[lower]) < multiplier)
+    if not (up.any() or down.any()):
       break
-  return value, prefix + unit
+    indexes += up
+    indexes -= down
+  return [(quantity, value, index if is_scaled else None)
+          for quantity, value, index, is_scaled in zip(
+              quantities.tolist(), values.tolist(), indexes.tolist(),
+              scaled.tolist())]
 
 # Contains the fractions where the full range [1/n ... (n - 1) / n]
 # is defined in Unicode.
@@ -442,11 +688,17 @@ def NaturalSortKey(data):
   - ['Model 9', 'Model 70 SE', 'Model 70 SE2']
     (not ['Model 70 SE', 'Model 70 SE2', 'Model 9']).
 
+  Strings starting with a digit sort before the others, as the key of such a
+  string starts with an empty string, so that integers are only ever compared
+  with integers.
+
   Usage:
     new_list = sorted(old_list, key=humanize.NaturalSortKey)
     or
     list_sort_in_place.sort(key=humanize.NaturalSortKey)
 
+  See also NaturalSortTupleKey() and NaturalSorted(), which are faster.
+
   Based on code by Steven Bazyl <sbazyl@google.com>.
 
   Args:
@@ -455,13 +707,82 @@ def NaturalSortKey(data):
   Returns:
     A list which is comparable to other lists for the purpose of sorting.
   """
-  segments = DIGIT_SPLITTER(data)
-  for i, value in enumerate(segments):
-    if value.isdigit():
-      segments[i] = int(value)
+  segments = _DIGIT_RUN_SPLITTER(data)
+  segments[1::2] = map(int, segments[1::2])
+  if not segments[-1]:
+    segments.pop()
   return segments
 
 
+def NaturalSortTupleKey(data):
+  """Key function for "natural sort" ordering, returning a tuple.
+
+  Sorts in the same order as NaturalSortKey(), but the key is a tuple, which
+  is more compact than a list and can be hashed, e.g. to keep it in a dict.
+
+  Args:
+    data: str, The key being compared in a sort.
+
+  Returns:
+    A tuple of alternating strings and integers, starting and ending with a
+    string, which is comparable to other such tuples for the purpose of
+    sorting.
+  """
+  segments = _DIGIT_RUN_SPLITTER(data)
+  segments[1::2] = map(int, segments[1::2])
+  return tuple(segments)
+
+
+def NaturalSorted(iterable, key=None, reverse=False):
+  """Return a new list of the items of iterable, in natural sort order.
+
+  Like sorted(iterable, key=NaturalSortKey), but the key of every item is
+  built once, as a tuple.
+
+  Args:
+    iterable: The strings to sort, or the items to sort if key is given.
+    key: A function returning the string to sort an item by, or None to sort
+        the items themselves.
+    reverse: Whether to sort in descending order.
+
+  Returns:
+    A sorted list.
+  """
+  if key is None:
+    return sorted(iterable, key=NaturalSortTupleKey, reverse=reverse)
+  return sorted(iterable, key=lambda item: NaturalSortTupleKey(key(item)),
+                reverse=reverse)
+
+
+def NaturalInsort(sorted_list, item, key=None):
+  """Insert an item into a list in natural sort order, keeping it sorted.
+
+  Like bisect.insort(), the item goes after any equal item.  Only the keys
+  of the O(log n) items the binary search looks at are built.
+
+  Args:
+    sorted_list: A list sorted in natural sort order, e.g. by NaturalSorted().
+    item: The string to insert, or the item to insert if key is given.
+    key: A function returning the string to sort an item by, or None to sort
+        the items themselves.
+
+  Returns:
+    The index at which the item was inserted.
+  """
+  if key is None:
+    key = lambda item: item
+  item_key = NaturalSortTupleKey(key(item))
+  low, high = 0, len(sorted_list)
+  while low < high:
+    middle = (low + high) // 2
+    if item_key < NaturalSortTupleKey(key(sorted_list[middle])):
+      high = middle
+    else:
+      low = middle + 1
+  sorted_list.insert(low, item)
+  return low
+
+
 def UnixTimestamp(unix_ts, tz):
   """Format a UNIX timestamp into a human-readable string.
 
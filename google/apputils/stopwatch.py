@@ -44,37 +44,451 @@ sw.stop('all_this')
 In this case, the output will be what you want:  the time spent in
 small_but_expensive function will show up in the timer for just_that and not
 all_this.
+
+Timers can also be used as context managers or decorators, which stop them
+even if an exception is raised:
+
+with sw.timer('foo'):
+  foo()
+
+@sw.timed('bar')
+def bar(args):
+  ...
+
+A StopWatch created with nested=True additionally records which timer was
+started inside which, and can render the result as a call tree with the
+inclusive and exclusive time of every node:
+
+sw = StopWatch(nested=True)
+sw.start('request')
+sw.start('parse')
+sw.stop('parse')
+sw.start('db')
+sw.stop('db')
+sw.stop('request')
+sw.dump(verbose=True)
+
+In nested mode timers have to be stopped in the reverse order they were
+started in.
+
+A StopWatch created with histograms=True also keeps a fixed-size histogram of
+the time each start/stop pair took per timer, so dump() can show percentiles
+and histogram(name) can be queried for them.
+
+StopWatch(track_memory=True) also records, per timer, the bytes allocated
+(according to tracemalloc), the peak of traced memory above the level at which
+it started and the number of garbage collections that happened while it ran.
+
+StopWatch(track_cpu=True) records the CPU time of the calling thread next to
+the wall time of every timer, and dump() shows what fraction of the wall time
+was spent computing, which tells compute-bound timers from those waiting on
+I/O or locks.
+
+To keep the cost of instrumenting very hot code down, timers can be sampled:
+StopWatch(sampling={'db': 100}) only times every 100th start of 'db', and
+results() scales the sampled time back up to an estimate of the total.
+
+Long-running processes can use a PeriodicReporter to write out, every few
+seconds, the time recorded since the previous report:
+
+reporter = PeriodicReporter(sw, 60, sys.stderr.write)
+reporter.start()
+
+A StopWatch must only be timed from one thread, though other threads may
+take snapshots of it or merge it.  Threaded programs can use a
+ThreadLocalStopWatch instead, which keeps a separate StopWatch per thread and
+merges them all when reporting.  Likewise, asyncio programs can use an
+AsyncStopWatch, which keeps a separate StopWatch per task and, with its task
+factory installed, leaves out the time tasks spend suspended at await points:
+
+sw = AsyncStopWatch()
+asyncio.get_running_loop().set_task_factory(sw.task_factory)
 """
 
+import asyncio
+import collections.abc
+import contextlib
+import contextvars
+import csv
+import functools
+import gc
 import io
+import json
+import logging
+import math
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.util
+import random
+import threading
 import time
+import tracemalloc
+import weakref
+import zlib
+
+from google.apputils import humanize
 
 
 __owner__ = 'dbentley@google.com (Dan Bentley)'
 
+_NANOS_PER_SECOND = 1e9
+
+# Number of timer() context managers each stopwatch keeps for reuse, so that
+# timers with ever new names, e.g. one per request, do not grow it forever.
+_TIMER_CACHE_SIZE = 256
+
+# The StopWatches created with track_memory=True.  Reading the peak traced
+# memory resets it, so every reading is passed on to the running timers of all
+# of them, under _memory_lock, rather than only to the stopwatch reading it.
+_memory_trackers = weakref.WeakSet()
+_memory_lock = threading.Lock()
+# tracemalloc.reset_peak(), or None before Python 3.9, where the peak cannot
+# be reset and the peaks of timers only come from the traced memory at each
+# start and stop.
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+
+
+class Histogram(object):
+  """A histogram of non-negative integers using a fixed amount of memory.
+
+  Values are counted in log-linear buckets, in the style of HdrHistogram: the
+  first 2**precision_bits values get a bucket each, and above that each power
+  of two is split into 2**(precision_bits - 1) buckets of equal width.  Any
+  value is therefore reported with a relative error below
+  2**(1 - precision_bits), and 64-bit values never need more than
+  (66 - precision_bits) * 2**(precision_bits - 1) buckets no matter how many
+  samples are recorded.  The exact count, sum, minimum and maximum are kept
+  too.
+
+  Instance variables:
+    count: number of values recorded.
+    total: sum of the values recorded.
+    min: smallest value recorded, or None if there are none.
+    max: largest value recorded, or None if there are none.
+  """
+
+  def __init__(self, precision_bits=5):
+    """Initializes the histogram.
+
+    Args:
+      precision_bits: int; number of significant bits kept for every value.
+    """
+    self._precision_bits = precision_bits
+    self._linear = 1 << precision_bits
+    self._half = self._linear >> 1
+    self._buckets = {}
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+
+  def _index(self, value):
+    """Return the index of the bucket counting value."""
+    if value < self._linear:
+      return value
+    shift = value.bit_length() - self._precision_bits
+    return self._linear + (shift - 1) * self._half + (
+        (value >> shift) - self._half)
+
+  def _upper_bound(self, index):
+    """Return the largest value counted by the bucket with the given index."""
+    if index < self._linear:
+      return index
+    shift, offset = divmod(index - self._linear, self._half)
+    return ((offset + self._half + 1) << (shift + 1)) - 1
+
+  def record(self, value):
+    """Add a value to the histogram.
+
+    Args:
+      value: int; the value to record.  Negative values are recorded as zero.
+    """
+    if value < 0:
+      value = 0
+    index = self._index(value)
+    self._buckets[index] = self._buckets.get(index, 0) + 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    """Add the values recorded by another histogram to this one.
+
+    Args:
+      other: Histogram; must use the same precision_bits as this one.
+
+    Raises:
+      ValueError: if the two histograms have different precisions.
+    """
+    # pylint: disable=protected-access
+    if other._precision_bits != self._precision_bits:
+      raise ValueError('Cannot merge histograms of different precision')
+    for index, count in list(other._buckets.items()):
+      self._buckets[index] = self._buckets.get(index, 0) + count
+    self.count += other.count
+    self.total += other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+  def _state(self):
+    """Return the state of the histogram as JSON-serializable data."""
+    return [self._precision_bits, self.count, self.total, self.min, self.max,
+            sorted(self._buckets.items())]
+
+  @classmethod
+  def _from_state(cls, state):
+    """Create a histogram from the output of _state()."""
+    precision_bits, count, total, minimum, maximum, buckets = state
+    histogram = cls(precision_bits)
+    histogram.count = count
+    histogram.total = total
+    histogram.min = minimum
+    histogram.max = maximum
+    histogram._buckets = dict(  # pylint: disable=protected-access
+        (index, bucket_count) for index, bucket_count in buckets)
+    return histogram
+
+  def percentile(self, percent):
+    """Estimate a percentile of the recorded values.
+
+    Args:
+      percent: number; the percentile to compute, between 0 and 100.
+
+    Returns:
+      The largest value of the bucket holding the requested rank, clamped to
+      the range of recorded values, or None if nothing has been recorded.
+    """
+    if not self.count:
+      return None
+    rank = max(1, -(-self.count * percent // 100))
+    seen = 0
+    for index in sorted(self._buckets):
+      seen += self._buckets[index]
+      if seen >= rank:
+        return max(self.min, min(self.max, self._upper_bound(index)))
+    return self.max
+
+
+class _Timer(object):
+  """Context manager that starts a timer on entry and stops it on exit.
+
+  It holds no per-use state, so one instance can be entered any number of
+  times, even concurrently.
+  """
+  __slots__ = ('_start', '_stop', '_timer', '_stop_others')
+
+  def __init__(self, stopwatch, timer, stop_others):
+    self._start = stopwatch.start
+    self._stop = stopwatch.stop
+    self._timer = timer
+    self._stop_others = stop_others
+
+  def __enter__(self):
+    self._start(self._timer, self._stop_others)
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self._stop(self._timer)
+
+
+class _TimerMixin(object):
+  """Context manager and decorator forms of start() and stop()."""
+
+  def timer(self, timer='total', stop_others=True):
+    """Get a context manager that runs a timer while its block executes.
+
+    The timer is stopped even if the block raises.  Context managers for the
+    most recently used names are cached, so entering one costs little more
+    than calling start() and stop() directly.
+
+    Args:
+      timer: str; name of the timer to run.
+      stop_others: bool; passed to start().
+
+    Returns:
+      A context manager.
+    """
+    return self._timer_cache(timer, stop_others)
+
+  def _new_timer(self, timer, stop_others):
+    """Create the context manager returned by timer()."""
+    return _Timer(self, timer, stop_others)
+
+  def timed(self, timer=None, stop_others=True):
+    """Get a decorator that runs a timer for every call of a function.
+
+    The wrapper binds start() and stop() once, when the function is decorated,
+    so a call only adds two method calls and a try/finally.  For very hot
+    functions, stop_others=False also skips stopping the other running timers.
+
+    Args:
+      timer: str; name of the timer to run, defaults to the function's name.
+      stop_others: bool; passed to start().
 
-class StopWatch(object):
+    Returns:
+      A decorator.
+    """
+    start = self.start
+    stop = self.stop
+
+    def Decorator(func):
+      name = timer or func.__name__
+
+      @functools.wraps(func)
+      def Wrapper(*args, **kwargs):
+        start(name, stop_others)
+        try:
+          return func(*args, **kwargs)
+        finally:
+          stop(name)
+      return Wrapper
+    return Decorator
+
+
+class StopWatch(_TimerMixin):
   """Class encapsulating a timer; see above for example usage.
 
+  Times are read from a pluggable clock returning integer nanoseconds
+  (time.perf_counter_ns by default), so they are monotonic and the hot path
+  does no float arithmetic.  Values are only converted to seconds when they
+  are reported.
+
   Instance variables:
-    timers: map of stopwatch name -> time for each currently running stopwatch,
-            where time is seconds from the epoch of when this stopwatch was
-            started.
-    accum: map of stopwatch name -> accumulated time, in seconds, it has
+    timers: map of stopwatch name -> clock reading, in nanoseconds, of when
+            each currently running stopwatch was started.
+    accum: map of stopwatch name -> accumulated time, in nanoseconds, it has
             already been run for.
     stopped: map of timer name -> list of timer names that are blocking it.
     counters: map of timer name -> number of times it has been started.
+    suspended: map of timer name -> time, in nanoseconds, it was running while
+               the stopwatch was paused, which is not included in accum.
   """
 
-  def __init__(self):
-    self.timers = {}
-    self.accum = {}
-    self.stopped = {}
-    self.counters = {}
+  def __init__(self, clock=None, nested=False, histograms=False,
+               sampling=None, random_sampling=False, track_memory=False,
+               track_cpu=False, cpu_clock=None):
+    """Initializes the stopwatch.
+
+    Args:
+      clock: callable; returns the current time as an integer number of
+             nanoseconds.  Only differences between readings are used, so it
+             need not be related to the epoch.  Defaults to
+             time.perf_counter_ns.
+      nested: bool; if True, also record the tree of timers started inside
+              each other; see tree().
+      histograms: bool; if True, keep a Histogram per timer of the time, in
+                  nanoseconds, between each start() and its stop(); see
+                  histogram().
+      sampling: dict; map of timer name -> N, to only time one in N starts of
+                that timer.  The other starts, and their stops, are only
+                counted.  results() scales the sampled time up by the ratio of
+                starts to sampled starts; see also sampling_error().
+      random_sampling: bool; if True, sample each start with probability 1/N
+                       instead of exactly every Nth start, which avoids bias
+                       when the cost of a timer is periodic.
+      track_memory: bool; if True, record memory allocations and garbage
+                    collections per timer; see memory().  This starts
+                    tracemalloc if it is not tracing yet.  Memory is tracked
+                    process-wide, so allocations made by other threads while a
+                    timer runs are counted too.  Each start and stop resets
+                    the peak of tracemalloc; the stopwatches tracking memory
+                    share what it was, but other users of
+                    tracemalloc.get_traced_memory() see a peak only covering
+                    the time since the last start or stop.  Before Python
+                    3.9, which cannot reset the peak, the peaks only account
+                    for the traced memory at each start and stop.
+      track_cpu: bool; if True, record the CPU time spent while each timer
+                 runs; see cpu().
+      cpu_clock: callable; a function of no arguments returning the CPU time in
+                 nanoseconds, used if track_cpu is set.  Defaults to
+                 time.thread_time_ns; use time.process_time_ns to count the
+                 CPU time of all threads.
+    """
+    self._clock = clock or time.perf_counter_ns
+    self._nested = nested
+    self._keep_histograms = histograms
+    self._sampling = dict(sampling or {})
+    # Map of timer name -> N for the timers sampled here or in the stopwatches
+    # merged in, to scale their time up by when no start was sampled; see
+    # _scale().
+    self._sampling_rates = dict(self._sampling)
+    self._random_sampling = random_sampling
+    self._track_memory = track_memory
+    self._track_cpu = track_cpu
+    self._cpu_clock = cpu_clock or time.thread_time_ns
+    if track_memory:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+      with _memory_lock:
+        _memory_trackers.add(self)
+    self._timer_cache = functools.lru_cache(maxsize=_TIMER_CACHE_SIZE)(
+        self._new_timer)
+    # Whether start() and stop() can take their fast path, which only does the
+    # bookkeeping of plain timers.
+    self._plain = not (nested or histograms or self._sampling or track_memory
+                       or track_cpu)
+    # Held by other threads while they snapshot() or merge() this stopwatch,
+    # and then by the thread doing the timing too; see _exclusive().
+    self._lock = threading.Lock()
+    self._readers = 0
+    self._writing = False
+    self.reset()
+
+  def reset(self):
+    """Forget everything recorded so far, including the running timers."""
+    with self._exclusive():
+      self.timers = {}
+      self.accum = {}
+      self.stopped = {}
+      self.counters = {}
+      # Map of span path (tuple of timer names, outermost first) ->
+      # [inclusive nanoseconds, number of times entered], or None when not in
+      # nested mode.
+      self._spans = {} if self._nested else None
+      # Stack of (timer, path, start) for the spans that are currently open.
+      self._span_stack = []
+      # Map of timer name -> Histogram, or None when histograms are disabled.
+      self._histograms = {} if self._keep_histograms else None
+      # Map of running timer name -> its accum value when it was last started
+      # with start(), used to compute the histogram samples.
+      self._marks = {}
+      self.suspended = {}
+      # Clock reading at which pause() was called, or None if not paused.
+      self._paused_at = None
+      # Map of sampled timer name -> [starts, sampled starts, samples, sum of
+      # samples, sum of squared samples], samples being completed sampled uses.
+      self._sampling_stats = {}
+      # Map of sampled timer name -> number of outermost starts, which picks
+      # the ones sampled when not sampling at random.
+      self._sampling_ticks = {}
+      # Names of the timers whose current start was not sampled.
+      self._skipped = set()
+      # Map of running timer name -> number of times it was started again
+      # while running, e.g. by recursion, and not stopped yet.
+      self._reentries = {}
+      # Map of timer name -> [bytes allocated, peak bytes, garbage collections].
+      self._memory = {}
+      # Map of running timer name -> [traced bytes, peak traced bytes, garbage
+      # collections] since it was last started or restarted.
+      self._memory_starts = {}
+      # Map of timer name -> CPU time in nanoseconds.
+      self._cpu = {}
+      # Map of running timer name -> CPU clock reading when it was last started,
+      # restarted or resumed.
+      self._cpu_starts = {}
+      self._cpu_paused_at = None
 
   def start(self, timer='total', stop_others=True):
     """Start a timer.
 
+    Starting a timer that is already running only counts the start: the timer
+    keeps running until it has been stopped as many times as it was started.
+
     Args:
       timer: str; name of the timer to start, defaults to the overall timer.
       stop_others: bool; if True, stop all other running timers.  If False, then
@@ -82,15 +496,91 @@ class StopWatch(object):
                    and there's a good chance that the overhead measured will be
                    negative.
     """
+    self._writing = True
+    try:
+      if not self._readers:
+        if (self._plain and self._paused_at is None and
+            timer not in self.timers):
+          now = self._clock()
+          if stop_others:
+            if len(self.timers) > ('total' in self.timers):
+              self._stop_others(timer, now, None, None)
+            else:
+              self.stopped[timer] = []
+          self.counters[timer] = self.counters.get(timer, 0) + 1
+          self.timers[timer] = now
+        else:
+          self._start_timer(timer, stop_others)
+        return
+    finally:
+      self._writing = False
+    with self._lock:
+      self._start_timer(timer, stop_others)
+
+  def _start_timer(self, timer, stop_others):
+    """Implement start() for the cases the fast path does not handle."""
+    if self._paused_at is not None:
+      self._resume()
+    if timer in self.timers or timer in self._skipped:
+      # A timer started again while it runs, e.g. by a recursive function
+      # decorated with timed(), keeps running until the outermost stop().
+      self._reentries[timer] = self._reentries.get(timer, 0) + 1
+      stats = self._sampling_stats.get(timer) if self._sampling else None
+      if stats is not None:
+        # Every start counts, but only the sampled ones are scaled up.
+        stats[0] += 1
+        if timer in self.timers:
+          stats[1] += 1
+      if timer in self.timers:
+        self.counters[timer] = self.counters.get(timer, 0) + 1
+      return
+    if self._sampling:
+      one_in = self._sampling.get(timer)
+      if one_in is not None:
+        stats = self._sampling_stats.get(timer)
+        if stats is None:
+          stats = self._sampling_stats[timer] = [0, 0, 0, 0, 0]
+        stats[0] += 1
+        if self._random_sampling:
+          sampled = random.random() * one_in < 1
+        else:
+          # Re-entered starts are left out, so that recursion does not bias
+          # which outermost starts are sampled.
+          ticks = self._sampling_ticks.get(timer, 0) + 1
+          self._sampling_ticks[timer] = ticks
+          sampled = ticks % one_in == 1 % one_in
+        if not sampled:
+          self._skipped.add(timer)
+          # The other timers are still stopped, so that they do not count the
+          # time of this start on top of its scaled up samples.
+          if stop_others and len(self.timers) > ('total' in self.timers):
+            self._stop_others(
+                timer, self._clock(),
+                self._read_memory() if self._track_memory else None,
+                self._cpu_clock() if self._track_cpu else None)
+          else:
+            self.stopped.pop(timer, None)
+          return
+        stats[1] += 1
+    now = self._clock()
+    reading = self._read_memory() if self._track_memory else None
+    cpu_now = self._cpu_clock() if self._track_cpu else None
     if stop_others:
-      stopped = []
-      for other in list(self.timers):
-        if not other == 'total':
-          self.stop(other)
-          stopped.append(other)
-      self.stopped[timer] = stopped
+      self._stop_others(timer, now, reading, cpu_now)
     self.counters[timer] = self.counters.get(timer, 0) + 1
-    self.timers[timer] = time.time()
+    self.timers[timer] = now
+    if reading is not None:
+      self._memory_starts[timer] = [reading[0], reading[0], reading[1]]
+    if cpu_now is not None:
+      self._cpu_starts[timer] = cpu_now
+    if self._keep_histograms or timer in self._sampling_stats:
+      self._marks[timer] = self.accum.get(timer, 0)
+    if self._nested:
+      if self._span_stack:
+        path = self._span_stack[-1][1] + (timer,)
+      else:
+        path = (timer,)
+      self._span_stack.append((timer, path, now))
 
   def stop(self, timer='total'):
     """Stop a running timer.
@@ -101,17 +591,315 @@ class StopWatch(object):
       timer: str; name of the timer to stop, defaults to the overall timer.
 
     Raises:
-      RuntimeError: if timer refers to a timer that was never started.
+      RuntimeError: if timer refers to a timer that was never started, or, in
+                    nested mode, if it is not the most recently started timer
+                    that is still running.
     """
+    self._writing = True
+    try:
+      if not self._readers:
+        if (self._plain and self._paused_at is None and not self._reentries
+            and timer in self.timers):
+          now = self._clock()
+          self.accum[timer] = (self.accum.get(timer, 0) + now -
+                               self.timers.pop(timer))
+          stopped = self.stopped.get(timer)
+          if stopped:
+            self._restart(stopped, now, None, None)
+        else:
+          self._stop_timer(timer)
+        return
+    finally:
+      self._writing = False
+    with self._lock:
+      self._stop_timer(timer)
+
+  def _stop_timer(self, timer):
+    """Implement stop() for the cases the fast path does not handle."""
+    if self._paused_at is not None:
+      self._resume()
+    if self._reentries and timer in self._reentries:
+      count = self._reentries.pop(timer)
+      if count > 1:
+        self._reentries[timer] = count - 1
+      return
+    if self._skipped and timer in self._skipped:
+      self._skipped.discard(timer)
+      stopped = self.stopped.pop(timer, None)
+      if stopped:
+        self._restart(stopped, self._clock(),
+                      self._read_memory() if self._track_memory else None,
+                      self._cpu_clock() if self._track_cpu else None)
+      return
     if timer not in self.timers:
       raise RuntimeError(
           'Tried to stop timer that was never started: %s' % timer)
-    self.accum[timer] = self.timervalue(timer)
-    del self.timers[timer]
-    for stopped in self.stopped.get(timer, []):
-      self.start(stopped, stop_others=0)
+    if self._nested and self._span_stack[-1][0] != timer:
+      raise RuntimeError(
+          'Tried to stop timer %s while %s is still running inside it' %
+          (timer, self._span_stack[-1][0]))
+    now = self._clock()
+    self._stop(timer, now,
+               self._read_memory() if self._track_memory else None,
+               self._cpu_clock() if self._track_cpu else None)
+    if timer in self._marks:
+      sample = self.accum[timer] - self._marks.pop(timer)
+      if self._keep_histograms:
+        histogram = self._histograms.get(timer)
+        if histogram is None:
+          histogram = self._histograms[timer] = Histogram()
+        histogram.record(sample)
+      stats = self._sampling_stats.get(timer)
+      if stats is not None:
+        stats[2] += 1
+        stats[3] += sample
+        stats[4] += sample * sample
+    if self._nested:
+      unused_timer, path, start = self._span_stack.pop()
+      span = self._spans.get(path)
+      if span is None:
+        self._spans[path] = [now - start, 1]
+      else:
+        span[0] += now - start
+        span[1] += 1
+
+  def _update(self, method, *args):
+    """Call a method changing the state, as the thread doing the timing.
+
+    This is the protocol start() and stop() follow, without their fast paths:
+    no lock is taken unless another thread is in _exclusive().
+    """
+    self._writing = True
+    try:
+      if not self._readers:
+        return method(*args)
+    finally:
+      self._writing = False
+    with self._lock:
+      return method(*args)
+
+  @contextlib.contextmanager
+  def _exclusive(self):
+    """Keep the thread doing the timing out of the state while in the block.
+
+    The thread doing the timing sets _writing for the duration of every
+    start(), stop(), pause() and resume(), and only takes the lock if it sees
+    _readers set first.  Once this has set _readers and seen _writing cleared,
+    that thread is therefore either done with its step or waiting for the
+    lock.  This relies on the GIL running the two threads' steps one at a
+    time.
+    """
+    with self._lock:
+      self._readers += 1
+      try:
+        while self._writing:
+          # Let the thread doing the timing finish its step.
+          time.sleep(0)
+        yield
+      finally:
+        self._readers -= 1
+
+  def _stop(self, timer, now, reading=None, cpu_now=None):
+    """Stop a running timer at the given clock reading.
 
-  def timervalue(self, timer='total', now=None):
+    Anything that was stopped on behalf of this timer is restarted at the same
+    reading, so no time is lost between the two.
+
+    Args:
+      timer: str; name of a running timer.
+      now: int; clock reading, in nanoseconds, to stop the timer at.
+      reading: tuple; if memory is tracked, the output of _read_memory().
+      cpu_now: int; if CPU time is tracked, the CPU clock reading.
+    """
+    elapsed = now - self.timers.pop(timer)
+    self.accum[timer] = self.accum.get(timer, 0) + elapsed
+    if reading is not None:
+      start = self._memory_starts.pop(timer, None)
+      if start is not None:
+        totals = self._memory.get(timer)
+        if totals is None:
+          totals = self._memory[timer] = [0, 0, 0]
+        totals[0] += reading[0] - start[0]
+        totals[1] = max(totals[1], start[1] - start[0])
+        totals[2] += reading[1] - start[2]
+    if cpu_now is not None and timer in self._cpu_starts:
+      self._cpu[timer] = (self._cpu.get(timer, 0) + cpu_now -
+                          self._cpu_starts.pop(timer))
+    self._restart(self.stopped.get(timer, []), now, reading, cpu_now)
+
+  def _stop_others(self, timer, now, reading, cpu_now):
+    """Stop all running timers but total on behalf of timer.
+
+    Args:
+      timer: str; name of the timer being started.
+      now: int; clock reading, in nanoseconds, to stop the timers at.
+      reading: tuple; if memory is tracked, the output of _read_memory().
+      cpu_now: int; if CPU time is tracked, the CPU clock reading.
+    """
+    stopped = []
+    for other in list(self.timers):
+      if not other == 'total':
+        self._stop(other, now, reading, cpu_now)
+        stopped.append(other)
+    self.stopped[timer] = stopped
+
+  def _restart(self, timers, now, reading, cpu_now):
+    """Restart timers that were stopped on behalf of another one.
+
+    Args:
+      timers: list of str; names of the timers to restart.
+      now: int; clock reading, in nanoseconds, to restart the timers at.
+      reading: tuple; if memory is tracked, the output of _read_memory().
+      cpu_now: int; if CPU time is tracked, the CPU clock reading.
+    """
+    for stopped in timers:
+      self.counters[stopped] = self.counters.get(stopped, 0) + 1
+      self.timers[stopped] = now
+      if reading is not None:
+        self._memory_starts[stopped] = [reading[0], reading[0], reading[1]]
+      if cpu_now is not None:
+        self._cpu_starts[stopped] = cpu_now
+
+  def _read_memory(self):
+    """Read the memory counters, updating the peaks of the running timers.
+
+    The peaks of the running timers of every other StopWatch tracking memory
+    are updated too, since the peak kept by tracemalloc is reset.
+
+    Returns:
+      A tuple of the currently traced bytes and the number of garbage
+      collections so far.
+    """
+    with _memory_lock:
+      current, peak = tracemalloc.get_traced_memory()
+      if _reset_peak is None:
+        # The peak covers the whole time tracemalloc has been tracing.
+        peak = current
+      else:
+        # The next reading's peak then only covers the time since this one,
+        # for this stopwatch and all the others tracking memory.
+        _reset_peak()
+      for stopwatch in list(_memory_trackers):
+        # pylint: disable=protected-access
+        for start in list(stopwatch._memory_starts.values()):
+          if peak > start[1]:
+            start[1] = peak
+    return current, sum(stats['collections'] for stats in gc.get_stats())
+
+  def memory(self, timer='total'):
+    """Get the memory activity recorded while a timer was running.
+
+    Like the time in accum, this excludes what happened while the timer was
+    stopped on behalf of other timers.
+
+    Args:
+      timer: str; the name of the timer to report on.
+
+    Returns:
+      A tuple of (bytes allocated, net of bytes freed; largest increase of
+      traced memory over the level at which the timer was started or
+      restarted; number of garbage collections), or None if no memory was
+      recorded for the timer.
+    """
+    totals = self._memory.get(timer)
+    return tuple(totals) if totals else None
+
+  def cpu(self, timer='total'):
+    """Get the CPU time spent while a timer was running.
+
+    Like the time in accum, this excludes the time the timer was stopped on
+    behalf of other timers.  A running timer only contributes the CPU time up
+    to when it was last started or stopped, because the CPU clock of a thread
+    cannot be read from another one.
+
+    Args:
+      timer: str; the name of the timer to report on.
+
+    Returns:
+      The CPU time, in seconds, or None if CPU time was not recorded for the
+      timer.
+    """
+    value = self._cpu.get(timer)
+    if value is None:
+      return None
+    return value / _NANOS_PER_SECOND
+
+  def cpu_ratio(self, timer='total'):
+    """Get the fraction of a timer's wall time that was spent on the CPU.
+
+    A ratio close to 1 means the timer is compute-bound; one close to 0 means
+    it is mostly waiting, e.g. on I/O.  With a process-wide cpu_clock it can
+    exceed 1 when several threads run at once.
+
+    Args:
+      timer: str; the name of the timer to report on.
+
+    Returns:
+      A float, or None if CPU time was not recorded for the timer.
+    """
+    value = self._cpu.get(timer)
+    elapsed = self.accum.get(timer, 0)
+    if value is None or elapsed <= 0:
+      return None
+    return value / elapsed
+
+  def pause(self):
+    """Stop the clock for all running timers until resume() is called.
+
+    The time until then is left out of every running timer and open span, and
+    recorded in suspended instead.  Calling start() or stop() resumes first.
+    """
+    self._update(self._pause)
+
+  def _pause(self, now=None):
+    """Implement pause(), at a clock reading defaulting to the current one."""
+    if self._paused_at is not None:
+      return
+    if now is None:
+      now = self._clock()
+    self._paused_at = now
+    if self._track_cpu:
+      self._cpu_paused_at = self._cpu_clock()
+
+  def resume(self):
+    """Restart the clock for the timers that were running at pause()."""
+    self._update(self._resume)
+
+  def _resume(self, now=None):
+    """Implement resume().
+
+    Args:
+      now: int; the clock reading to resume at, defaults to the current one.
+    """
+    if self._paused_at is None:
+      return
+    delta = (self._clock() if now is None else now) - self._paused_at
+    self._paused_at = None
+    for name in list(self.timers):
+      # Moving the start forward leaves the paused time out of the timer.
+      self.timers[name] += delta
+      self.suspended[name] = self.suspended.get(name, 0) + delta
+    if self._span_stack:
+      self._span_stack = [(timer, path, start + delta)
+                          for timer, path, start in self._span_stack]
+    if self._cpu_paused_at is not None:
+      delta = self._cpu_clock() - self._cpu_paused_at
+      self._cpu_paused_at = None
+      for name in list(self._cpu_starts):
+        self._cpu_starts[name] += delta
+
+  def _timervalue_ns(self, timer, now):
+    """Return the value seen by a timer so far, in nanoseconds."""
+    if timer in self.timers:
+      if self._paused_at is not None and now > self._paused_at:
+        # The time since pause() is not counted.
+        now = self._paused_at
+      # Timer is running now.
+      return self.accum.get(timer, 0) + (now - self.timers[timer])
+    # Timer is stopped, or never started.
+    return self.accum.get(timer, 0)
+
+  def timervalue(self, timer='total', *, now_ns=None):
     """Return the value seen by this timer so far.
 
     If the timer is stopped, this will be the accumulated time it has seen.
@@ -120,38 +908,70 @@ class StopWatch(object):
 
     Args:
       timer: str; the name of the timer to report on.
-      now: long; if provided, the time to use for 'now' for running timers.
-    """
-    if not now:
-      now = time.time()
+      now_ns: int; if provided, the clock reading, in nanoseconds, to use for
+              'now' for running timers.
 
-    if timer in self.timers:
-      # Timer is running now.
-      return self.accum.get(timer, 0.0) + (now - self.timers[timer])
-    elif timer in self.accum:
-      # Timer is stopped.
-      return self.accum[timer]
-    else:
-      # Timer is never started.
-      return 0.0
+    Returns:
+      The time seen by the timer, in seconds.
+    """
+    now = self._clock() if now_ns is None else now_ns
+    return self._timervalue_ns(timer, now) / _NANOS_PER_SECOND
 
-  def overhead(self, now=None):
+  def overhead(self, *, now_ns=None):
     """Calculate the overhead.
 
     Args:
-      now: (optional) time to use as the current time.
+      now_ns: (optional) clock reading, in nanoseconds, to use as the current
+              time.
 
     Returns:
       The overhead, that is, time spent in total but not in any sub timer.  This
       may be negative if time was counted in two sub timers.  Avoid this by
       always using stop_others.
     """
-    total = self.timervalue('total', now)
-    if total == 0.0:
+    now = self._clock() if now_ns is None else now_ns
+    total = self._timervalue_ns('total', now)
+    if total == 0:
       return 0.0
 
-    all_timers = sum(self.accum.values())
-    return total - (all_timers - total)
+    total *= self._scale('total')
+    all_timers = sum(value * self._scale(name)
+                     for name, value in self.accum.items())
+    return (total - (all_timers - total)) / _NANOS_PER_SECOND
+
+  def _scale(self, timer):
+    """Return the factor to scale a timer's sampled time up by."""
+    stats = self._sampling_stats.get(timer)
+    if not stats:
+      return 1.0
+    if not stats[1]:
+      # No sampled start since the last snapshot, but maybe the tail of one
+      # that was running then.
+      return float(self._sampling_rates.get(timer, 1))
+    return stats[0] / float(stats[1])
+
+  def sampling_error(self, timer):
+    """Estimate the standard error of a sampled timer's scaled-up total.
+
+    The error is estimated from the spread of the sampled durations, with the
+    finite population correction for the starts that were not sampled.
+
+    Args:
+      timer: str; the name of the timer to report on.
+
+    Returns:
+      The standard error, in seconds, of the time results() reports for the
+      timer, or None if it is not sampled or has fewer than two samples.
+    """
+    stats = self._sampling_stats.get(timer)
+    if not stats or stats[2] < 2:
+      return None
+    starts, unused_sampled, samples, total, squares = stats
+    variance = max(0.0, (squares - total * total / float(samples)) /
+                   (samples - 1))
+    correction = max(0.0, 1 - samples / float(starts))
+    return (starts * math.sqrt(variance / samples * correction) /
+            _NANOS_PER_SECOND)
 
   def results(self, verbose=False):
     """Get the results of this stopwatch.
@@ -162,9 +982,11 @@ class StopWatch(object):
     Returns:
       A list of tuples showing the output of this stopwatch, of the form
       (name, value, num_starts) for each timer.  Note that if the total timer
-      is not used, non-verbose results will be the empty list.
+      is not used, non-verbose results will be the empty list.  For sampled
+      timers, value is the estimated total time and num_starts the number of
+      starts, sampled or not.
     """
-    now = time.time()
+    now = self._clock()
 
     all_names = list(self.accum.keys())
     names = []
@@ -175,30 +997,983 @@ class StopWatch(object):
     if verbose:
       names = all_names
 
-    results = [(name, self.timervalue(name, now=now), self.counters[name])
-               for name in names]
     if verbose:
-      results.append(('overhead', self.overhead(now=now), 1))
+      results = [self._result(name, now) for name in names]
+      results.append(('overhead', self.overhead(now_ns=now), 1))
+    else:
+      results = []
     if 'total' in self.accum or 'total' in self.timers:
-      results.append(('total', self.timervalue('total', now=now),
-                      self.counters['total']))
+      results.append(self._result('total', now))
+    return results
+
+  def _result(self, timer, now):
+    """Return the (name, value, num_starts) results() tuple of a timer."""
+    stats = self._sampling_stats.get(timer)
+    if stats:
+      return (timer, self.timervalue(timer, now_ns=now) * self._scale(timer),
+              stats[0])
+    return (timer, self.timervalue(timer, now_ns=now),
+            self.counters.get(timer, 0))
+
+  def _span_totals(self, now):
+    """Return a copy of the recorded spans, including the ones still open.
+
+    Args:
+      now: int; clock reading, in nanoseconds, to close open spans at.
+
+    Returns:
+      A map of span path -> [inclusive nanoseconds, number of times entered].
+    """
+    spans = dict((path, list(span)) for path, span in list(self._spans.items()))
+    if self._paused_at is not None and now > self._paused_at:
+      now = self._paused_at
+    for unused_timer, path, start in list(self._span_stack):
+      span = spans.setdefault(path, [0, 0])
+      span[0] += now - start
+      span[1] += 1
+    return spans
+
+  def merge(self, other):
+    """Add the timings recorded by another stopwatch to this one.
+
+    Timers still running in other contribute the time they have seen so far,
+    but are not left running in this stopwatch.  The histograms and call tree
+    of other are merged too, even if this stopwatch does not record its own.
+
+    Args:
+      other: StopWatch; the stopwatch to merge in.  It is only read, so it may
+             belong to another thread.
+    """
+    # pylint: disable=protected-access
+    with other._exclusive():
+      now = other._clock()
+      # The running timers of a paused stopwatch have only seen the time up to
+      # pause(), and have been suspended since.
+      paused_at = other._paused_at
+      end = now if paused_at is None else min(now, paused_at)
+      accum = dict(other.accum)
+      suspended = dict(other.suspended)
+      for name, start in other.timers.items():
+        accum[name] = accum.get(name, 0) + end - start
+        if end < now:
+          suspended[name] = suspended.get(name, 0) + now - end
+      counters = dict(other.counters)
+      sampling_stats = [(name, list(stats))
+                        for name, stats in other._sampling_stats.items()]
+      memory = [(name, tuple(totals))
+                for name, totals in other._memory.items()]
+      cpu = dict(other._cpu)
+      sampling_rates = dict(other._sampling_rates)
+      histograms = None
+      if other._histograms is not None:
+        histograms = []
+        for name, histogram in other._histograms.items():
+          copy = Histogram(histogram._precision_bits)
+          copy.merge(histogram)
+          histograms.append((name, copy))
+      spans = None
+      if other._spans is not None:
+        spans = other._span_totals(now)
+
+    with self._exclusive():
+      for name, value in accum.items():
+        self.accum[name] = self.accum.get(name, 0) + value
+      for name, count in counters.items():
+        self.counters[name] = self.counters.get(name, 0) + count
+      for name, value in suspended.items():
+        self.suspended[name] = self.suspended.get(name, 0) + value
+      for name, stats in sampling_stats:
+        mine = self._sampling_stats.setdefault(name, [0, 0, 0, 0, 0])
+        for i, value in enumerate(stats):
+          mine[i] += value
+      for name, (allocated, peak, gc_count) in memory:
+        mine = self._memory.setdefault(name, [0, 0, 0])
+        mine[0] += allocated
+        mine[1] = max(mine[1], peak)
+        mine[2] += gc_count
+      for name, value in cpu.items():
+        self._cpu[name] = self._cpu.get(name, 0) + value
+      for name, one_in in sampling_rates.items():
+        self._sampling_rates.setdefault(name, one_in)
+      if histograms is not None:
+        if self._histograms is None:
+          self._histograms = {}
+        for name, histogram in histograms:
+          self._histograms.setdefault(name, Histogram()).merge(histogram)
+      if spans is not None:
+        if self._spans is None:
+          self._spans = {}
+        for path, (inclusive, num_starts) in spans.items():
+          span = self._spans.setdefault(path, [0, 0])
+          span[0] += inclusive
+          span[1] += num_starts
+
+  def snapshot(self):
+    """Move everything recorded so far into a new StopWatch.
+
+    This stopwatch is reset, so successive snapshots hold the time recorded
+    between them rather than cumulative totals.  Running timers and open spans
+    keep running: the time they have seen so far goes into the snapshot, and
+    only the rest is counted when they are stopped.  Their starts are counted
+    in the snapshot they were started in, and a histogram sample is recorded
+    in the snapshot it ends in.  If the stopwatch is paused, the time its
+    timers have been suspended so far goes into the snapshot too.
+
+    It may be taken from another thread: the state is swapped for fresh dicts
+    once the thread doing the timing is between two steps, and that thread
+    only waits if it starts or stops a timer during the swap.
+
+    Returns:
+      A StopWatch with no running timers.
+    """
+    result = StopWatch(clock=self._clock, nested=self._nested,
+                       histograms=self._keep_histograms,
+                       sampling=self._sampling,
+                       random_sampling=self._random_sampling,
+                       track_memory=self._track_memory,
+                       track_cpu=self._track_cpu, cpu_clock=self._cpu_clock)
+    result._sampling_rates = dict(self._sampling_rates)
+    with self._exclusive():
+      now = self._clock()
+      if self._paused_at is not None:
+        # Resuming and pausing again puts the time suspended so far into the
+        # snapshot, and leaves it out of the running timers.
+        self._resume(now)
+        self._pause(now)
+      # New totals start at minus the time running timers have already seen,
+      # so the stop() that adds their whole interval only counts the part
+      # after now.
+      carry = dict((name, now - start)
+                   for name, start in list(self.timers.items()))
+      accum, self.accum = self.accum, dict(
+          (name, -value) for name, value in carry.items())
+      result.counters, self.counters = self.counters, {}
+      result.suspended, self.suspended = self.suspended, {}
+      # A sampled timer that is running gets an entry here, for its stop() to
+      # record the sample in.
+      result._sampling_stats, self._sampling_stats = self._sampling_stats, dict(
+          (name, [0, 0, 0, 0, 0]) for name in self._marks
+          if name in self._sampling_stats)
+      result._memory, self._memory = self._memory, {}
+      result._cpu, self._cpu = self._cpu, {}
+      for name, value in carry.items():
+        accum[name] = accum.get(name, 0) + value
+      result.accum = accum
+
+      if self._histograms is not None:
+        result._histograms, self._histograms = self._histograms, {}
+      if self._marks:
+        self._marks = dict((name, mark - accum.get(name, 0))
+                           for name, mark in list(self._marks.items()))
+
+      if self._spans is not None:
+        carry = dict((path, now - start)
+                     for unused_timer, path, start in list(self._span_stack))
+        spans, self._spans = self._spans, dict(
+            (path, [-value, 0]) for path, value in carry.items())
+        for path, value in carry.items():
+          spans.setdefault(path, [0, 0])[0] += value
+        result._spans = spans
+    return result
+
+  def serialize(self):
+    """Encode what this stopwatch has recorded as a compact string of bytes.
+
+    Running timers contribute the time they have seen so far.  The encoding is
+    zlib-compressed JSON, so it can be sent between processes or stored, and
+    decoded with StopWatch.deserialize() for merging.
+
+    Returns:
+      A bytes object.
+    """
+    frozen = StopWatch(nested=self._nested, histograms=self._keep_histograms)
+    frozen.merge(self)
+    # pylint: disable=protected-access
+    state = {'accum': frozen.accum, 'counters': frozen.counters}
+    if frozen.suspended:
+      state['suspended'] = frozen.suspended
+    if frozen._sampling_stats:
+      state['sampling'] = frozen._sampling_stats
+    if frozen._sampling_rates:
+      state['sampling_rates'] = frozen._sampling_rates
+    if frozen._memory:
+      state['memory'] = frozen._memory
+    if frozen._cpu:
+      state['cpu'] = frozen._cpu
+    if frozen._histograms is not None:
+      state['histograms'] = dict(
+          (name, histogram._state())
+          for name, histogram in frozen._histograms.items())
+    if frozen._spans is not None:
+      state['spans'] = [[list(path), inclusive, num_starts]
+                        for path, (inclusive, num_starts)
+                        in frozen._spans.items()]
+    return zlib.compress(
+        json.dumps(state, separators=(',', ':')).encode('utf-8'))
+
+  @classmethod
+  def deserialize(cls, data):
+    """Decode the output of serialize().
+
+    Args:
+      data: bytes; the output of StopWatch.serialize().
+
+    Returns:
+      A new StopWatch, with no running timers, holding what was recorded.  It is
+      nested, and keeps histograms, if the serialized stopwatch did.
+    """
+    state = json.loads(zlib.decompress(data).decode('utf-8'))
+    # pylint: disable=protected-access
+    result = cls(nested='spans' in state, histograms='histograms' in state)
+    result.accum = state['accum']
+    result.counters = state['counters']
+    result.suspended = state.get('suspended', {})
+    result._sampling_stats = state.get('sampling', {})
+    result._sampling_rates = state.get('sampling_rates', {})
+    result._memory = state.get('memory', {})
+    result._cpu = state.get('cpu', {})
+    if 'histograms' in state:
+      result._histograms = dict(
+          (name, Histogram._from_state(histogram))
+          for name, histogram in state['histograms'].items())
+    if 'spans' in state:
+      result._spans = dict((tuple(path), [inclusive, num_starts])
+                           for path, inclusive, num_starts in state['spans'])
+    return result
+
+  def histogram(self, timer='total'):
+    """Get the distribution of the time taken by each use of a timer.
+
+    Args:
+      timer: str; the name of the timer to report on.
+
+    Returns:
+      A Histogram of the nanoseconds between each start() of the timer and the
+      matching stop(), excluding time it spent stopped on behalf of other
+      timers, or None if the timer has never been stopped.
+
+    Raises:
+      RuntimeError: if the stopwatch was not created with histograms=True.
+    """
+    if self._histograms is None:
+      raise RuntimeError('Histograms require StopWatch(histograms=True)')
+    return self._histograms.get(timer)
+
+  def tree(self, *, now_ns=None):
+    """Get the call tree recorded by a nested stopwatch.
+
+    Args:
+      now_ns: (optional) clock reading, in nanoseconds, to use as the current
+              time for spans that are still running.
+
+    Returns:
+      A list of tuples of the form (path, inclusive, exclusive, num_starts),
+      one per node in depth-first order with siblings sorted by name.  path is
+      a tuple of timer names from the outermost timer down to this node;
+      inclusive is the time, in seconds, spent inside the node and exclusive is
+      that time minus the time spent in its children.
+
+    Raises:
+      RuntimeError: if the stopwatch was not created with nested=True.
+    """
+    if self._spans is None:
+      raise RuntimeError('Call tree requires StopWatch(nested=True)')
+    now = self._clock() if now_ns is None else now_ns
+
+    spans = self._span_totals(now)
+    children = {}
+    for path in spans:
+      children.setdefault(path[:-1], []).append(path)
+
+    results = []
+    pending = sorted(children.get((), []), reverse=True)
+    while pending:
+      path = pending.pop()
+      inclusive, num_starts = spans[path]
+      kids = sorted(children.get(path, []), reverse=True)
+      exclusive = inclusive - sum(spans[kid][0] for kid in kids)
+      results.append((path, inclusive / _NANOS_PER_SECOND,
+                      exclusive / _NANOS_PER_SECOND, num_starts))
+      pending.extend(kids)
     return results
 
-  def dump(self, verbose=False):
+  def _percentiles(self, timer):
+    """Return (p50, p90, p99, max) of a timer in seconds, or None."""
+    histogram = self._histograms and self._histograms.get(timer)
+    if not histogram:
+      return None
+    return tuple(value / _NANOS_PER_SECOND for value in (
+        histogram.percentile(50), histogram.percentile(90),
+        histogram.percentile(99), histogram.max))
+
+  def dump(self, verbose=False, output_format='text'):
     """Describes where time in this stopwatch was spent.
 
+    In nested mode the text format shows the timers as a call tree, with the
+    inclusive and exclusive time of each node.
+
     Args:
-      verbose: bool; if True, show all timers; otherwise, show only the total.
+      verbose: bool; if True, show all timers; otherwise, show only the total
+               (or, in nested mode, only the outermost timers).
+      output_format: str; one of 'text' (for people), 'json', 'csv',
+                     'prometheus' (the Prometheus text exposition format) or
+                     'chrome' (Chrome trace-event JSON, for chrome://tracing).
 
     Returns:
       A string describing the stopwatch.
+
+    Raises:
+      ValueError: if output_format is not known.
+    """
+    try:
+      formatter = _FORMATTERS[output_format]
+    except KeyError:
+      raise ValueError('Unknown output format: %s' % output_format)
+    return formatter(self, verbose)
+
+
+class _ShardedStopWatch(_TimerMixin):
+  """Base class for stopwatches made of many StopWatch shards.
+
+  start() and stop() go to the shard returned by _get(), which subclasses
+  implement; reporting merges all the shards into one StopWatch.  Subclasses
+  _retire() the shards that are no longer used, merging them into a single
+  one, so memory does not grow with the number of shards ever made.
+  """
+
+  def __init__(self, **kwargs):
+    """Initializes the stopwatch.
+
+    Args:
+      **kwargs: options for the shards; see StopWatch.
     """
-    output = io.StringIO()
-    results = self.results(verbose=verbose)
-    maxlength = max([len(result[0]) for result in results])
-    for result in results:
-      output.write('%*s: %6.2fs\n' % (maxlength, result[0], result[1]))
+    self._kwargs = kwargs
+    self._timer_cache = functools.lru_cache(maxsize=_TIMER_CACHE_SIZE)(
+        self._new_timer)
+    self._lock = threading.Lock()
+    self._stopwatches = set()
+    self._finished = StopWatch(**kwargs)
+    self._local = threading.local()
+
+  def _get(self):
+    """Return the shard for the caller, creating it if needed."""
+    raise NotImplementedError('method must be implemented by a subclass.')
+
+  def _thread_shard(self):
+    """Return the shard of the calling thread, creating it if needed."""
+    try:
+      return self._local.shard.stopwatch
+    except AttributeError:
+      stopwatch = self._new_shard()
+      self._local.shard = _ThreadShard(stopwatch)
+      # The thread-local storage is the only reference to the _ThreadShard,
+      # and it is cleared when the thread exits.
+      weakref.finalize(self._local.shard, self._retire, stopwatch)
+      return stopwatch
+
+  def _new_shard(self):
+    """Create and register a new shard."""
+    stopwatch = StopWatch(**self._kwargs)
+    with self._lock:
+      self._stopwatches.add(stopwatch)
+    return stopwatch
+
+  def _retire(self, stopwatch):
+    """Merge a shard that is no longer used into the retired shards' one."""
+    with self._lock:
+      self._stopwatches.discard(stopwatch)
+      self._finished.merge(stopwatch)
+
+  def _shards(self):
+    """Return a list of all the shards, including the retired shards' one.
+
+    The caller must hold self._lock until it is done reading the shards, or a
+    shard retired meanwhile would be read twice: on its own and in the
+    retired shards' one.
+    """
+    return list(self._stopwatches) + [self._finished]
+
+  def start(self, timer='total', stop_others=True):
+    """Start a timer in the caller's shard; see StopWatch.start."""
+    self._get().start(timer, stop_others)
+
+  def stop(self, timer='total'):
+    """Stop a timer in the caller's shard; see StopWatch.stop."""
+    self._get().stop(timer)
+
+  def timervalue(self, timer='total', *, now_ns=None):
+    """Return the value seen by a timer of the caller's shard, in seconds."""
+    return self._get().timervalue(timer, now_ns=now_ns)
+
+  def merged(self):
+    """Return a new StopWatch holding the timings of every shard."""
+    result = StopWatch(**self._kwargs)
+    with self._lock:
+      for stopwatch in self._shards():
+        result.merge(stopwatch)
+    return result
+
+  def results(self, verbose=False):
+    """Get the results merged across shards; see StopWatch.results."""
+    return self.merged().results(verbose)
+
+  def snapshot(self):
+    """Move everything recorded by all shards into a new StopWatch.
+
+    See StopWatch.snapshot; every shard is reset.
+
+    Returns:
+      A StopWatch with no running timers.
+    """
+    result = StopWatch(**self._kwargs)
+    with self._lock:
+      for stopwatch in self._shards():
+        result.merge(stopwatch.snapshot())
+    return result
+
+  def histogram(self, timer='total'):
+    """Get a histogram merged across shards; see StopWatch.histogram."""
+    return self.merged().histogram(timer)
+
+  def tree(self):
+    """Get the call tree merged across shards; see StopWatch.tree."""
+    return self.merged().tree()
+
+  def dump(self, verbose=False, output_format='text'):
+    """Describe where time was spent in all shards; see StopWatch.dump."""
+    return self.merged().dump(verbose, output_format)
+
+  def serialize(self):
+    """Encode what all shards recorded; see StopWatch.serialize."""
+    return self.merged().serialize()
+
+
+class _ThreadShard(object):
+  """Holds the StopWatch of a thread in a ThreadLocalStopWatch."""
+
+  __slots__ = ('stopwatch', '__weakref__')
+
+  def __init__(self, stopwatch):
+    self.stopwatch = stopwatch
+
+
+class ThreadLocalStopWatch(_ShardedStopWatch):
+  """A stopwatch that keeps separate timers for every thread.
+
+  start() and stop() work on a StopWatch private to the calling thread, so
+  threads cannot stop each other's timers, and they take no lock: reporting
+  waits for the thread's current start() or stop() instead, and that thread
+  only takes the shard's lock while a report is reading it.  When a thread
+  exits its StopWatch is merged into a single StopWatch for exited threads,
+  so memory does not grow with the number of threads.  Reporting merges the
+  stopwatches of every thread that has used this one, including those that
+  have since exited, into a single StopWatch.
+
+  Usage:
+
+  sw = ThreadLocalStopWatch()
+
+  def Worker():
+    sw.start('rpc')
+    DoRpc()
+    sw.stop('rpc')
+
+  ... run Worker in many threads ...
+  print(sw.dump(verbose=True))
+  """
+
+  def _get(self):
+    """Return the StopWatch of the calling thread, creating it if needed."""
+    return self._thread_shard()
+
+
+def _CurrentTask():
+  """Return the running asyncio task, or None outside of one."""
+  try:
+    return asyncio.current_task()
+  except RuntimeError:
+    # No running event loop.
+    return None
+
+
+class _SuspendAwareCoroutine(collections.abc.Coroutine):
+  """Coroutine wrapper that pauses a task's timers while it is suspended.
+
+  asyncio runs a task by calling send() or throw() on its coroutine until the
+  coroutine next yields, i.e. suspends at an await.  Wrapping those calls lets
+  the task's StopWatch be resumed for each step and paused in between.
+  """
+
+  def __init__(self, stopwatch, coro):
+    self._stopwatch = stopwatch
+    self._coro = coro
+
+  def _step(self, method, *args):
+    shard = self._stopwatch._current()  # pylint: disable=protected-access
+    if shard is not None:
+      shard.resume()
+    try:
+      return method(*args)
+    finally:
+      # The step may have created the task's StopWatch.
+      shard = self._stopwatch._current()  # pylint: disable=protected-access
+      if shard is not None:
+        shard.pause()
+
+  def send(self, value):
+    return self._step(self._coro.send, value)
+
+  def throw(self, *args):
+    return self._step(self._coro.throw, *args)
+
+  def close(self):
+    return self._coro.close()
+
+  def __await__(self):
+    return self
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return self.send(None)
+
+
+class AsyncStopWatch(_ShardedStopWatch):
+  """A stopwatch that keeps separate timers for every asyncio task.
+
+  The StopWatch of the current task is found through a context variable, so
+  one task starting a timer does not stop another task's timers.  When a task
+  finishes its StopWatch is merged into a single StopWatch for finished tasks,
+  so memory does not grow with the number of tasks.  Outside of any task, each
+  thread gets a StopWatch of its own.
+
+  By default timers keep running while their task is suspended at an await.
+  Tasks created through task_factory(), or coroutines wrapped with
+  instrument(), pause their timers between steps instead: the time a timer
+  spends suspended is left out of its value and reported in the suspended
+  map (and the 'suspended' column of dump()).
+
+  Usage:
+
+  sw = AsyncStopWatch()
+
+  async def Handle(request):
+    with sw.timer('handle'):
+      await Work(request)
+
+  loop.set_task_factory(sw.task_factory)
+  """
+
+  def __init__(self, **kwargs):
+    """Initializes the stopwatch.
+
+    Args:
+      **kwargs: options for the per-task stopwatches; see StopWatch.
+    """
+    super(AsyncStopWatch, self).__init__(**kwargs)
+    # Holds a (task, StopWatch) pair.  Tasks inherit their parent's context,
+    # so the task is checked to tell a task's own entry from an inherited one.
+    self._context = contextvars.ContextVar('stopwatch', default=None)
+
+  def _current(self):
+    """Return the StopWatch of the current task, or None if it has none."""
+    entry = self._context.get()
+    if entry is not None and entry[0] is _CurrentTask():
+      return entry[1]
+    return None
+
+  def _get(self):
+    """Return the StopWatch of the current task, creating it if needed."""
+    task = _CurrentTask()
+    if task is None:
+      # Callbacks run by the event loop outside of tasks each get a copy of
+      # the context, which is thrown away after them, and nothing tells when
+      # the last of them is done, so they share their thread's StopWatch.
+      return self._thread_shard()
+    entry = self._context.get()
+    if entry is not None and entry[0] is task:
+      return entry[1]
+    stopwatch = self._new_shard()
+    self._context.set((task, stopwatch))
+    task.add_done_callback(lambda unused_task: self._retire(stopwatch))
+    return stopwatch
+
+  def instrument(self, coro):
+    """Wrap a coroutine so its task's timers pause while it is suspended.
+
+    Args:
+      coro: coroutine; to be run as a task.
+
+    Returns:
+      A coroutine to pass to asyncio.Task or loop.create_task().
+    """
+    return _SuspendAwareCoroutine(self, coro)
+
+  def task_factory(self, loop, coro, **kwargs):
+    """Task factory that instruments every task; see loop.set_task_factory.
+
+    Args:
+      loop: the event loop creating the task.
+      coro: coroutine; the coroutine the task runs.
+      **kwargs: other arguments for asyncio.Task, such as context.
+
+    Returns:
+      A new asyncio.Task.
+    """
+    return asyncio.Task(self.instrument(coro), loop=loop, **kwargs)
+
+
+class PeriodicReporter(object):
+  """Reports what a stopwatch recorded at a fixed interval.
+
+  A daemon thread takes a snapshot of the stopwatch every interval seconds,
+  resetting it, and passes the formatted snapshot to a sink.  Each report
+  therefore covers only the time since the previous one.  Formatting happens
+  in the reporting thread, and a snapshot only holds the stopwatch's lock while
+  it swaps out the recorded state, so the timed threads are barely held up.
+
+  Usage:
+
+  reporter = PeriodicReporter(stopwatch.sw, 60, sys.stderr.write,
+                              output_format='json')
+  reporter.start()
+  ...
+  reporter.stop()
+  """
+
+  def __init__(self, stopwatch, interval, sink, verbose=True,
+               output_format='text'):
+    """Initializes the reporter.
+
+    Args:
+      stopwatch: StopWatch or ThreadLocalStopWatch; the stopwatch to report on.
+      interval: number; seconds between reports.
+      sink: callable; called with each formatted report, a string.
+      verbose: bool; passed to dump().
+      output_format: str; passed to dump().
+    """
+    self._stopwatch = stopwatch
+    self._interval = interval
+    self._sink = sink
+    self._verbose = verbose
+    self._output_format = output_format
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def start(self):
+    """Start reporting in a background thread, unless it is already running."""
+    if self._thread is not None and self._thread.is_alive():
+      return
+    self._stopped.clear()
+    self._thread = threading.Thread(target=self._run,
+                                    name='stopwatch.PeriodicReporter')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, flush=True):
+    """Stop reporting and wait for the background thread to exit.
+
+    Args:
+      flush: bool; if True, report what was recorded since the last report.
+    """
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    if flush:
+      self.flush()
+
+  def flush(self):
+    """Report, and reset, what was recorded since the last report."""
+    snapshot = self._stopwatch.snapshot()
+    self._sink(snapshot.dump(self._verbose, self._output_format))
+
+  def _run(self):
+    while not self._stopped.wait(self._interval):
+      try:
+        self.flush()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Failed to report stopwatch snapshot')
+
+
+def _InitWorker(queue, initializer, initargs, stopwatch_options):
+  """Set up a Pool worker to send its stopwatch back when it exits."""
+  global sw
+  if stopwatch_options is None:
+    # A forked worker inherits whatever the parent had recorded.
+    sw.reset()
+  else:
+    sw = StopWatch(**stopwatch_options)
+  multiprocessing.util.Finalize(None, _SendWorkerStopWatch, args=(queue,),
+                                exitpriority=10)
+  if initializer is not None:
+    initializer(*initargs)
+
+
+def _SendWorkerStopWatch(queue):
+  """Send what a Pool worker's stopwatch recorded to the parent process."""
+  queue.put(sw.serialize())
+
+
+class Pool(multiprocessing.pool.Pool):
+  """A multiprocessing.pool.Pool that gathers the workers' stopwatches.
+
+  Each worker process starts with the module-level stopwatch sw reset, or
+  replaced by one made with the given StopWatch options.  When the worker
+  exits, it sends what sw recorded back to the parent.  join() merges all of
+  it into a stopwatch in the parent.  Workers only exit cleanly after close(),
+  so call close() and then join().  terminate(), which is also what leaving a
+  with block does, kills the workers before they can report.
+
+  Usage:
+
+  def Work(item):
+    with stopwatch.sw.timer('work'):
+      ...
+
+  pool = stopwatch.Pool(8)
+  pool.map(Work, items)
+  pool.close()
+  pool.join()
+  print(stopwatch.sw.dump(verbose=True))
+  """
+
+  def __init__(self, processes=None, initializer=None, initargs=(),
+               maxtasksperchild=None, context=None, stopwatch=None,
+               stopwatch_options=None):
+    """Initializes the pool.
+
+    Args:
+      processes: see multiprocessing.pool.Pool.
+      initializer: see multiprocessing.pool.Pool.
+      initargs: see multiprocessing.pool.Pool.
+      maxtasksperchild: see multiprocessing.pool.Pool.
+      context: see multiprocessing.pool.Pool.
+      stopwatch: StopWatch; where to merge the workers' timings, defaults to
+                 the module-level stopwatch sw.
+      stopwatch_options: dict; keyword arguments of StopWatch, such as
+                         nested=True or histograms=True, for a new sw in each
+                         worker.  Tasks must then use it as stopwatch.sw,
+                         since a name imported from this module still refers
+                         to the old one.  By default the workers keep sw as
+                         it was set up in the parent process.
+    """
+    self._stopwatch = stopwatch
+    self._stopwatch_queue = (context or multiprocessing).SimpleQueue()
+    self._stopwatch_states = []
+    # Read the workers' reports as they arrive, so that a worker never blocks
+    # on a full pipe while join() waits for it to exit.
+    self._stopwatch_reader = threading.Thread(target=self._read_stopwatches)
+    self._stopwatch_reader.daemon = True
+    self._stopwatch_reader.start()
+    super(Pool, self).__init__(
+        processes, _InitWorker,
+        (self._stopwatch_queue, initializer, initargs, stopwatch_options),
+        maxtasksperchild, context)
+
+  def _read_stopwatches(self):
+    while True:
+      state = self._stopwatch_queue.get()
+      if state is None:
+        return
+      self._stopwatch_states.append(state)
+
+  def join(self):
+    """Wait for the workers to exit and merge their stopwatches."""
+    super(Pool, self).join()
+    if self._stopwatch_reader.is_alive():
+      self._stopwatch_queue.put(None)
+      self._stopwatch_reader.join()
+    stopwatch = self._stopwatch or sw
+    for state in self._stopwatch_states:
+      stopwatch.merge(StopWatch.deserialize(state))
+    self._stopwatch_states = []
+
+
+def _DumpText(stopwatch, verbose):
+  """Format a stopwatch as aligned text for people to read."""
+  output = io.StringIO()
+  # pylint: disable=protected-access
+  if stopwatch._spans is not None:
+    nodes = [node for node in stopwatch.tree() if verbose or len(node[0]) == 1]
+    labels = ['  ' * (len(node[0]) - 1) + node[0][-1] for node in nodes]
+    maxlength = max([len(label) for label in labels] + [0])
+    for label, (unused_path, inclusive, exclusive, num_starts) in zip(
+        labels, nodes):
+      output.write('%-*s: %6.2fs %6.2fs self %6d calls\n' %
+                   (maxlength, label, inclusive, exclusive, num_starts))
     return output.getvalue()
+  results = stopwatch.results(verbose=verbose)
+  maxlength = max([len(result[0]) for result in results] + [0])
+  for result in results:
+    output.write('%*s: %6.2fs' % (maxlength, result[0], result[1]))
+    percentiles = stopwatch._percentiles(result[0])
+    if percentiles:
+      output.write('  p50 %.3gs p90 %.3gs p99 %.3gs max %.3gs' % percentiles)
+    ratio = stopwatch.cpu_ratio(result[0])
+    if ratio is not None:
+      output.write('  cpu %.2fs (%3.0f%%)' % (ratio * result[1], ratio * 100))
+    memory = stopwatch.memory(result[0])
+    if memory:
+      output.write('  alloc %s peak %s gc %d' % (
+          humanize.BinaryPrefix(memory[0], 'B'),
+          humanize.BinaryPrefix(memory[1], 'B'), memory[2]))
+    error = stopwatch.sampling_error(result[0])
+    if error is not None:
+      output.write('  sampled +/-%.2fs' % error)
+    suspended = stopwatch.suspended.get(result[0])
+    if suspended:
+      output.write('  suspended %.2fs' % (suspended / _NANOS_PER_SECOND))
+    output.write('\n')
+  return output.getvalue()
+
+
+def _DumpJson(stopwatch, verbose):
+  """Format a stopwatch as a JSON object.
+
+  The object has a "timers" list with the name, seconds and count of every
+  result, plus p50, p90, p99 and max when histograms are kept, cpu_seconds and
+  cpu_ratio when CPU time is tracked, allocated_bytes, peak_bytes and
+  gc_collections when memory is tracked, sampling_error for sampled timers and
+  suspended for timers that were paused while running.
+  In nested mode there is also a "tree" list with the path, inclusive,
+  exclusive and count of every node.
+  """
+  # pylint: disable=protected-access
+  timers = []
+  for name, value, num_starts in stopwatch.results(verbose=verbose):
+    timer = {'name': name, 'seconds': value, 'count': num_starts}
+    percentiles = stopwatch._percentiles(name)
+    if percentiles:
+      timer.update(zip(('p50', 'p90', 'p99', 'max'), percentiles))
+    ratio = stopwatch.cpu_ratio(name)
+    if ratio is not None:
+      timer['cpu_seconds'] = stopwatch.cpu(name)
+      timer['cpu_ratio'] = ratio
+    memory = stopwatch.memory(name)
+    if memory:
+      timer.update(zip(('allocated_bytes', 'peak_bytes', 'gc_collections'),
+                       memory))
+    error = stopwatch.sampling_error(name)
+    if error is not None:
+      timer['sampling_error'] = error
+    if stopwatch.suspended.get(name):
+      timer['suspended'] = stopwatch.suspended[name] / _NANOS_PER_SECOND
+    timers.append(timer)
+  output = {'timers': timers}
+  if stopwatch._spans is not None:
+    output['tree'] = [
+        {'path': list(path), 'inclusive': inclusive, 'exclusive': exclusive,
+         'count': num_starts}
+        for path, inclusive, exclusive, num_starts in stopwatch.tree()]
+  return json.dumps(output, sort_keys=True)
+
+
+def _DumpCsv(stopwatch, verbose):
+  """Format a stopwatch as CSV with a name,seconds,count,... header row."""
+  # pylint: disable=protected-access
+  output = io.StringIO()
+  writer = csv.writer(output, lineterminator='\n')
+  writer.writerow(['name', 'seconds', 'count', 'p50', 'p90', 'p99', 'max'])
+  for name, value, num_starts in stopwatch.results(verbose=verbose):
+    percentiles = stopwatch._percentiles(name)
+    if percentiles:
+      percentiles = [repr(value) for value in percentiles]
+    else:
+      percentiles = ['', '', '', '']
+    writer.writerow([name, repr(value), num_starts] + percentiles)
+  return output.getvalue()
+
+
+def _PrometheusLabel(value):
+  """Escape a string for use as a Prometheus label value."""
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _DumpPrometheus(stopwatch, verbose):
+  """Format a stopwatch in the Prometheus text exposition format.
+
+  Every result becomes a stopwatch_seconds and a stopwatch_starts gauge labeled
+  with the timer name.  Timers with a histogram are also exported as a
+  stopwatch_latency_seconds summary with 0.5, 0.9 and 0.99 quantiles.
+  """
+  results = stopwatch.results(verbose=verbose)
+  lines = ['# HELP stopwatch_seconds Time spent in each timer.',
+           '# TYPE stopwatch_seconds gauge']
+  for name, value, unused_num_starts in results:
+    lines.append('stopwatch_seconds{timer="%s"} %r' %
+                 (_PrometheusLabel(name), value))
+  lines.extend(['# HELP stopwatch_starts Number of times each timer started.',
+                '# TYPE stopwatch_starts gauge'])
+  for name, unused_value, num_starts in results:
+    lines.append('stopwatch_starts{timer="%s"} %d' %
+                 (_PrometheusLabel(name), num_starts))
+  # pylint: disable=protected-access
+  summaries = []
+  for name, unused_value, unused_num_starts in results:
+    histogram = stopwatch._histograms and stopwatch._histograms.get(name)
+    if not histogram:
+      continue
+    label = _PrometheusLabel(name)
+    p50, p90, p99, unused_max = stopwatch._percentiles(name)
+    for quantile, value in (('0.5', p50), ('0.9', p90), ('0.99', p99)):
+      summaries.append('stopwatch_latency_seconds{timer="%s",quantile="%s"} %r'
+                       % (label, quantile, value))
+    summaries.append('stopwatch_latency_seconds_sum{timer="%s"} %r' %
+                     (label, histogram.total / _NANOS_PER_SECOND))
+    summaries.append('stopwatch_latency_seconds_count{timer="%s"} %d' %
+                     (label, histogram.count))
+  if summaries:
+    lines.extend(['# HELP stopwatch_latency_seconds Time taken by each use of '
+                  'a timer.', '# TYPE stopwatch_latency_seconds summary'])
+    lines.extend(summaries)
+  return '\n'.join(lines) + '\n'
+
+
+def _DumpChromeTrace(stopwatch, verbose):
+  """Format a stopwatch as Chrome trace-event JSON.
+
+  Only totals are kept, so the events are synthesized: in nested mode every
+  node of the call tree becomes a complete event, with children laid out one
+  after the other inside their parent; otherwise every result becomes a
+  complete event starting at zero on its own row.
+  """
+  events = []
+  # pylint: disable=protected-access
+  if stopwatch._spans is not None:
+    # Map of path -> start of the next child, in microseconds.
+    offsets = {(): 0.0}
+    for path, inclusive, unused_exclusive, num_starts in stopwatch.tree():
+      if not verbose and len(path) > 1:
+        continue
+      start = offsets[path[:-1]]
+      duration = inclusive * 1e6
+      offsets[path[:-1]] = start + duration
+      offsets[path] = start
+      events.append({'name': path[-1], 'ph': 'X', 'pid': 0, 'tid': 0,
+                     'ts': start, 'dur': duration,
+                     'args': {'count': num_starts}})
+  else:
+    for tid, (name, value, num_starts) in enumerate(
+        stopwatch.results(verbose=verbose)):
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid,
+                     'args': {'name': name}})
+      events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': tid, 'ts': 0,
+                     'dur': max(0.0, value * 1e6),
+                     'args': {'count': num_starts}})
+  return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                    sort_keys=True)
+
+
+_FORMATTERS = {
+    'text': _DumpText,
+    'json': _DumpJson,
+    'csv': _DumpCsv,
+    'prometheus': _DumpPrometheus,
+    'chrome': _DumpChromeTrace,
+}
+
 
 # Create a stopwatch to be publicly used.
 sw = StopWatch()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timing harness used by the *_benchmark.py scripts."""
+
+
+
+import sys
+import timeit
+
+
+def NanosPerCall(function, number):
+  """Return the best time of a few runs of function, in ns per call."""
+  return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e9
+
+
+def Run(benchmarks, columns, number=100000, output=sys.stdout):
+  """Run benchmarks and print a table of their timings.
+
+  Args:
+    benchmarks: list of (name, function, baseline) tuples, where baseline is
+      a function doing the same work to compare with, or None.
+    columns: pair of the headings for the function and baseline timings.
+    number: number of calls of each function per timing run.
+    output: file to print the table to.
+  """
+  width = max([len('benchmark')] + [len(name) for name, _, _ in benchmarks])
+  output.write('%-*s %12s %12s\n' % ((width, 'benchmark') + tuple(columns)))
+  for name, function, baseline in benchmarks:
+    line = '%-*s %9.0f ns' % (width, name, NanosPerCall(function, number))
+    if baseline is not None:
+      line += ' %9.0f ns' % NanosPerCall(baseline, number)
+    output.write(line + '\n')
+
+
+def Main(benchmarks, columns, argv):
+  """Run benchmarks, with the number of calls per run from argv if given."""
+  Run(benchmarks, columns, int(argv[1]) if len(argv) > 1 else 100000)
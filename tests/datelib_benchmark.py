@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for Timestamp arithmetic and construction in datelib.py.
+
+Usage: datelib_benchmark.py [number of calls per benchmark]
+
+Prints the time per call of every benchmark, next to the time of the same
+operation on a plain datetime where there is one, so that the overhead of the
+Timestamp wrapper stands out.
+"""
+
+
+
+import datetime
+import sys
+
+import pytz
+
+import benchmark_util
+from google.apputils import datelib
+
+_TS = datelib.Timestamp(2013, 1, 5, 13, 0, 0, 0, pytz.utc)
+_PACIFIC_TS = datelib.US_PACIFIC.localize(datelib.Timestamp(2013, 1, 5, 13))
+_PLAIN = datetime.datetime(2013, 1, 5, 13, 0, 0, 0, pytz.utc)
+_DELTA = datetime.timedelta(seconds=1)
+_MICROS = 1357390800123456
+
+# (name, Timestamp operation, equivalent plain datetime operation or None)
+BENCHMARKS = [
+    ('timestamp + timedelta', lambda: _TS + _DELTA, lambda: _PLAIN + _DELTA),
+    ('timedelta + timestamp', lambda: _DELTA + _TS, lambda: _DELTA + _PLAIN),
+    ('timestamp - timedelta', lambda: _TS - _DELTA, lambda: _PLAIN - _DELTA),
+    ('timestamp - timestamp', lambda: _TS - _TS, lambda: _PLAIN - _PLAIN),
+    ('astimezone', lambda: _TS.astimezone(datelib.US_PACIFIC),
+     lambda: _PLAIN.astimezone(datelib.US_PACIFIC)),
+    ('now', datelib.Timestamp.now, datetime.datetime.now),
+    ('utcnow', datelib.Timestamp.utcnow,
+     lambda: datetime.datetime.now(pytz.utc)),
+    ('fromtimestamp', lambda: datelib.Timestamp.fromtimestamp(1e9),
+     lambda: datetime.datetime.fromtimestamp(1e9)),
+    ('FromMicroTimestamp',
+     lambda: datelib.Timestamp.FromMicroTimestamp(_MICROS), None),
+    ('AsMicroTimestamp (UTC)', _TS.AsMicroTimestamp,
+     lambda: datelib.DatetimeToUTCMicros(_PLAIN)),
+    ('AsMicroTimestamp (US/Pacific)', _PACIFIC_TS.AsMicroTimestamp, None),
+]
+
+
+if __name__ == '__main__':
+  benchmark_util.Main(BENCHMARKS, ('Timestamp', 'datetime'), sys.argv)
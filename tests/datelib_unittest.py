@@ -18,14 +18,27 @@
 
 
 import datetime
+import itertools
+import os
 import random
+import struct
+import subprocess
+import sys
 import time
+import unittest
 
+import dateutil.parser
+import dateutil.tz
 import pytz
 
 from google.apputils import basetest
 from google.apputils import datelib
 
+try:
+  import numpy  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numpy = None
+
 
 class TimestampUnitTest(basetest.TestCase):
   seed = 1979
@@ -85,6 +98,68 @@ class TimestampUnitTest(basetest.TestCase):
           random.randint(0, datelib.MAXIMUM_MICROSECOND_TIMESTAMP),
           random.randint(0, datelib.MAXIMUM_MICROSECOND_TIMESTAMP))
 
+  def testMicroTimestampWithOffset(self):
+    ts = datelib.US_PACIFIC.localize(datelib.Timestamp(2013, 7, 1, 5, 0, 0, 7))
+    self.assertEqual(1372680000000007, ts.AsMicroTimestamp())
+    self.assertEqual(1372680000, ts.AsSecondsSinceEpoch())
+    before_epoch = datelib.Timestamp(1969, 12, 31, 23, 59, 59, 500000)
+    self.assertEqual(-500000, before_epoch.AsMicroTimestamp())
+    self.assertEqual(-1, before_epoch.AsSecondsSinceEpoch())
+
+  def testArithmeticKeepsType(self):
+    a = datelib.Timestamp(2013, 1, 5, 13, 0, 0, 0, pytz.utc)
+    delta = datetime.timedelta(hours=1, microseconds=5)
+    for result in (a + delta, delta + a, a - delta,
+                   a.astimezone(datelib.US_PACIFIC)):
+      self.assertIs(datelib.Timestamp, type(result))
+    self.assertEqual(datetime.datetime(2013, 1, 5, 14, 0, 0, 5, pytz.utc),
+                     a + delta)
+    self.assertIs(pytz.utc, (a - delta).tzinfo)
+    self.assertEqual(delta, (a + delta) - a)
+
+  def testWrapKeepsFold(self):
+    tz = dateutil.tz.gettz('America/Los_Angeles')
+    # 1:30 happened twice on 2013-11-03; fold=1 is the second time, in PST.
+    second = datetime.datetime(2013, 11, 3, 1, 30, tzinfo=tz, fold=1)
+    stamp = datelib.Timestamp._Wrap(second)
+    self.assertIs(datelib.Timestamp, type(stamp))
+    self.assertEqual(1, stamp.fold)
+    self.assertEqual(datetime.timedelta(hours=-8), stamp.utcoffset())
+    stamp = datelib.Timestamp.fromtimestamp(second.timestamp(), tz)
+    self.assertEqual(1, stamp.fold)
+    self.assertEqual(second.timestamp(), stamp.timestamp())
+
+    class SecondTime(datetime.tzinfo):
+      """Los Angeles, where it is always the second 1:30 of 2013-11-03."""
+
+      def utcoffset(self, dt):
+        return dt.replace(tzinfo=tz).utcoffset()
+
+      def dst(self, dt):
+        return dt.replace(tzinfo=tz).dst()
+
+      def fromutc(self, unused_dt):
+        return second.replace(tzinfo=self)
+
+    stamp = datelib.Timestamp.now(SecondTime())
+    self.assertEqual(1, stamp.fold)
+    self.assertEqual(datetime.timedelta(hours=-8), stamp.utcoffset())
+
+  def testConstructors(self):
+    for ts in (datelib.Timestamp.now(), datelib.Timestamp.today(),
+               datelib.Timestamp.fromtimestamp(1e9)):
+      self.assertIs(datelib.Timestamp, type(ts))
+      self.assertIs(datelib.Timestamp.LocalTimezone, ts.tzinfo)
+    for ts in (datelib.Timestamp.utcnow(),
+               datelib.Timestamp.utcfromtimestamp(1e9 + 0.5),
+               datelib.Timestamp.FromMicroTimestamp(10**15 + 500000)):
+      self.assertIs(datelib.Timestamp, type(ts))
+      self.assertIs(pytz.utc, ts.tzinfo)
+    self.assertEqual(datelib.Timestamp(2001, 9, 9, 1, 46, 40, 500000, pytz.utc),
+                     datelib.Timestamp.utcfromtimestamp(1e9 + 0.5))
+    ts = datelib.Timestamp.fromtimestamp(1e9, datelib.US_PACIFIC)
+    self.assertEqual((2001, 9, 8, 18, 46, 40), ts.timetuple()[:6])
+
   def testCombine(self):
     for tz in (datelib.UTC, datelib.US_PACIFIC):
       self.assertEqual(
@@ -156,6 +231,81 @@ class TimestampUnitTest(basetest.TestCase):
           datelib.Timestamp.FromString(naive_day_str, tz=datelib.US_PACIFIC),
           'FromString localizes time incorrectly')
 
+  def testFromStringIso8601(self):
+    for string in (
+        '2013-01-05',
+        '2013-01-05 13:00',
+        '2013-01-05T13:00:00',
+        '2013-01-05T13:00:00.5',
+        '2013-01-05T13:00:00.123456Z',
+        '2013-01-05T13:00:00-08:00',
+        '2013-01-05T13:00:00+0530',
+        '2013-01-05T13:00:00+00:00',
+        '20130105T130000',
+        '20130105T130000.25-0800',
+        ):
+      # Zero offsets are left to dateutil if the local zone is called UTC.
+      if not string.endswith(('Z', '+00:00')) or 'UTC' not in time.tzname:
+        self.assertIsNotNone(datelib._ParseIso8601(string), string)
+      for testtz in (None, datelib.UTC, datelib.US_PACIFIC):
+        expected = dateutil.parser.parse(string)
+        if not expected.tzinfo:
+          expected = (testtz or datelib.LocalTimezone).localize(expected)
+        actual = datelib.Timestamp.FromString(string, testtz)
+        self.assertIsInstance(actual, datelib.Timestamp)
+        self.assertEqual(expected, actual)
+        self.assertEqual(expected.utcoffset(), actual.utcoffset())
+
+    for string in ('2013-01-05T13:00:00.1234567', '2013-02-30', 'Jan 5 2013',
+                   '2013-01-05T13:00:00 PST', '\u0662013-01-05'):
+      self.assertIsNone(datelib._ParseIso8601(string), string)
+    self.assertEqual(
+        datelib.UTC.localize(datelib.Timestamp(2013, 1, 5, 13, 0, 0, 123456)),
+        datelib.Timestamp.FromString('2013-01-05T13:00:00.1234567',
+                                     datelib.UTC))
+    self.assertRaises(
+        datelib.TimeParseError, datelib.Timestamp.FromString, '2013-02-30')
+
+  def testParseCache(self):
+    self.assertIsNone(datelib.GetParseCacheInfo())
+    datelib.SetParseCacheSize(2)
+    self.addCleanup(datelib.SetParseCacheSize, 0)
+    first = datelib.Timestamp.FromString('2013-01-05 13:00:00', datelib.UTC)
+    self.assertIs(
+        first, datelib.Timestamp.FromString('2013-01-05 13:00:00', datelib.UTC))
+    self.assertEqual(
+        datelib.US_PACIFIC.localize(datelib.Timestamp(2013, 1, 5, 13)),
+        datelib.Timestamp.FromString('2013-01-05 13:00:00',
+                                     datelib.US_PACIFIC))
+    info = datelib.GetParseCacheInfo()
+    self.assertEqual((1, 2, 2, 2), info)
+    self.assertAlmostEqual(1 / 3.0, info.hit_rate)
+
+    # Intervals are relative to the time of the call.
+    earlier = datelib.Timestamp.FromString('1d')
+    time.sleep(0.01)
+    self.assertGreater(datelib.Timestamp.FromString('1d'), earlier)
+
+    # So are strings that dateutil completes with the current date, and
+    # neither is stored nor counted.
+    info = datelib.GetParseCacheInfo()
+    for string in ('13:00', 'Friday', '5', 'Jan 5 13:00', '2013'):
+      self.assertIsNot(datelib.Timestamp.FromString(string, datelib.UTC),
+                       datelib.Timestamp.FromString(string, datelib.UTC),
+                       string)
+    self.assertEqual(info, datelib.GetParseCacheInfo())
+    for string in ('2013/1/5', '05/Jan/2013 13:00:00', 'Jan 5th, 2013',
+                   '5 January 2013', '20130105T130000'):
+      self.assertIs(datelib.Timestamp.FromString(string, datelib.UTC),
+                    datelib.Timestamp.FromString(string, datelib.UTC), string)
+    self.assertIs(datelib.Timestamp.FromString('Jan 5 2013 13:00', datelib.UTC),
+                  datelib.Timestamp.FromString('Jan 5 2013 13:00', datelib.UTC))
+
+    datelib.SetParseCacheSize(0)
+    self.assertIsNone(datelib.GetParseCacheInfo())
+    self.assertIsNot(
+        first, datelib.Timestamp.FromString('2013-01-05 13:00:00', datelib.UTC))
+
   def testFromStringInterval(self):
     expected_date = datetime.datetime.utcnow() - datetime.timedelta(days=1)
     expected_s = time.mktime(expected_date.utctimetuple())
@@ -166,6 +316,128 @@ class TimestampUnitTest(basetest.TestCase):
     self.assertRaises(
         datelib.TimeParseError, datelib.Timestamp.FromString, 'wat')
 
+  def testFromStringIntervalGrammar(self):
+    # dateutil would read these as times of day.
+    for interval, seconds in (('30m', 1800), ('1.5h', 5400),
+                              ('1h 30m', 5400), ('-1h', -3600)):
+      expected = datelib.Timestamp.utcnow() - datetime.timedelta(
+          seconds=seconds)
+      actual = datelib.Timestamp.FromString(interval)
+      self.assertBetween(
+          (actual - expected).total_seconds(), 0, 1, interval)
+    self.assertEqual(2013, datelib.Timestamp.FromString('2013').year)
+
+
+class ConvertIntervalToSecondsUnitTest(basetest.TestCase):
+
+  def testIntervals(self):
+    for interval, seconds in (('', 0),
+                              ('90', 90),
+                              ('1d', 86400),
+                              ('1d2h', 93600),
+                              ('3M1Y', 39312000),
+                              ('1h 30m', 5400),
+                              (' +2W ', 1209600),
+                              ('-1d', -86400),
+                              ('1h -30m', 1800)):
+      result = datelib.ConvertIntervalToSeconds(interval)
+      self.assertEqual(seconds, result, interval)
+      self.assertIsInstance(result, int)
+
+  def testFractions(self):
+    self.assertEqual(5400.0, datelib.ConvertIntervalToSeconds('1.5h'))
+    self.assertEqual(30.0, datelib.ConvertIntervalToSeconds('.5m'))
+    self.assertEqual(-0.25, datelib.ConvertIntervalToSeconds('-0.25'))
+
+  def testInvalid(self):
+    for interval in ('1x', 'abc', ' ', '1d-', '1..5h', 'h', '1 d',
+                     '2013-02-30'):
+      self.assertIsNone(datelib.ConvertIntervalToSeconds(interval), interval)
+
+  def testCached(self):
+    datelib.ConvertIntervalToSeconds('17m')
+    hits = datelib._ParseInterval.cache_info().hits
+    self.assertEqual(1020, datelib.ConvertIntervalToSeconds('17m'))
+    self.assertEqual(hits + 1, datelib._ParseInterval.cache_info().hits)
+
+
+def _SetTimezone(tz):
+  if tz is None:
+    os.environ.pop('TZ', None)
+  else:
+    os.environ['TZ'] = tz
+  time.tzset()
+  datelib.LocalTimezoneClass._transitions = None
+
+
+class ParseTimestampsUnitTest(basetest.TestCase):
+
+  def testIso8601(self):
+    lines = ['2013-01-05T13:00:%02dZ' % i for i in range(60)]
+    self.assertEqual([datelib.Timestamp.FromString(line) for line in lines],
+                     list(datelib.ParseTimestamps(iter(lines))))
+
+  def testDominantFormat(self):
+    lines = ['2013/01/05 13:00:%02d' % i for i in range(5)]
+    lines += ['2013-01-05T13:00:05', 'bogus', '01/05/2013 13:00:06']
+    result = datelib.ParseTimestamps(lines, tz=datelib.UTC, sample_size=3)
+    self.assertEqual(
+        [datelib.UTC.localize(datelib.Timestamp(2013, 1, 5, 13, 0, i))
+         for i in range(6)],
+        list(itertools.islice(result, 6)))
+    self.assertRaises(datelib.TimeParseError, next, result)
+
+  def testErrorsNone(self):
+    lines = ['2013-01-05T13:00:00Z', 'bogus', '2013-01-05T13:00:01Z']
+    self.assertEqual(
+        [datelib.Timestamp.FromString(lines[0]), None,
+         datelib.Timestamp.FromString(lines[2])],
+        list(datelib.ParseTimestamps(lines, errors='none')))
+    self.assertRaises(ValueError, list,
+                      datelib.ParseTimestamps(lines, errors='ignore'))
+
+  def testExtract(self):
+    lines = ['127.0.0.1 - - [05/Jan/2013:13:00:00 -0800] "GET / HTTP/1.0" 200',
+             'no timestamp here']
+    expected = datelib.Timestamp.FromString('2013-01-05T13:00:00-08:00')
+    self.assertEqual(
+        [expected, None],
+        list(datelib.ParseTimestamps(lines, extract=r'\[([^]]+)\]')))
+    self.assertEqual(
+        [expected.AsMicroTimestamp(), None],
+        list(datelib.ParseTimestamps(
+            lines, extract=lambda line: line[15:41] if '[' in line else None,
+            micros=True)))
+    self.assertEqual(
+        [datelib.US_PACIFIC.localize(datelib.Timestamp(2013, 1, 5, 13)), None],
+        list(datelib.ParseTimestamps(
+            ['INFO 2013-01-05T13:00:00 started', 'INFO'], extract=1,
+            tz=datelib.US_PACIFIC)))
+
+  def testZeroOffsetOnUTCHost(self):
+    original_tz = os.environ.get('TZ')
+    self.addCleanup(_SetTimezone, original_tz)
+    _SetTimezone('UTC')
+    lines = ['127.0.0.1 - - [05/Jan/2013:13:00:00 +0000] "GET / HTTP/1.0" 200']
+    self.assertEqual(
+        [datelib.UTC.localize(datelib.Timestamp(2013, 1, 5, 13))],
+        list(datelib.ParseTimestamps(lines, extract=r'\[([^\]]+)\]')))
+
+  def testNoIntervals(self):
+    for string in ('1d', '3W', '1Y'):
+      result = datelib.ParseTimestamps(['2013-01-05T13:00:00Z', string])
+      next(result)
+      self.assertRaises(datelib.TimeParseError, next, result)
+
+  def testCustomFormat(self):
+    self.assertEqual(
+        [datelib.UTC.localize(datelib.Timestamp(2013, 1, 5, 13, 0, 0, 500000))],
+        list(datelib.ParseTimestamps(['05.01.2013 13h00m00.5s'],
+                                     tz=datelib.UTC,
+                                     formats=['%d.%m.%Y %Hh%Mm%S.%fs'])))
+    self.assertRaises(ValueError, list,
+                      datelib.ParseTimestamps([], formats=['%Y-%j']))
+
 
 def _EpochToDatetime(t, tz=None):
   if tz is not None:
@@ -234,6 +506,383 @@ class DatetimeConversionUnitTest(basetest.TestCase):
                      datelib.UTCMillisToDatetime(0, tz=self.utc))
 
 
+class BulkConversionUnitTest(basetest.TestCase):
+
+  def setUp(self):
+    self.pst = pytz.timezone('US/Pacific')
+    # Includes values far enough from the epoch for the float conversion of
+    # UTCMicrosToDatetime to round them.
+    self.micros = [0, -1, 1, 1500000, -999999, 2 ** 57] + [
+        random.randint(-2 ** 55, 2 ** 57) for _ in range(1000)]
+
+  def testUTCMicrosToDatetimes(self):
+    self.assertEqual([datelib.UTCMicrosToDatetime(m) for m in self.micros],
+                     datelib.UTCMicrosToDatetimes(self.micros))
+    self.assertEqual(
+        [datelib.UTCMicrosToDatetime(m, tz=self.pst) for m in self.micros],
+        datelib.UTCMicrosToDatetimes(self.micros, tz=self.pst))
+    self.assertEqual([], datelib.UTCMicrosToDatetimes([]))
+
+  def testUTCMicrosToDatetimesOutOfRange(self):
+    self.assertRaises(ValueError, datelib.UTCMicrosToDatetimes, [2 ** 63])
+
+  def testDatetimesToUTCMicros(self):
+    dates = datelib.UTCMicrosToDatetimes(self.micros)
+    dates += [self.pst.localize(dt) for dt in dates if 1900 < dt.year < 2100]
+    dates += [datelib.Timestamp.FromMicroTimestamp(m) for m in self.micros]
+    self.assertEqual([datelib.DatetimeToUTCMicros(dt) for dt in dates],
+                     datelib.DatetimesToUTCMicros(dates))
+
+  @unittest.skipIf(numpy is None, 'NumPy is not installed')
+  def testNumpyArrays(self):
+    micros = numpy.array(self.micros, dtype=numpy.int64)
+    stamps = datelib.UTCMicrosToDatetimes(micros)
+    self.assertEqual('datetime64[us]', stamps.dtype)
+    self.assertEqual([datelib.UTCMicrosToDatetime(m) for m in self.micros],
+                     stamps.tolist())
+    self.assertEqual(
+        [datelib.UTCMicrosToDatetime(m, tz=self.pst) for m in self.micros],
+        datelib.UTCMicrosToDatetimes(micros, tz=self.pst))
+    result = datelib.DatetimesToUTCMicros(stamps)
+    self.assertEqual(numpy.int64, result.dtype)
+    self.assertEqual(
+        [datelib.DatetimeToUTCMicros(dt) for dt in stamps.tolist()],
+        result.tolist())
+    objects = numpy.array(stamps.tolist(), dtype=object)
+    self.assertEqual(result.tolist(),
+                     datelib.DatetimesToUTCMicros(objects).tolist())
+
+  def testNumpyNotImportedByModule(self):
+    code = ('import sys; from google.apputils import datelib; '
+            'datelib.DatetimesToUTCMicros([]); '
+            'sys.exit("numpy" in sys.modules)')
+    self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
+
+class TimestampArrayUnitTest(basetest.TestCase):
+
+  def setUp(self):
+    self.timestamps = [
+        datelib.Timestamp(2013, 1, 5, 13, 0, i, 250, datelib.UTC)
+        for i in (30, 10, 20, 0)]
+    self.array = datelib.TimestampArray.FromDatetimes(self.timestamps)
+
+  def testSequence(self):
+    self.assertEqual(4, len(self.array))
+    self.assertEqual(8, self.array.micros.itemsize)
+    self.assertEqual(self.timestamps, list(self.array))
+    self.assertIsInstance(self.array[0], datelib.Timestamp)
+    self.assertEqual(self.timestamps[-1], self.array[-1])
+    self.assertEqual(datelib.TimestampArray.FromDatetimes(self.timestamps[1:3]),
+                     self.array[1:3])
+    self.assertEqual(
+        [ts.AsMicroTimestamp() for ts in self.timestamps],
+        list(self.array.micros))
+
+    self.array.append(self.timestamps[0].replace(tzinfo=None))
+    self.array.extend([0])
+    self.assertEqual(self.timestamps[0], self.array[4])
+    self.assertEqual(datelib.Timestamp(1970, 1, 1, tzinfo=datelib.UTC),
+                     self.array[5])
+
+  def testTimezone(self):
+    pacific = datelib.TimestampArray(self.array.micros, datelib.US_PACIFIC)
+    self.assertEqual(self.timestamps[0], pacific[0])
+    self.assertEqual('PST', pacific[0].tzname())
+    self.assertEqual('PST', pacific[1:][0].tzname())
+
+  def testSortAndBetween(self):
+    self.array.sort()
+    self.assertEqual(sorted(self.timestamps), list(self.array))
+    self.assertEqual(
+        sorted(self.timestamps)[1:3],
+        list(self.array.Between(self.timestamps[1], self.timestamps[0])))
+    self.assertEqual(sorted(self.timestamps)[:3],
+                     list(self.array.Between(end=self.timestamps[0])))
+    self.assertEqual(
+        [], list(self.array.Between(self.array.micros[-1] + 1)))
+    self.array.sort(reverse=True)
+    self.assertEqual(sorted(self.timestamps, reverse=True), list(self.array))
+
+  def testArithmetic(self):
+    delta = datetime.timedelta(hours=1, microseconds=1)
+    self.assertEqual([ts + delta for ts in self.timestamps],
+                     list(self.array + delta))
+    self.assertEqual([ts - delta for ts in self.timestamps],
+                     list(self.array - delta))
+    self.assertEqual(self.array + delta, self.array.Shift(3600000001))
+    self.assertRaises(TypeError, self.array.Shift, 1.5)
+    self.assertRaises(OverflowError, self.array.Shift, 2 ** 63 - 1)
+    self.assertRaises(OverflowError, self.array.Shift(-3 * 2 ** 61).Shift,
+                      -3 * 2 ** 61)
+
+  @unittest.skipIf(numpy is None, 'NumPy is not installed')
+  def testNumpy(self):
+    micros = self.array.AsNumpy()
+    self.assertEqual(list(self.array.micros), micros.tolist())
+    self.assertEqual(self.array, datelib.TimestampArray(micros))
+
+
+class TruncateUTCMicrosUnitTest(basetest.TestCase):
+
+  def _Micros(self, tz, *args):
+    return datelib.DatetimeToUTCMicros(tz.localize(datetime.datetime(*args)))
+
+  def _Check(self, unit, expected, value, tz=datelib.US_PACIFIC, step=1):
+    expected = self._Micros(tz, *expected)
+    value = self._Micros(tz, *value)
+    self.assertEqual([expected],
+                     datelib.TruncateUTCMicros([value], unit, tz, step))
+    if numpy is not None:
+      self.assertEqual([expected], datelib.TruncateUTCMicros(
+          numpy.array([value]), unit, tz, step).tolist())
+
+  def testUnits(self):
+    value = (2013, 8, 14, 13, 47, 22, 5)
+    self._Check('second', (2013, 8, 14, 13, 47, 22), value)
+    self._Check('minute', (2013, 8, 14, 13, 47), value)
+    self._Check('minute', (2013, 8, 14, 13, 45), value, step=15)
+    self._Check('hour', (2013, 8, 14, 13), value)
+    self._Check('day', (2013, 8, 14), value)
+    self._Check('week', (2013, 8, 12), value)
+    self._Check('month', (2013, 8, 1), value)
+    self._Check('month', (2013, 7, 1), value, step=3)
+    self._Check('year', (2013, 1, 1), value)
+    self._Check('year', (2010, 1, 1), value, step=10)
+    self._Check('day', (1969, 12, 31), (1969, 12, 31, 23), tz=datelib.UTC)
+    self._Check('month', (1600, 2, 1), (1600, 2, 29, 23), tz=datelib.UTC)
+    self._Check('hour', (2013, 8, 14, 13), value,
+                tz=pytz.timezone('Asia/Kolkata'))
+
+  def testDst(self):
+    # The day DST ends has 25 hours.
+    self._Check('day', (2013, 11, 3), (2013, 11, 3, 23))
+    start = self._Micros(datelib.US_PACIFIC, 2013, 11, 3, 1)
+    hour = 3600 * 1000000
+    self.assertEqual(
+        [start, start + hour],
+        datelib.TruncateUTCMicros([start + 10, start + hour + 10], 'hour',
+                                  datelib.US_PACIFIC))
+    # There was no midnight when DST started in Sao Paulo in 2013.
+    sao_paulo = pytz.timezone('America/Sao_Paulo')
+    self._Check('day', (2013, 10, 20, 1), (2013, 10, 20, 12), tz=sao_paulo)
+
+  def testOtherTimezones(self):
+    value = self._Micros(datelib.US_PACIFIC, 2013, 8, 14, 13, 47)
+    expected = self._Micros(datelib.US_PACIFIC, 2013, 8, 14)
+    self.assertEqual([expected], datelib.TruncateUTCMicros(
+        [value], 'day', dateutil.tz.gettz('America/Los_Angeles')))
+    self.assertEqual([expected], datelib.TruncateUTCMicros(
+        [value], 'day', pytz.FixedOffset(-7 * 60)))
+
+  @unittest.skipIf(numpy is None, 'NumPy is not installed')
+  def testOtherTimezonesNumpy(self):
+    value = self._Micros(datelib.US_PACIFIC, 2013, 8, 14, 13, 47)
+    expected = self._Micros(datelib.US_PACIFIC, 2013, 8, 14)
+    tz = dateutil.tz.gettz('America/Los_Angeles')
+    result = datelib.TruncateUTCMicros(numpy.array([value]), 'day', tz)
+    self.assertEqual(numpy.int64, result.dtype)
+    self.assertEqual([expected], result.tolist())
+    timestamps = datelib.TimestampArray([value], tz=tz)
+    self.assertEqual([expected], list(timestamps.Truncate('day').micros))
+
+  def testInvalid(self):
+    self.assertRaises(ValueError, datelib.TruncateUTCMicros, [0], 'fortnight')
+    self.assertRaises(ValueError, datelib.TruncateUTCMicros, [0], 'day',
+                      step=0)
+
+  def testTimestampArray(self):
+    timestamps = datelib.TimestampArray(
+        [self._Micros(datelib.US_PACIFIC, 2013, 8, 14, 13, 47)],
+        tz=datelib.US_PACIFIC)
+    truncated = timestamps.Truncate('day')
+    self.assertEqual(datelib.US_PACIFIC, truncated.tz)
+    self.assertEqual(
+        datelib.US_PACIFIC.localize(datelib.Timestamp(2013, 8, 14)),
+        truncated[0])
+    timestamps.append(0)
+
+
+_LOS_ANGELES_TZFILE = '/usr/share/zoneinfo/America/Los_Angeles'
+# America/Los_Angeles as written by "zic -b slim": the table ends in 2007, and
+# the rules since are only in the POSIX TZ string at the end.
+_LOS_ANGELES_SLIM_TZFILE = os.path.join(os.path.dirname(__file__), 'data',
+                                        'Los_Angeles_slim')
+
+
+@unittest.skipIf(not os.path.exists(_LOS_ANGELES_TZFILE),
+                 'No zoneinfo for America/Los_Angeles')
+class LocalTimezoneUnitTest(basetest.TestCase):
+
+  def setUp(self):
+    original_tz = os.environ.get('TZ')
+    self.addCleanup(_SetTimezone, original_tz)
+    _SetTimezone(_LOS_ANGELES_TZFILE)
+
+  def testIsDst(self):
+    local = datelib.LocalTimezone
+    self.assertFalse(local._isdst(datetime.datetime(2013, 1, 5, 13)))
+    self.assertTrue(local._isdst(datetime.datetime(2013, 7, 5, 13)))
+    # The hour skipped when DST starts, and the one repeated when it ends.
+    self.assertTrue(local._isdst(datetime.datetime(2013, 3, 10, 2, 30)))
+    self.assertTrue(local._isdst(datetime.datetime(2013, 3, 10, 3)))
+    self.assertTrue(local._isdst(datetime.datetime(2013, 11, 3, 0, 59, 59)))
+    self.assertTrue(local._isdst(datetime.datetime(2013, 11, 3, 1, 30)))
+    self.assertFalse(local._isdst(datetime.datetime(2013, 11, 3, 1, 30,
+                                                    fold=1)))
+    self.assertFalse(local._isdst(datetime.datetime(2013, 11, 3, 2)))
+    self.assertTrue(datelib.LocalTimezoneClass._transitions[0])
+
+  def testMatchesMktime(self):
+    local = datelib.LocalTimezone
+    dt = datetime.datetime(1960, 1, 1, 12, 30)
+    # Past the end of the table too, where mktime() is used.
+    while dt.year < 2060:
+      self.assertEqual(local._mktime_isdst(dt), local._isdst(dt), dt)
+      dt += datetime.timedelta(days=3)
+    # Around every transition, including in the hours skipped or repeated.
+    for wall in datelib.LocalTimezoneClass._transitions[0]:
+      for seconds in range(wall - 5400, wall + 5400, 600):
+        dt = datelib._EPOCH + datetime.timedelta(seconds=seconds)
+        if 1960 <= dt.year < 2060:
+          self.assertEqual(local._mktime_isdst(dt), local._isdst(dt), dt)
+
+  def testNoTzfile(self):
+    _SetTimezone('XST5XDT4,M3.2.0,M11.1.0')
+    local = datelib.LocalTimezone
+    self.assertTrue(local._isdst(datetime.datetime(2013, 7, 5, 13)))
+    self.assertEqual(([], [], [False], False),
+                     datelib.LocalTimezoneClass._transitions)
+
+  def testParseTzif(self):
+    with open(_LOS_ANGELES_TZFILE, 'rb') as tzfile:
+      data = tzfile.read()
+    walls, fold_walls, isdst, fixed = datelib._ParseTzif(data)
+    self.assertEqual(len(walls) + 1, len(isdst))
+    self.assertEqual(len(walls), len(fold_walls))
+    self.assertEqual(sorted(walls), walls)
+    self.assertFalse(fixed)
+    self.assertRaises(ValueError, datelib._ParseTzif, b'not a tzfile')
+    self.assertRaises(struct.error, datelib._ParseTzif, data[:100])
+
+  def testSlimTzif(self):
+    _SetTimezone(_LOS_ANGELES_SLIM_TZFILE)
+    local = datelib.LocalTimezone
+    expected = [local._mktime_isdst(datetime.datetime(2025, 1, 1, 12, 30) +
+                                    datetime.timedelta(days=day))
+                for day in range(365)]
+
+    def Fail(dt):
+      self.fail('mktime() used for %s' % dt)
+    local._mktime_isdst = Fail
+    self.addCleanup(delattr, local, '_mktime_isdst')
+    self.assertEqual(expected,
+                     [local._isdst(datetime.datetime(2025, 1, 1, 12, 30) +
+                                   datetime.timedelta(days=day))
+                      for day in range(365)])
+    self.assertFalse(local._isdst(datetime.datetime(2099, 3, 8, 1, 59)))
+    self.assertTrue(local._isdst(datetime.datetime(2099, 3, 8, 3)))
+
+  def testExpandPosixTz(self):
+    # Sydney: DST from the first Sunday of October to that of April, 3:00.
+    transitions = datelib._ExpandPosixTz('AEST-10AEDT,M10.1.0,M4.1.0/3',
+                                         2025, 2025)
+    self.assertEqual(
+        [(datelib.GetSecondsSinceEpoch((2025, 4, 5, 16, 0, 0)), 36000, False),
+         (datelib.GetSecondsSinceEpoch((2025, 10, 4, 16, 0, 0)), 39600,
+          True)],
+        transitions)
+    self.assertEqual(
+        datelib.GetSecondsSinceEpoch((2024, 3, 1, 2, 0, 0)),
+        datelib._ExpandPosixTz('<+00>0<+01>,J60,300', 2024, 2024)[0][0])
+    self.assertIsNone(datelib._ExpandPosixTz('EST5', 2025, 2025))
+    self.assertIsNone(datelib._ExpandPosixTz('EST5EDT,M13.1.0,M1.1.0', 2025,
+                                             2025))
+
+
+class _FakeLoop(object):
+  """Records call_later calls instead of running an event loop."""
+
+  def __init__(self):
+    self.calls = []
+
+  def call_later(self, delay, callback):
+    self.calls.append((delay, callback))
+
+
+class CoarseClockUnitTest(basetest.TestCase):
+
+  def setUp(self):
+    self.now = 1357390800.25
+    self.clock = datelib.CoarseClock(timer=lambda: self.now)
+    self.addCleanup(datelib.SetCoarseClock, None)
+
+  def testUpdate(self):
+    self.assertEqual(1357390800250000, self.clock.micros)
+    self.now += 1.5
+    self.assertEqual(1357390800250000, self.clock.micros)
+    self.clock.Update()
+    self.assertEqual(1357390801750000, self.clock.micros)
+    self.assertEqual(self.now, self.clock.time)
+    self.assertEqual((self.now, 1357390801750000), self.clock.reading)
+
+  def testNow(self):
+    utc = self.clock.Now(datelib.Timestamp, utc=True)
+    self.assertEqual(datelib.Timestamp.FromMicroTimestamp(1357390800250000),
+                     utc)
+    self.assertIs(utc, self.clock.Now(datelib.Timestamp, utc=True))
+    local = self.clock.Now(datelib.Timestamp)
+    self.assertEqual(datelib.Timestamp.fromtimestamp(self.now), local)
+    self.assertIs(datelib.Timestamp.LocalTimezone, local.tzinfo)
+    self.now += 1
+    self.clock.Update()
+    self.assertEqual(utc + datetime.timedelta(seconds=1),
+                     self.clock.Now(datelib.Timestamp, utc=True))
+
+  def testSetCoarseClock(self):
+    self.assertIsNone(datelib.GetCoarseClock())
+    datelib.SetCoarseClock(self.clock)
+    self.assertIs(self.clock, datelib.GetCoarseClock())
+    self.assertEqual(1357390800250000, datelib._GetCurrentTimeMicros())
+    self.assertEqual(self.clock.Now(datelib.Timestamp, utc=True),
+                     datelib.Timestamp.utcnow())
+    self.assertIs(datelib.Timestamp, type(datelib.Timestamp.now()))
+    self.assertEqual(datelib.Timestamp.now(), datelib.Timestamp.utcnow())
+    self.assertEqual(datelib.Timestamp.now(), datelib.Timestamp.today())
+    # An explicit timezone still reads the system time.
+    self.assertLess(datelib.Timestamp.utcnow(),
+                    datelib.Timestamp.now(datelib.UTC))
+    datelib.SetCoarseClock(None)
+    self.assertLess(1357390800250000, datelib._GetCurrentTimeMicros())
+
+  def testStartStop(self):
+    self.clock.resolution = 0.0001
+    with self.clock:
+      self.now += 1
+      deadline = time.time() + 10
+      while self.clock.time != self.now and time.time() < deadline:
+        time.sleep(0.001)
+    self.assertEqual(self.now, self.clock.time)
+    self.now += 1
+    time.sleep(0.01)
+    self.assertNotEqual(self.now, self.clock.time)
+
+  def testScheduleOn(self):
+    loop = _FakeLoop()
+    self.clock.ScheduleOn(loop)
+    delay, tick = loop.calls.pop()
+    self.assertEqual(self.clock.resolution, delay)
+    self.now += 1
+    tick()
+    self.assertEqual(self.now, self.clock.time)
+    self.assertEqual(1, len(loop.calls))
+    self.clock.Stop()
+    self.now += 1
+    loop.calls.pop()[1]()
+    self.assertNotEqual(self.now, self.clock.time)
+    self.assertFalse(loop.calls)
+
+
 class MicrosecondsToSecondsUnitTest(basetest.TestCase):
 
   def testConversionFromMicrosecondsToSeconds(self):
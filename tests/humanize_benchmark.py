@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the prefix selection of humanize.py.
+
+Usage: humanize_benchmark.py [number of calls per benchmark]
+
+Prints the time per call of humanize._Scale, next to the time of the linear
+search over the prefixes that it replaced, for quantities in the middle and at
+the ends of the range of prefixes.
+"""
+
+
+
+import functools
+import sys
+
+import benchmark_util
+from google.apputils import humanize
+
+
+def _LinearScale(quantity, unit, multiplier, prefixes=None, min_scale=None):
+  """The former humanize._Scale, which tries every prefix in turn."""
+  if (not prefixes or not quantity or quantity != quantity or
+      quantity in [float('inf'), float('-inf')]):
+    return float(quantity), unit
+
+  if min_scale is None:
+    min_scale = 0
+    prefixes = ('',) + tuple(prefixes)
+  value, prefix = quantity, ''
+  for power, prefix in enumerate(prefixes, min_scale):
+    value = float(quantity) * multiplier ** -power
+    if abs(value) < multiplier:
+      break
+  return value, prefix + unit
+
+
+# (name, quantity, multiplier, prefixes, min_scale)
+_CASES = [
+    ('decimal 576012', 576012, 1000, humanize.DECIMAL_PREFIXES[8:], 0),
+    ('decimal 999.95', 999.95, 1000, humanize.DECIMAL_PREFIXES[8:], 0),
+    ('decimal 6e27', 6e27, 1000, humanize.DECIMAL_PREFIXES[8:], 0),
+    ('decimal 1e-30', 1e-30, 1000, humanize.DECIMAL_PREFIXES,
+     humanize.DECIMAL_MIN_SCALE),
+    ('decimal 3e20, unbounded', 3e20, 1000, humanize.DECIMAL_PREFIXES,
+     humanize.DECIMAL_MIN_SCALE),
+    ('binary 1024', 1024, 1024, humanize.BINARY_PREFIXES, None),
+    ('binary 2**36', 2**36, 1024, humanize.BINARY_PREFIXES, None),
+    ('binary 2**96', 2**96, 1024, humanize.BINARY_PREFIXES, None),
+]
+
+# (name, humanize._Scale call, linear search call)
+BENCHMARKS = [
+    (case[0], functools.partial(humanize._Scale, case[1], 'B', *case[2:]),
+     functools.partial(_LinearScale, case[1], 'B', *case[2:]))
+    for case in _CASES]
+
+
+if __name__ == '__main__':
+  for name, scale, linear in BENCHMARKS:
+    assert scale() == linear(), name
+  benchmark_util.Main(BENCHMARKS, ('_Scale', 'linear'), sys.argv)
@@ -6,10 +6,19 @@
 
 
 import datetime
+import subprocess
+import sys
+import unittest
+
 from google.apputils import basetest
 from google.apputils import datelib
 from google.apputils import humanize
 
+try:
+  import numpy  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numpy = None
+
 
 class HumanizeTest(basetest.TestCase):
 
@@ -157,6 +166,90 @@ class HumanizeTest(basetest.TestCase):
     self.assertAlmostEqual(value, 2.728, 3)
     self.assertEqual(unit, 'TiB')
 
+  def testScaleBoundaries(self):
+    self.assertEqual((1.0, 'KiB'), humanize.BinaryScale(1024, 'B'))
+    self.assertEqual((1023.0, 'B'), humanize.BinaryScale(1023, 'B'))
+    self.assertEqual((1.0, 'MiB'), humanize.BinaryScale(1024**2, 'B'))
+    self.assertEqual((1023.999, 'KiB'),
+                     humanize.BinaryScale(1023.999 * 1024, 'B'))
+    self.assertEqual((999.95, ''), humanize.DecimalScale(999.95, ''))
+    self.assertEqual((1.0, 'k'), humanize.DecimalScale(1000, ''))
+    self.assertEqual((999.999999, 'M'), humanize.DecimalScale(999999999, ''))
+    self.assertEqual((1.0, 'G'), humanize.DecimalScale(1e9, ''))
+    self.assertEqual((1.0, 'm'), humanize.DecimalScale(0.001, '',
+                                                       min_scale=None))
+    self.assertEqual((999.0, 'y'), humanize.DecimalScale(999e-24, '',
+                                                         min_scale=None))
+    self.assertEqual('y', humanize.DecimalScale(1e-30, '', min_scale=None)[1])
+    self.assertEqual('Y', humanize.DecimalScale(6e27, '')[1])
+    self.assertEqual((65536.0, 'Yi'), humanize.BinaryScale(2**96, ''))
+    self.assertEqual((-1.0, 'Ki'), humanize.BinaryScale(-1024, ''))
+    # Every quantity gets the first prefix that brings it below the multiplier,
+    # whatever the rounding of its logarithm.
+    for power in range(-9, 10):
+      for quantity in (1000.0 ** power, 999.95 * 1000.0 ** power,
+                       999.9999999999 * 1000.0 ** power, 1024.0 ** power):
+        for prefix_power, prefix in enumerate(humanize.DECIMAL_PREFIXES,
+                                              humanize.DECIMAL_MIN_SCALE):
+          value = quantity * 1000 ** -prefix_power
+          if abs(value) < 1000:
+            break
+        self.assertEqual((value, prefix),
+                         humanize.DecimalScale(quantity, '', min_scale=None))
+
+  # Boundaries and special values of DecimalPrefix and BinaryPrefix.
+  PREFIX_QUANTITIES = [
+      0, 1, -1, 12, 999, 999.95, 999.9999999, 1000, -1000, 1023, 1024, 1280,
+      12100, 1150000, 10e9, -10e9, 2**36, 2**96, 6e27, 0.0000013, 0.005, 5e-7,
+      1e-30, float('nan'), float('inf'), float('-inf')]
+
+  def testDecimalPrefixes(self):
+    self.assertEqual(['576 kbps', '2 Mbps'],
+                     humanize.DecimalPrefixes([576012, 1574215], 'bps'))
+    self.assertEqual([], humanize.DecimalPrefixes([], 'bps'))
+    for kwargs in ({}, {'precision': 3}, {'min_scale': None},
+                   {'max_scale': 4}, {'min_scale': -1, 'precision': 2},
+                   {'min_scale': None, 'max_scale': -1}, {'min_scale': 1},
+                   {'min_scale': 3, 'max_scale': 1}):
+      for unit in ('m', ''):
+        self.assertEqual(
+            [humanize.DecimalPrefix(quantity, unit, **kwargs)
+             for quantity in self.PREFIX_QUANTITIES],
+            humanize.DecimalPrefixes(self.PREFIX_QUANTITIES, unit, **kwargs))
+
+  def testBinaryPrefixes(self):
+    self.assertEqual(['563 KiB', '1 KiB'],
+                     humanize.BinaryPrefixes([576012, 1024], 'B'))
+    for precision in (1, 2, 3):
+      self.assertEqual(
+          [humanize.BinaryPrefix(quantity, 'B', precision)
+           for quantity in self.PREFIX_QUANTITIES],
+          humanize.BinaryPrefixes(self.PREFIX_QUANTITIES, 'B', precision))
+
+  @unittest.skipIf(numpy is None, 'NumPy is not installed')
+  def testPrefixesOfNumpyArrays(self):
+    floats = numpy.array(self.PREFIX_QUANTITIES, numpy.float64)
+    floats = numpy.concatenate([floats, 1000.0 ** numpy.arange(-9, 10),
+                                1024.0 ** numpy.arange(10)])
+    floats = numpy.concatenate([floats, numpy.nextafter(floats, 0)])
+    ints = numpy.array([0, 999, 1000, 1023, 1024, -2**40, 2**62], numpy.int64)
+    for quantities in (floats, ints):
+      for kwargs in ({}, {'min_scale': None}, {'precision': 3}):
+        self.assertEqual(
+            [humanize.DecimalPrefix(quantity, 'B', **kwargs)
+             for quantity in quantities.tolist()],
+            humanize.DecimalPrefixes(quantities, 'B', **kwargs))
+      self.assertEqual(
+          [humanize.BinaryPrefix(quantity, 'B')
+           for quantity in quantities.tolist()],
+          humanize.BinaryPrefixes(quantities, 'B'))
+
+  def testNumpyNotImportedByModule(self):
+    code = ('import sys; from google.apputils import humanize; '
+            'humanize.DecimalPrefixes([1000], "B"); '
+            'sys.exit("numpy" in sys.modules)')
+    self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
   def testPrettyFraction(self):
     # No rounded integer part
     self.assertEqual('½', humanize.PrettyFraction(0.5))
@@ -281,6 +374,17 @@ class NaturalSortKeyChunkingTest(basetest.TestCase):
         humanize.NaturalSortKey('one 11 -- two 44'),
         ['one ', 11, ' -- two ', 44])
 
+  def testChunkifyLeadingDigits(self):
+    self.assertListEqual(humanize.NaturalSortKey('10X a'), ['', 10, 'X a'])
+    self.assertListEqual(humanize.NaturalSortKey('7'), ['', 7])
+    self.assertListEqual(humanize.NaturalSortKey(''), [])
+
+  def testChunkifyTuple(self):
+    self.assertEqual(('a', 1, 'b', 2, 'c', 3, ''),
+                     humanize.NaturalSortTupleKey('a1b2c3'))
+    self.assertEqual(('', 10, 'X a'), humanize.NaturalSortTupleKey('10X a'))
+    self.assertEqual(('',), humanize.NaturalSortTupleKey(''))
+
 
 class NaturalSortKeysortTest(basetest.TestCase):
 
@@ -396,6 +500,41 @@ class NaturalSortKeyBigTest(basetest.TestCase):
         ]
     self.test.sort(key=humanize.NaturalSortKey)
     self.assertListEqual(self.test, self.good)
+    self.assertListEqual(self.good, humanize.NaturalSorted(reversed(self.good)))
+
+
+class NaturalSortedTest(basetest.TestCase):
+
+  def setUp(self):
+    self.good = ['', '0', '1', '1a', '007', '9', '10', '10a', 'a', 'a1',
+                 'a1b', 'a2', 'a10', 'b']
+
+  def testNaturalSorted(self):
+    self.assertListEqual(self.good, humanize.NaturalSorted(self.good[::-1]))
+    self.assertListEqual(self.good[::-1],
+                         humanize.NaturalSorted(self.good, reverse=True))
+    self.assertListEqual(self.good,
+                         sorted(self.good[::-1], key=humanize.NaturalSortKey))
+
+  def testNaturalSortedKey(self):
+    items = [(name, i) for i, name in enumerate(self.good)][::-1]
+    self.assertListEqual(
+        self.good,
+        [name for name, _ in humanize.NaturalSorted(
+            items, key=lambda item: item[0])])
+
+  def testNaturalInsort(self):
+    result = []
+    for name in ('a10', '9', 'a', '10', 'a1b', '', '1', 'a2', 'a1', 'b',
+                 '10a', '1a', '0', '007'):
+      humanize.NaturalInsort(result, name)
+    self.assertListEqual(self.good, result)
+    # Equal items go after the ones already in the list.
+    self.assertEqual(5, humanize.NaturalInsort(result, '07'))
+    self.assertEqual(['007', '07'], result[4:6])
+    items = [('a1', 0), ('a10', 1)]
+    self.assertEqual(1, humanize.NaturalInsort(items, ('a9', 2),
+                                               key=lambda item: item[0]))
 
 
 if __name__ == '__main__':
@@ -17,6 +17,17 @@
 
 __author__ = 'dbentley@google.com (Dan Bentley)'
 
+import asyncio
+import csv
+import gc
+import io
+import json
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
 from google.apputils import basetest
 
 import gflags as flags
@@ -25,6 +36,12 @@ from google.apputils import stopwatch
 FLAGS = flags.FLAGS
 
 
+def _PoolWork(value):
+  with stopwatch.sw.timer('work'):
+    with stopwatch.sw.timer('inner', stop_others=False):
+      return value * 2
+
+
 class StubTime(object):
   """Simple stub replacement for the time module.
 
@@ -34,21 +51,35 @@ class StubTime(object):
 
   def __init__(self):
     self._counter = 0
+    self._cpu_counter = 0
 
-  def time(self):
-    """Get the time for this time object.
+  def perf_counter_ns(self):
+    """Get the time for this time object, in nanoseconds.
 
     A call is always guaranteed to be greater than the previous one.
 
     Returns:
-      A monotonically increasing time.
+      A monotonically increasing integer time.
     """
-    self._counter += 0.0001
+    self._counter += 100000
     return self._counter
 
+  def time(self):
+    """Get the time for this time object, in seconds."""
+    return self.perf_counter_ns() / 1e9
+
   def sleep(self, time):
     """Simulate sleeping for the specified number of seconds."""
-    self._counter += time
+    self._counter += int(time * 1e9)
+
+  def thread_time_ns(self):
+    """Get the CPU time used so far, in nanoseconds."""
+    return self._cpu_counter
+
+  def spin(self, time):
+    """Simulate computing for the specified number of seconds."""
+    self._counter += int(time * 1e9)
+    self._cpu_counter += int(time * 1e9)
 
 
 class StopwatchUnitTest(basetest.TestCase):
@@ -169,6 +200,1038 @@ class StopwatchUnitTest(basetest.TestCase):
     res2 = sw.results(verbose=True)
     self.assertListEqual(res1, res2)
 
+  def testCustomClock(self):
+    ticks = iter([10, 25, 1000])
+    sw = stopwatch.StopWatch(clock=lambda: next(ticks))
+    sw.start('a')
+    sw.stop('a')
+    self.assertIsInstance(sw.accum['a'], int)
+    self.assertEqual(15, sw.accum['a'])
+    sw.start('a')
+    self.assertAlmostEqual(515e-9, sw.timervalue('a', now_ns=1500), 15)
+    # Callers passing the time in seconds, as before, fail loudly.
+    self.assertRaises(TypeError, sw.timervalue, 'a', now=1.5)
+    self.assertRaises(TypeError, sw.timervalue, 'a', 1.5)
+    self.assertRaises(TypeError, sw.overhead, now=1.5)
+
+  def testStopOthersLosesNoTime(self):
+    sw = stopwatch.StopWatch()
+    sw.start('a')
+    self.time.sleep(1)
+    sw.start('b')
+    self.time.sleep(1)
+    sw.stop('b')
+    sw.stop('a')
+    # The nested start and stop read the clock once each, so 'a' and 'b'
+    # together account for all 2s slept plus the three clock ticks between
+    # the outer start and stop.
+    self.assertEqual(2 * 10**9 + 300000, sw.accum['a'] + sw.accum['b'])
+
+  def testNestedTree(self):
+    sw = stopwatch.StopWatch(nested=True)
+    sw.start('request')
+    for _ in range(2):
+      sw.start('db')
+      self.time.sleep(1)
+      sw.stop('db')
+    sw.start('render')
+    sw.start('db')
+    self.time.sleep(1)
+    sw.stop('db')
+    sw.stop('render')
+    self.time.sleep(1)
+    sw.stop('request')
+
+    tree = sw.tree()
+    self.assertListEqual(
+        [('request',), ('request', 'db'), ('request', 'render'),
+         ('request', 'render', 'db')],
+        [node[0] for node in tree])
+    self.assertListEqual([1, 2, 1, 1], [node[3] for node in tree])
+    request, db, render, render_db = tree
+    self.assertAlmostEqual(4, request[1], 2)
+    self.assertAlmostEqual(1, request[2], 2)
+    self.assertAlmostEqual(2, db[1], 2)
+    self.assertAlmostEqual(db[1], db[2])
+    self.assertAlmostEqual(render[1], render_db[1], 2)
+    self.assertAlmostEqual(request[1],
+                           request[2] + db[1] + render[1])
+    # The flat timers still report exclusive time per name.
+    self.assertAlmostEqual(3, sw.timervalue('db'), 2)
+
+    lines = sw.dump(verbose=True).splitlines()
+    self.assertEqual(4, len(lines))
+    self.assertTrue(lines[3].startswith('    db'))
+    self.assertEqual(1, len(sw.dump().splitlines()))
+
+  def testNestedTreeIncludesRunningSpans(self):
+    sw = stopwatch.StopWatch(nested=True)
+    sw.start('a')
+    sw.start('b')
+    self.time.sleep(1)
+    tree = sw.tree()
+    self.assertListEqual([('a',), ('a', 'b')], [node[0] for node in tree])
+    self.assertAlmostEqual(1, tree[1][1], 2)
+
+  def testNestedStopOutOfOrder(self):
+    sw = stopwatch.StopWatch(nested=True)
+    sw.start('a')
+    sw.start('b')
+    self.assertRaises(RuntimeError, sw.stop, 'a')
+    sw.stop('b')
+    sw.stop('a')
+
+  def testTreeRequiresNested(self):
+    self.assertRaises(RuntimeError, stopwatch.StopWatch().tree)
+
+  def testMerge(self):
+    sw1 = stopwatch.StopWatch(nested=True)
+    sw1.start('a')
+    self.time.sleep(1)
+    sw1.stop('a')
+    sw2 = stopwatch.StopWatch(nested=True)
+    sw2.start('a')
+    sw2.start('b')
+    self.time.sleep(2)
+
+    sw1.merge(sw2)
+    self.assertAlmostEqual(1, sw1.timervalue('a'), 2)
+    self.assertAlmostEqual(2, sw1.timervalue('b'), 2)
+    self.assertEqual(2, sw1.counters['a'])
+    self.assertEqual(1, sw1.counters['b'])
+    self.assertDictEqual({}, sw1.timers)
+    self.assertListEqual([(('a',), 2), (('a', 'b'), 1)],
+                         [(node[0], node[3]) for node in sw1.tree()])
+    # Merging only reads the other stopwatch.
+    self.assertItemsEqual(['b'], sw2.timers)
+    sw2.stop('b')
+    sw2.stop('a')
+
+  def testMergeIntoPlainStopWatch(self):
+    sw1 = stopwatch.StopWatch(nested=True, histograms=True)
+    with sw1.timer('a'):
+      with sw1.timer('b', stop_others=False):
+        self.time.sleep(1)
+    merged = stopwatch.StopWatch()
+    merged.merge(sw1)
+    self.assertEqual(1, merged.histogram('a').count)
+    self.assertListEqual([('a',), ('a', 'b')],
+                         [node[0] for node in merged.tree()])
+    # The merged histograms and tree do not make it record its own.
+    with merged.timer('c'):
+      self.time.sleep(1)
+    self.assertIsNone(merged.histogram('c'))
+    self.assertEqual(2, len(merged.tree()))
+
+  def testHistograms(self):
+    sw = stopwatch.StopWatch(histograms=True)
+    sw.start()
+    for seconds in (1, 1, 1, 10):
+      sw.start('a')
+      self.time.sleep(seconds)
+      sw.start('b')
+      self.time.sleep(5)
+      sw.stop('b')
+      sw.stop('a')
+    sw.stop()
+
+    histogram = sw.histogram('a')
+    self.assertEqual(4, histogram.count)
+    # Time spent in 'b' is not part of the samples for 'a'.
+    self.assertAlmostEqual(1, histogram.percentile(50) / 1e9, 1)
+    self.assertAlmostEqual(10, histogram.max / 1e9, 3)
+    self.assertEqual(sw.accum['a'], histogram.total)
+    self.assertEqual(1, sw.histogram().count)
+    self.assertIsNone(sw.histogram('c'))
+    self.assertIn('p99', sw.dump(verbose=True))
+
+  def testHistogramRequiresOption(self):
+    self.assertRaises(RuntimeError, stopwatch.StopWatch().histogram)
+
+  def testTimerContextManager(self):
+    sw = stopwatch.StopWatch()
+    with sw.timer('a'):
+      self.time.sleep(1)
+      with sw.timer('b'):
+        self.time.sleep(1)
+    self.assertDictEqual({}, sw.timers)
+    self.assertAlmostEqual(1, sw.timervalue('a'), 2)
+    self.assertAlmostEqual(1, sw.timervalue('b'), 2)
+    self.assertIs(sw.timer('a'), sw.timer('a'))
+
+  def testTimerCacheIsBounded(self):
+    sw = stopwatch.StopWatch()
+    for i in range(10000):
+      with sw.timer('request %d' % i):
+        pass
+    self.assertEqual(10000, len(sw.counters))
+    self.assertLessEqual(sw._timer_cache.cache_info().currsize,
+                         stopwatch._TIMER_CACHE_SIZE)
+
+  def testTimerStopsOnException(self):
+    sw = stopwatch.StopWatch()
+
+    def Fail():
+      with sw.timer('a'):
+        raise ValueError
+
+    self.assertRaises(ValueError, Fail)
+    self.assertDictEqual({}, sw.timers)
+    self.assertEqual(1, sw.counters['a'])
+
+  def testTimed(self):
+    sw = stopwatch.StopWatch(nested=True)
+
+    @sw.timed()
+    def Inner(value):
+      self.time.sleep(1)
+      if value < 0:
+        raise ValueError(value)
+      return value * 2
+
+    @sw.timed('outer', stop_others=False)
+    def Outer(value):
+      return Inner(value)
+
+    self.assertEqual(4, Outer(2))
+    self.assertEqual('Inner', Inner.__name__)
+    self.assertRaises(ValueError, Outer, -1)
+    self.assertDictEqual({}, sw.timers)
+    self.assertListEqual([(('outer',), 2), (('outer', 'Inner'), 2)],
+                         [(node[0], node[3]) for node in sw.tree()])
+    self.assertAlmostEqual(2, sw.timervalue('Inner'), 2)
+
+  def testTimedRecursion(self):
+    sw = stopwatch.StopWatch(histograms=True)
+
+    @sw.timed('fact')
+    def Fact(n):
+      self.time.sleep(1)
+      return n * Fact(n - 1) if n > 1 else 1
+
+    with sw.timer('request'):
+      self.time.sleep(1)
+      self.assertEqual(6, Fact(3))
+      self.time.sleep(1)
+    self.assertDictEqual({}, sw.timers)
+    self.assertAlmostEqual(3, sw.timervalue('fact'), 2)
+    self.assertAlmostEqual(2, sw.timervalue('request'), 2)
+    self.assertEqual(3, sw.counters['fact'])
+    self.assertEqual(1, sw.histogram('fact').count)
+
+  def _MakeNested(self):
+    sw = stopwatch.StopWatch(nested=True, histograms=True)
+    sw.start()
+    with sw.timer('a'):
+      self.time.sleep(1)
+      with sw.timer('b'):
+        self.time.sleep(2)
+    with sw.timer('c'):
+      self.time.sleep(3)
+    sw.stop()
+    return sw
+
+  def testDumpJson(self):
+    output = json.loads(self._MakeNested().dump(True, output_format='json'))
+    self.assertListEqual(['a', 'b', 'c', 'overhead', 'total'],
+                         [timer['name'] for timer in output['timers']])
+    timer_a = output['timers'][0]
+    # 'a' counts its restart after 'b' stopped.
+    self.assertEqual(2, timer_a['count'])
+    self.assertAlmostEqual(1, timer_a['seconds'], 2)
+    self.assertAlmostEqual(1, timer_a['p99'], 1)
+    self.assertNotIn('p50', output['timers'][3])
+    self.assertListEqual([['total'], ['total', 'a'], ['total', 'a', 'b'],
+                          ['total', 'c']],
+                         [node['path'] for node in output['tree']])
+    self.assertAlmostEqual(3, output['tree'][1]['inclusive'], 2)
+
+  def testDumpCsv(self):
+    rows = list(csv.reader(io.StringIO(
+        self._MakeNested().dump(True, output_format='csv'))))
+    self.assertListEqual(
+        ['name', 'seconds', 'count', 'p50', 'p90', 'p99', 'max'], rows[0])
+    self.assertListEqual(['a', 'b', 'c', 'overhead', 'total'],
+                         [row[0] for row in rows[1:]])
+    self.assertAlmostEqual(3, float(rows[3][1]), 2)
+    self.assertListEqual(['', '', '', ''], rows[4][3:])
+
+  def testDumpPrometheus(self):
+    sw = stopwatch.StopWatch(histograms=True)
+    with sw.timer('say "hi"'):
+      self.time.sleep(1)
+    lines = sw.dump(True, output_format='prometheus').splitlines()
+    self.assertIn('# TYPE stopwatch_seconds gauge', lines)
+    self.assertIn('stopwatch_starts{timer="say \\"hi\\""} 1', lines)
+    self.assertIn('stopwatch_latency_seconds_count{timer="say \\"hi\\""} 1',
+                  lines)
+    for line in lines:
+      if line.startswith('stopwatch_seconds{timer="say'):
+        self.assertAlmostEqual(1, float(line.split()[-1]), 2)
+        break
+    else:
+      self.fail('No stopwatch_seconds sample in %r' % lines)
+
+  def testDumpChromeTrace(self):
+    trace = json.loads(self._MakeNested().dump(True, output_format='chrome'))
+    events = dict((event['name'], event) for event in trace['traceEvents'])
+    self.assertItemsEqual(['total', 'a', 'b', 'c'], events)
+    self.assertEqual(0, events['total']['ts'])
+    self.assertEqual(0, events['a']['ts'])
+    self.assertEqual(0, events['b']['ts'])
+    self.assertEqual(events['a']['dur'], events['c']['ts'])
+    self.assertAlmostEqual(3e6, events['c']['dur'], -3)
+
+    sw = stopwatch.StopWatch()
+    with sw.timer('a'):
+      pass
+    trace = json.loads(sw.dump(True, output_format='chrome'))
+    self.assertListEqual(['M', 'X', 'M', 'X'],
+                         [event['ph'] for event in trace['traceEvents']])
+
+  def testDumpUnknownFormat(self):
+    self.assertRaises(ValueError, self._MakeNested().dump, True, 'xml')
+
+  def testSnapshot(self):
+    sw = stopwatch.StopWatch(nested=True, histograms=True)
+    sw.start()
+    with sw.timer('a'):
+      self.time.sleep(1)
+    sw.start('b')
+    self.time.sleep(2)
+
+    first = sw.snapshot()
+    self.assertDictEqual({}, first.timers)
+    self.assertAlmostEqual(1, first.timervalue('a'), 2)
+    self.assertAlmostEqual(2, first.timervalue('b'), 2)
+    self.assertAlmostEqual(3, first.timervalue(), 2)
+    self.assertEqual(1, first.counters['b'])
+    self.assertEqual(1, first.histogram('a').count)
+    self.assertIsNone(first.histogram('b'))
+    self.assertListEqual([('total',), ('total', 'a'), ('total', 'b')],
+                         [node[0] for node in first.tree()])
+
+    self.time.sleep(4)
+    sw.stop('b')
+    sw.stop()
+    second = sw.snapshot()
+    self.assertAlmostEqual(0, second.timervalue('a'), 2)
+    self.assertAlmostEqual(4, second.timervalue('b'), 2)
+    self.assertAlmostEqual(4, second.timervalue(), 2)
+    self.assertNotIn('b', second.counters)
+    # The sample for 'b' covers its whole run, across both snapshots.
+    self.assertAlmostEqual(6, second.histogram('b').max / 1e9, 2)
+    tree = dict((node[0], node[1:]) for node in second.tree())
+    self.assertAlmostEqual(4, tree[('total', 'b')][0], 2)
+    self.assertEqual(1, tree[('total', 'b')][2])
+
+    third = sw.snapshot()
+    self.assertListEqual([('overhead', 0.0, 1)], third.results(verbose=True))
+
+  def testSnapshotFromAnotherThread(self):
+    self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+    sys.setswitchinterval(1e-6)
+    sw = stopwatch.StopWatch(clock=time.perf_counter_ns, histograms=True,
+                             sampling={'b': 3})
+    errors = []
+    done = threading.Event()
+
+    def Work():
+      try:
+        for _ in range(20000):
+          with sw.timer('a'):
+            with sw.timer('b'):
+              pass
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+      finally:
+        done.set()
+
+    thread = threading.Thread(target=Work)
+    thread.start()
+    snapshots = []
+    while not done.is_set():
+      snapshots.append(sw.snapshot())
+    thread.join()
+    snapshots.append(sw.snapshot())
+
+    self.assertListEqual([], errors)
+    self.assertEqual(20000, sum(snapshot._sampling_stats['b'][0]
+                                for snapshot in snapshots
+                                if 'b' in snapshot._sampling_stats))
+    self.assertEqual(
+        20000, sum(snapshot.histogram('a').count for snapshot in snapshots
+                   if snapshot.histogram('a')))
+    for snapshot in snapshots:
+      for value in snapshot.accum.values():
+        self.assertGreaterEqual(value, 0)
+
+  def testPlainSnapshotFromAnotherThread(self):
+    self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+    sys.setswitchinterval(1e-6)
+    sw = stopwatch.StopWatch(clock=time.perf_counter_ns)
+    sw.start()
+    done = threading.Event()
+
+    def Work():
+      try:
+        for _ in range(20000):
+          sw.start('a')
+          sw.start('b')
+          sw.stop('b')
+          sw.stop('a')
+      finally:
+        done.set()
+
+    thread = threading.Thread(target=Work)
+    thread.start()
+    snapshots = []
+    while not done.is_set():
+      snapshots.append(sw.snapshot())
+    thread.join()
+    snapshots.append(sw.snapshot())
+
+    # 'a' is restarted each time 'b' stops.
+    self.assertEqual(40000, sum(snapshot.counters.get('a', 0)
+                                for snapshot in snapshots))
+    self.assertEqual(20000, sum(snapshot.counters.get('b', 0)
+                                for snapshot in snapshots))
+    for snapshot in snapshots:
+      for value in snapshot.accum.values():
+        self.assertGreaterEqual(value, 0)
+
+  def testPeriodicReporter(self):
+    sw = stopwatch.ThreadLocalStopWatch()
+    reports = []
+    reported = threading.Event()
+
+    def Sink(report):
+      reports.append(json.loads(report))
+      reported.set()
+
+    reporter = stopwatch.PeriodicReporter(sw, 0.01, Sink,
+                                          output_format='json')
+    with sw.timer('a'):
+      self.time.sleep(1)
+    reporter.start()
+    self.assertTrue(reported.wait(10))
+    with sw.timer('a'):
+      self.time.sleep(2)
+    reporter.stop()
+
+    totals = [timer['seconds'] for report in reports
+              for timer in report['timers'] if timer['name'] == 'a']
+    self.assertAlmostEqual(1, totals[0], 2)
+    self.assertAlmostEqual(3, sum(totals), 2)
+    self.assertEqual(0, sw.merged().timervalue('a'))
+
+  def testPeriodicReporterStartTwice(self):
+    reporter = stopwatch.PeriodicReporter(stopwatch.StopWatch(), 60,
+                                          lambda report: None)
+    reporter.start()
+    thread = reporter._thread
+    reporter.start()
+    self.assertIs(thread, reporter._thread)
+    self.assertEqual(1, sum(1 for t in threading.enumerate()
+                            if t.name == 'stopwatch.PeriodicReporter'))
+    reporter.stop()
+    self.assertFalse(thread.is_alive())
+
+  def testPause(self):
+    sw = stopwatch.StopWatch(nested=True)
+    sw.start('a')
+    self.time.sleep(1)
+    sw.pause()
+    self.time.sleep(5)
+    sw.resume()
+    self.time.sleep(1)
+    sw.pause()
+    self.time.sleep(5)
+    sw.stop('a')
+    self.assertAlmostEqual(2, sw.timervalue('a'), 2)
+    self.assertAlmostEqual(10, sw.suspended['a'] / 1e9, 2)
+    self.assertAlmostEqual(2, sw.tree()[0][1], 2)
+    self.assertIn('suspended', sw.dump(verbose=True, output_format='json'))
+
+  def testSnapshotWhilePaused(self):
+    sw = stopwatch.StopWatch(nested=True)
+    sw.start('a')
+    self.time.sleep(10)
+    sw.pause()
+    self.time.sleep(1000)
+    self.assertAlmostEqual(10, sw.timervalue('a'), 2)
+    first = sw.snapshot()
+    self.time.sleep(1000)
+    merged = stopwatch.StopWatch(nested=True)
+    merged.merge(sw)
+    self.assertAlmostEqual(0, merged.timervalue('a'), 2)
+    self.assertAlmostEqual(1000, merged.suspended['a'] / 1e9, 2)
+    self.assertAlmostEqual(0, sw.tree()[0][1], 2)
+    sw.resume()
+    self.time.sleep(10)
+    sw.stop('a')
+    second = sw.snapshot()
+
+    for snapshot in (first, second):
+      self.assertAlmostEqual(10, snapshot.timervalue('a'), 2)
+      self.assertAlmostEqual(1000, snapshot.suspended['a'] / 1e9, 2)
+      self.assertAlmostEqual(10, snapshot.tree()[0][1], 2)
+
+  def testSampling(self):
+    sw = stopwatch.StopWatch(sampling={'a': 4})
+    sw.start()
+    for i in range(100):
+      with sw.timer('a'):
+        self.time.sleep(1 + i % 2)
+    sw.stop()
+
+    self.assertEqual(25, sw.counters['a'])
+    results = dict((r[0], r[1:]) for r in sw.results(verbose=True))
+    # Every 4th start is sampled, and those all sleep for one second.
+    self.assertAlmostEqual(100, results['a'][0], 0)
+    self.assertEqual(100, results['a'][1])
+    self.assertAlmostEqual(150, results['total'][0], 0)
+    self.assertAlmostEqual(50, results['overhead'][0], 0)
+    self.assertAlmostEqual(0, sw.sampling_error('a'), 2)
+    self.assertIsNone(sw.sampling_error('total'))
+    self.assertIn('sampled', sw.dump(verbose=True))
+
+  def testSamplingRecursion(self):
+    sw = stopwatch.StopWatch(sampling={'fact': 2})
+
+    @sw.timed('fact')
+    def Fact(n):
+      self.time.sleep(1)
+      return n * Fact(n - 1) if n > 1 else 1
+
+    for _ in range(10):
+      Fact(3)
+    # Every start is counted, re-entered or not, sampled or not, and every
+    # other outermost start is sampled.
+    self.assertListEqual([30, 15], sw._sampling_stats['fact'][:2])
+    self.assertAlmostEqual(30, sw.results(verbose=True)[0][1], 0)
+    self.assertEqual(30, sw.results(verbose=True)[0][2])
+
+  def testRandomSampling(self):
+    random.seed(301)
+    sw = stopwatch.StopWatch(sampling={'a': 10}, random_sampling=True)
+    for i in range(2000):
+      with sw.timer('a'):
+        self.time.sleep(i % 3)
+    value, num_starts = sw.results(verbose=True)[0][1:]
+    self.assertEqual(2000, num_starts)
+    error = sw.sampling_error('a')
+    self.assertGreater(error, 0)
+    # The true total is 1999 seconds.
+    self.assertBetween(value, 1999 - 4 * error, 1999 + 4 * error)
+
+  def testSamplingSkipsSpans(self):
+    sw = stopwatch.StopWatch(nested=True, sampling={'b': 2})
+    for _ in range(4):
+      with sw.timer('a'):
+        with sw.timer('b'):
+          with sw.timer('c'):
+            pass
+    self.assertListEqual([(('a',), 4), (('a', 'b'), 2), (('a', 'b', 'c'), 2),
+                          (('a', 'c'), 2)],
+                         [(node[0], node[3]) for node in sw.tree()])
+
+  def testSamplingInsideAnotherTimer(self):
+    sw = stopwatch.StopWatch(sampling={'db': 10})
+    sw.start()
+    for _ in range(100):
+      with sw.timer('req'):
+        self.time.sleep(1)
+        with sw.timer('db'):
+          self.time.sleep(9)
+    sw.stop()
+
+    results = dict((r[0], r[1:]) for r in sw.results(verbose=True))
+    # The unsampled uses of 'db' are left out of 'req' too, rather than
+    # being counted there and in the scaled up time of 'db'.
+    self.assertAlmostEqual(900, results['db'][0], 0)
+    self.assertAlmostEqual(100, results['req'][0], 0)
+    self.assertAlmostEqual(1000, results['total'][0], 0)
+    self.assertAlmostEqual(0, results['overhead'][0], 0)
+
+  def testSnapshotWhileSampling(self):
+    sw = stopwatch.StopWatch(sampling={'a': 2})
+    for _ in range(2):
+      with sw.timer('a'):
+        self.time.sleep(1)
+    sw.start('a')
+    self.time.sleep(1)
+    first = sw.snapshot()
+    self.time.sleep(3)
+    sw.stop('a')
+    second = sw.snapshot()
+    first_results = dict(r[:2] for r in first.results(verbose=True))
+    second_results = dict(r[:2] for r in second.results(verbose=True))
+
+    # Two of the three starts were sampled, and saw two seconds in all.
+    self.assertAlmostEqual(3, first_results['a'], 2)
+    self.assertEqual(1, first._sampling_stats['a'][2])
+    # The sample for the running start covers its whole run, and its tail is
+    # scaled up like the rest of the sampled time.
+    self.assertEqual(1, second._sampling_stats['a'][2])
+    self.assertAlmostEqual(4, second._sampling_stats['a'][3] / 1e9, 2)
+    self.assertAlmostEqual(6, second_results['a'], 2)
+
+  def testMergeSampling(self):
+    sw1 = stopwatch.StopWatch(sampling={'a': 2})
+    sw2 = stopwatch.StopWatch(sampling={'a': 2})
+    for sw in (sw1, sw2, sw2):
+      with sw.timer('a'):
+        self.time.sleep(1)
+    merged = stopwatch.StopWatch()
+    merged.merge(sw1)
+    merged.merge(sw2)
+    self.assertEqual(3, merged.results(verbose=True)[0][2])
+    self.assertAlmostEqual(3, merged.results(verbose=True)[0][1], 2)
+
+  def testDeserializeKeepsSamplingRates(self):
+    sw = stopwatch.StopWatch(sampling={'a': 4})
+    sw.start('a')
+    self.time.sleep(1)
+    sw.snapshot()
+    # No start since the snapshot was sampled, but the tail of one was.
+    self.time.sleep(1)
+    sw.stop('a')
+    self.assertAlmostEqual(4, sw.results(verbose=True)[0][1], 2)
+    copy = stopwatch.StopWatch.deserialize(sw.serialize())
+    self.assertEqual(sw.results(verbose=True)[0],
+                     copy.results(verbose=True)[0])
+
+  def testTrackMemory(self):
+    if not tracemalloc.is_tracing():
+      self.addCleanup(tracemalloc.stop)
+    sw = stopwatch.StopWatch(track_memory=True)
+    self.assertTrue(tracemalloc.is_tracing())
+    self.assertIsNone(sw.memory('a'))
+    with sw.timer('a'):
+      kept = [0] * 100000
+      with sw.timer('b'):
+        scratch = [0] * 200000
+        del scratch
+        gc.collect()
+    allocated, peak, collections = sw.memory('a')
+    self.assertGreaterEqual(allocated, 800000)
+    # The temporary list of 'b' is not counted against 'a'.
+    self.assertLess(peak, 1600000)
+    self.assertEqual(0, collections)
+    allocated, peak, collections = sw.memory('b')
+    self.assertLess(allocated, 100000)
+    self.assertGreaterEqual(peak, 1600000)
+    self.assertGreaterEqual(collections, 1)
+    del kept
+
+    merged = stopwatch.StopWatch.deserialize(sw.serialize())
+    merged.merge(sw)
+    self.assertEqual(2 * sw.memory('b')[2], merged.memory('b')[2])
+    self.assertEqual(sw.memory('b')[1], merged.memory('b')[1])
+    self.assertIn(' gc ', merged.dump(verbose=True))
+    self.assertIn('gc_collections', merged.dump(True, output_format='json'))
+
+  def testTrackMemoryWithSeveralStopWatches(self):
+    if not tracemalloc.is_tracing():
+      self.addCleanup(tracemalloc.stop)
+    sw1 = stopwatch.StopWatch(track_memory=True)
+    sw2 = stopwatch.StopWatch(track_memory=True)
+    with sw1.timer('a'):
+      scratch = [0] * 200000
+      del scratch
+      # Reading the memory from sw2 resets the peak of tracemalloc, but sw1
+      # still gets the peak its timer saw.
+      with sw2.timer('b'):
+        pass
+    self.assertGreaterEqual(sw1.memory('a')[1], 1600000)
+    self.assertLess(sw2.memory('b')[1], 1600000)
+
+  def testTrackMemoryWithoutResetPeak(self):
+    if not tracemalloc.is_tracing():
+      self.addCleanup(tracemalloc.stop)
+    self.addCleanup(setattr, stopwatch, '_reset_peak', stopwatch._reset_peak)
+    stopwatch._reset_peak = None
+    sw = stopwatch.StopWatch(track_memory=True)
+    scratch = [0] * 200000
+    del scratch
+    with sw.timer('a'):
+      with sw.timer('b'):
+        kept = [0] * 100000
+    # The peak reached before 'a' started is not counted against it.
+    self.assertLess(sw.memory('a')[1], 1600000)
+    self.assertGreaterEqual(sw.memory('b')[1], 800000)
+    del kept
+
+  def testTrackCpu(self):
+    sw = stopwatch.StopWatch(track_cpu=True)
+    self.assertIsNone(sw.cpu('a'))
+    sw.start()
+    with sw.timer('a'):
+      self.time.spin(1)
+      self.time.sleep(1)
+      with sw.timer('b'):
+        self.time.spin(2)
+    self.time.sleep(1)
+    sw.stop()
+    self.assertEqual(1, sw.cpu('a'))
+    self.assertAlmostEqual(0.5, sw.cpu_ratio('a'), 3)
+    self.assertAlmostEqual(1, sw.cpu_ratio('b'), 3)
+    self.assertEqual(3, sw.cpu())
+    self.assertAlmostEqual(0.6, sw.cpu_ratio(), 3)
+    self.assertIn('( 50%)', sw.dump(verbose=True))
+
+    copy = stopwatch.StopWatch.deserialize(sw.serialize())
+    copy.merge(sw)
+    self.assertEqual(6, copy.cpu())
+    timers = json.loads(copy.dump(True, output_format='json'))['timers']
+    self.assertEqual(2, timers[0]['cpu_seconds'])
+
+  def testTrackCpuLeavesOutPause(self):
+    sw = stopwatch.StopWatch(track_cpu=True)
+    sw.start('a')
+    sw.pause()
+    self.time.spin(1)
+    sw.resume()
+    self.time.spin(1)
+    sw.stop('a')
+    self.assertEqual(1, sw.cpu('a'))
+
+  def testSerialize(self):
+    sw = stopwatch.StopWatch(nested=True, histograms=True,
+                             sampling={'b': 2})
+    sw.start()
+    for _ in range(3):
+      with sw.timer('a'):
+        self.time.sleep(1)
+        with sw.timer('b'):
+          self.time.sleep(1)
+    sw.pause()
+    self.time.sleep(1)
+    sw.resume()
+
+    data = sw.serialize()
+    self.assertIsInstance(data, bytes)
+    copy = stopwatch.StopWatch.deserialize(data)
+    self.assertDictEqual({}, copy.timers)
+    # The running total was counted up to when it was serialized.
+    self.assertAlmostEqual(sw.timervalue(), copy.timervalue(), 2)
+    self.assertListEqual(sw.results(verbose=True)[:2],
+                         copy.results(verbose=True)[:2])
+    self.assertListEqual([node[0] for node in sw.tree()],
+                         [node[0] for node in copy.tree()])
+    self.assertEqual(3, copy.histogram('a').count)
+    self.assertEqual(sw.histogram('a').percentile(50),
+                     copy.histogram('a').percentile(50))
+    self.assertEqual(sw.sampling_error('b'), copy.sampling_error('b'))
+    self.assertDictEqual(sw.suspended, copy.suspended)
+
+    plain = stopwatch.StopWatch.deserialize(stopwatch.StopWatch().serialize())
+    self.assertRaises(RuntimeError, plain.tree)
+    self.assertRaises(RuntimeError, plain.histogram)
+
+  def testReset(self):
+    sw = stopwatch.StopWatch(nested=True)
+    sw.start('a')
+    sw.reset()
+    self.assertDictEqual({}, sw.timers)
+    self.assertListEqual([], sw.tree())
+    self.assertRaises(RuntimeError, sw.stop, 'a')
+
+
+class PoolTest(basetest.TestCase):
+
+  def testGathersWorkerStopWatches(self):
+    parent = stopwatch.StopWatch()
+    pool = stopwatch.Pool(3, stopwatch=parent)
+    self.assertListEqual([0, 2, 4, 6], pool.map(_PoolWork, range(4)))
+    pool.close()
+    pool.join()
+    results = dict((r[0], r[2]) for r in parent.results(verbose=True))
+    self.assertEqual(4, results['inner'])
+    self.assertEqual(4, results['work'])
+
+  def testMaxTasksPerChild(self):
+    parent = stopwatch.StopWatch()
+    pool = stopwatch.Pool(2, maxtasksperchild=1, stopwatch=parent)
+    pool.map(_PoolWork, range(5), chunksize=1)
+    pool.close()
+    pool.join()
+    self.assertEqual(5, parent.counters['inner'])
+
+  def testStopWatchOptions(self):
+    parent = stopwatch.StopWatch()
+    pool = stopwatch.Pool(2, stopwatch=parent,
+                          stopwatch_options={'nested': True,
+                                             'histograms': True})
+    pool.map(_PoolWork, range(4))
+    pool.close()
+    pool.join()
+    self.assertEqual(4, parent.histogram('inner').count)
+    self.assertListEqual([(('work',), 4), (('work', 'inner'), 4)],
+                         [(node[0], node[3]) for node in parent.tree()])
+
+
+class AsyncStopWatchTest(basetest.TestCase):
+
+  def testTasksKeepSeparateTimers(self):
+    sw = stopwatch.AsyncStopWatch()
+
+    async def Worker(event):
+      with sw.timer('work'):
+        await event.wait()
+
+    async def Main():
+      event = asyncio.Event()
+      with sw.timer('main'):
+        tasks = [asyncio.ensure_future(Worker(event)) for _ in range(3)]
+        await asyncio.sleep(0)
+        # The workers started their timers without stopping this one.
+        self.assertIn('main', sw._get().timers)
+        event.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(Main())
+    results = dict((r[0], r[2]) for r in sw.results(verbose=True))
+    self.assertEqual(1, results['main'])
+    self.assertEqual(3, results['work'])
+    # Finished tasks are folded into a single StopWatch.
+    self.assertEqual(0, len(sw._stopwatches))
+
+  def testTaskFactoryLeavesOutSuspendedTime(self):
+    clock = [0]
+    sw = stopwatch.AsyncStopWatch(clock=lambda: clock[0])
+
+    async def Worker(event):
+      with sw.timer('work'):
+        clock[0] += 10
+        await event.wait()
+        clock[0] += 5
+
+    async def Main():
+      asyncio.get_running_loop().set_task_factory(sw.task_factory)
+      event = asyncio.Event()
+      task = asyncio.ensure_future(Worker(event))
+      await asyncio.sleep(0)
+      # Time passing while the worker is suspended is not counted.
+      clock[0] += 1000
+      event.set()
+      await task
+
+    asyncio.run(Main())
+    merged = sw.merged()
+    self.assertEqual(15, merged.accum['work'])
+    self.assertEqual(1000, merged.suspended['work'])
+    self.assertIn('suspended', sw.dump(verbose=True))
+
+  def testPeriodicReporterDuringTaskChurn(self):
+    sw = stopwatch.AsyncStopWatch()
+    counts = []
+
+    def Sink(report):
+      counts.extend(timer['count'] for timer in json.loads(report)['timers']
+                    if timer['name'] == 'work')
+
+    async def Worker():
+      with sw.timer('work'):
+        await asyncio.sleep(0)
+
+    async def Main():
+      for _ in range(50):
+        await asyncio.gather(*[Worker() for _ in range(200)])
+
+    reporter = stopwatch.PeriodicReporter(sw, 0.0001, Sink,
+                                          output_format='json')
+    reporter.start()
+    asyncio.run(Main())
+    reporter.stop()
+    # Every task is reported exactly once, whenever it finished.
+    self.assertGreater(len(counts), 1)
+    self.assertEqual(50 * 200, sum(counts))
+
+  def testOutsideOfTasks(self):
+    sw = stopwatch.AsyncStopWatch()
+    with sw.timer('sync'):
+      pass
+    self.assertEqual(1, sw.merged().counters['sync'])
+
+  def testCallbacksOutsideOfTasksShareAStopWatch(self):
+    sw = stopwatch.AsyncStopWatch()
+
+    def Callback():
+      with sw.timer('callback'):
+        pass
+
+    async def Main():
+      loop = asyncio.get_running_loop()
+      for _ in range(1000):
+        loop.call_soon(Callback)
+      await asyncio.sleep(0)
+      await asyncio.sleep(0)
+
+    asyncio.run(Main())
+    self.assertLessEqual(len(sw._stopwatches), 2)
+    self.assertEqual(1000, sw.merged().counters['callback'])
+
+
+class HistogramTest(basetest.TestCase):
+
+  def testEmpty(self):
+    histogram = stopwatch.Histogram()
+    self.assertEqual(0, histogram.count)
+    self.assertIsNone(histogram.percentile(50))
+
+  def testSmallValuesAreExact(self):
+    histogram = stopwatch.Histogram()
+    for value in range(1, 11):
+      histogram.record(value)
+    self.assertEqual(10, histogram.count)
+    self.assertEqual(55, histogram.total)
+    self.assertEqual(5, histogram.percentile(50))
+    self.assertEqual(9, histogram.percentile(90))
+    self.assertEqual(10, histogram.percentile(100))
+
+  def testRelativeError(self):
+    histogram = stopwatch.Histogram()
+    for value in range(1, 100001):
+      histogram.record(value * 1000)
+    for percent in (50, 90, 99):
+      expected = percent * 1000 * 1000
+      self.assertBetween(histogram.percentile(percent), expected,
+                         expected * (1 + 2 ** -4))
+    self.assertEqual(100000 * 1000, histogram.max)
+    self.assertEqual(1000, histogram.min)
+
+  def testMemoryIsBounded(self):
+    histogram = stopwatch.Histogram()
+    for shift in range(64):
+      for low in range(64):
+        histogram.record((1 << shift) + low)
+        histogram.record((2 << shift) - 1 - low)
+    self.assertLessEqual(len(histogram._buckets), 61 * 16)
+
+  def testMerge(self):
+    a = stopwatch.Histogram()
+    b = stopwatch.Histogram()
+    for value in range(10):
+      a.record(value)
+      b.record(value + 10)
+    a.merge(b)
+    self.assertEqual(20, a.count)
+    self.assertEqual(0, a.min)
+    self.assertEqual(19, a.max)
+    self.assertEqual(9, a.percentile(50))
+    self.assertRaises(ValueError, a.merge, stopwatch.Histogram(3))
+
+
+class ThreadLocalStopWatchTest(basetest.TestCase):
+
+  def testThreadsKeepSeparateTimers(self):
+    sw = stopwatch.ThreadLocalStopWatch()
+    sw.start('main')
+    started = threading.Barrier(4)
+
+    def Worker():
+      sw.start('work')
+      started.wait()
+      sw.start('inner')
+      sw.stop('inner')
+      sw.stop('work')
+
+    threads = [threading.Thread(target=Worker) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # The workers did not stop the main thread's timer.
+    self.assertGreater(sw.timervalue('main'), 0)
+    results = dict((r[0], r[2]) for r in sw.results(verbose=True))
+    self.assertEqual(1, results['main'])
+    self.assertEqual(4, results['inner'])
+    # Every worker's 'work' timer was restarted once after 'inner' stopped.
+    self.assertEqual(8, results['work'])
+    self.assertIn('inner', sw.dump(verbose=True))
+
+  def testExitedThreadsAreMerged(self):
+    sw = stopwatch.ThreadLocalStopWatch(histograms=True)
+
+    def Worker():
+      with sw.timer('work'):
+        pass
+
+    for _ in range(10):
+      thread = threading.Thread(target=Worker)
+      thread.start()
+      thread.join()
+    # pylint: disable=protected-access
+    self.assertEqual(set(), sw._stopwatches)
+    self.assertEqual(10, sw.histogram('work').count)
+    self.assertEqual(10, dict((r[0], r[2]) for r in sw.results(True))['work'])
+
+  def testThreadExitingDuringReportIsCountedOnce(self):
+    sw = stopwatch.ThreadLocalStopWatch()
+    recorded = threading.Event()
+    done = threading.Event()
+
+    def Worker():
+      with sw.timer('work'):
+        pass
+      recorded.set()
+      done.wait()
+
+    thread = threading.Thread(target=Worker)
+    thread.start()
+    recorded.wait()
+    # pylint: disable=protected-access
+    shards = sw._shards
+
+    def ShardsThenExit():
+      # The worker exits, and would retire its shard, after it was listed.
+      result = shards()
+      done.set()
+      thread.join(0.1)
+      return result
+
+    sw._shards = ShardsThenExit
+    results = dict((r[0], r[2]) for r in sw.snapshot().results(True))
+    self.assertEqual(1, results['work'])
+    thread.join()
+    self.assertNotIn('work', dict(
+        (r[0], r[2]) for r in sw.snapshot().results(True)))
+
+  def testTreeMergesThreads(self):
+    sw = stopwatch.ThreadLocalStopWatch(nested=True)
+
+    def Worker():
+      sw.start('a')
+      sw.start('b')
+      sw.stop('b')
+      sw.stop('a')
+
+    threads = [threading.Thread(target=Worker) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertListEqual([(('a',), 3), (('a', 'b'), 3)],
+                         [(node[0], node[3]) for node in sw.tree()])
+
+  def testTimerIsPerThread(self):
+    sw = stopwatch.ThreadLocalStopWatch()
+    timer = sw.timer('work')
+
+    def Worker():
+      with timer:
+        pass
+
+    threads = [threading.Thread(target=Worker) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(3, dict((r[0], r[2]) for r in sw.results(True))['work'])
+
 
 if __name__ == '__main__':
   basetest.main()